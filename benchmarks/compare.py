@@ -0,0 +1,97 @@
+import argparse
+import json
+import os
+import sys
+
+import pandas as pd
+
+CASE_COLUMNS = ["n_samples", "n_proteins", "metric", "evaluation", "stage"]
+# arguments of run.py that only select the cases or name the output
+CASE_ARGUMENTS = {"output", "samples", "proteins", "metrics", "evaluation"}
+
+
+def load_results(path):
+    with open(path) as f:
+        report = json.load(f)
+    results = pd.DataFrame(report["results"])
+    return report.get("commit") or path, report.get("arguments", {}), results
+
+
+def mismatched_arguments(baseline, candidate):
+    """Run arguments, other than the case grid, that differ between two benchmarks."""
+    # checkouts of the two commits keep the same default ranking at different paths
+    baseline, candidate = (
+        dict(arguments, ranking=os.path.basename(arguments.get("ranking") or ""))
+        for arguments in (baseline, candidate)
+    )
+    names = (set(baseline) | set(candidate)) - CASE_ARGUMENTS
+    return sorted(name for name in names if baseline.get(name) != candidate.get(name))
+
+
+def compare(baseline, candidate, threshold):
+    """
+    Median times and peak memory of the cases run in both benchmarks, with the
+    candidate / baseline ratios and whether they exceed 1 + `threshold`.
+    """
+    merged = baseline.merge(
+        candidate, on=CASE_COLUMNS, suffixes=("_baseline", "_candidate")
+    )
+    merged["time_ratio"] = merged["median_candidate"] / merged["median_baseline"]
+    merged["memory_ratio"] = (
+        merged["peak_bytes_candidate"] / merged["peak_bytes_baseline"]
+    )
+    merged["regression"] = (merged["time_ratio"] > 1 + threshold) | (
+        merged["memory_ratio"] > 1 + threshold
+    )
+    return merged[
+        CASE_COLUMNS
+        + [
+            "median_baseline",
+            "median_candidate",
+            "time_ratio",
+            "peak_bytes_baseline",
+            "peak_bytes_candidate",
+            "memory_ratio",
+            "regression",
+        ]
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare two benchmark result files of benchmarks/run.py."
+    )
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative slowdown or memory growth reported as a regression.",
+    )
+    args = parser.parse_args(argv)
+
+    baseline_name, baseline_arguments, baseline = load_results(args.baseline)
+    candidate_name, candidate_arguments, candidate = load_results(args.candidate)
+    mismatched = mismatched_arguments(baseline_arguments, candidate_arguments)
+    if mismatched:
+        # timings of different cohorts, repeats or parameters are not comparable
+        parser.error(
+            "the benchmarks were run with different arguments: "
+            + ", ".join(
+                f"--{name.replace('_', '-')} {baseline_arguments.get(name)} "
+                f"vs {candidate_arguments.get(name)}"
+                for name in mismatched
+            )
+        )
+    comparison = compare(baseline, candidate, args.threshold)
+    print(f"{baseline_name} -> {candidate_name}")
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(comparison.to_string(index=False, float_format="{:.3f}".format))
+    regressions = int(comparison["regression"].sum())
+    print(f"{regressions} of {len(comparison)} cases regressed.")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,266 @@
+import argparse
+import datetime
+import gc
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+# cold starts clear the scratch directory, which must not be the one of the app;
+# constants reads it on import
+SCRATCH = tempfile.TemporaryDirectory(prefix="spqrp-benchmark-")
+os.environ["SPQRP_SCRATCH_DIR"] = SCRATCH.name
+
+import numpy as np
+import pandas as pd
+
+from blocked import scratch_cache
+from constants import DEFAULT_RANKING_FILE
+from distances import pair_list, result_neighbours
+from embedding import SCALABLE_METHODS
+from ingest import read_ranking_csv
+from instrumentation import own_process
+from matrix import build_protein_matrix
+from pipeline import (
+    clustering_cache,
+    compute_clustering,
+    compute_results,
+    distance_cache,
+    results_cache,
+)
+from synthetic import generate_cohort
+from utils import calculate_f1_based_on_cutoff, calculate_f1_based_on_nn_neighbour
+
+DEFAULT_RANKING_PATH = os.path.join(ROOT, "data", DEFAULT_RANKING_FILE)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def cold_start():
+    for cache in (distance_cache(), results_cache(), clustering_cache()):
+        cache.clear()
+    # out-of-core runs would otherwise reuse the distance files of the last one
+    scratch_cache().clear()
+    gc.collect()
+
+
+def measure(function, repeat):
+    """
+    Wall times of `repeat` cold runs and the peak traced memory of one more,
+    which runs apart because tracing slows the Python parts down.
+    """
+    times = []
+    for _ in range(repeat):
+        cold_start()
+        start = time.perf_counter()
+        value = function()
+        times.append(time.perf_counter() - start)
+    cold_start()
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return value, {
+        "times": times,
+        "median": float(np.median(times)),
+        "min": min(times),
+        "peak_bytes": peak,
+    }
+
+
+def swap_recall(df_display, swaps):
+    # swapped samples among as many samples with the lowest F1
+    if swaps.empty:
+        return None
+    lowest = df_display.nsmallest(len(swaps), "Sample F1")["Sample ID"]
+    return float(np.isin(swaps["Sample_ID"], lowest.to_numpy()).mean())
+
+
+def run_case(prot_ranking, case, args):
+    df, swaps = generate_cohort(
+        prot_ranking,
+        n_patients=case["n_samples"] // args.samples_per_patient,
+        samples_per_patient=args.samples_per_patient,
+        missing_rate=args.missing_rate,
+        swap_rate=args.swap_rate,
+        seed=args.seed,
+    )
+    parameters = {
+        "param_evaluation_method": case["evaluation"],
+        "param_k": args.samples_per_patient - 1,
+        "param_n": case["n_proteins"],
+        "param_n_max": None,
+        "param_metric": case["metric"],
+        "param_fractional_p": args.fractional_p,
+        "param_min_overlap": args.min_overlap,
+        "param_mode": "use parameters",
+        "param_optimization_metric": "F1",
+        "param_percentile": args.percentile,
+        "number_display_neighbours": args.neighbours,
+    }
+    fingerprint = f"benchmark:{sorted(case.items())}:{args.seed}"
+    stages = {}
+
+    matrix, stages["build_protein_matrix"] = measure(
+        lambda: build_protein_matrix(df, prot_ranking, fingerprint), args.repeat
+    )
+    output, stages["compute_results"] = measure(
+        lambda: compute_results(matrix, parameters, state={}), args.repeat
+    )
+    result = output["result"]
+    mapping = dict(zip(matrix.sample_ids, matrix.patient_ids[matrix.patient_codes]))
+    if "pair_indices" in result:
+        pairs = {
+            name: pair_list(indices, result["sample_ids"])
+            for name, indices in result["pair_indices"].items()
+        }
+        _, stages["calculate_f1_based_on_cutoff"] = measure(
+            lambda: calculate_f1_based_on_cutoff(
+                df, pairs["TP"], pairs["FP"], [], pairs["FN"], mapping
+            ),
+            args.repeat,
+        )
+    nearest_neighbours = result_neighbours(result)
+    _, stages["calculate_f1_based_on_nn_neighbour"] = measure(
+        lambda: calculate_f1_based_on_nn_neighbour(
+            df, nearest_neighbours, mapping, parameters["param_k"]
+        ),
+        args.repeat,
+    )
+    if args.cluster_method is not None and result.get("square"):
+        _, stages["compute_clustering"] = measure(
+            lambda: compute_clustering(
+                result,
+                df,
+                args.cluster_method,
+                args.samples_per_patient - 1,
+                args.samples_per_patient,
+                df_name="benchmark",
+                values=matrix.top_n(case["n_proteins"]),
+                embedding_options={
+                    "metric": case["metric"],
+                    "fractional_p": args.fractional_p,
+                },
+            ),
+            args.repeat,
+        )
+
+    quality = dict(output["metrics"])
+    quality["swap_recall"] = swap_recall(output["df_display"], swaps)
+    return [
+        {**case, "stage": stage, **timing, "quality": quality}
+        for stage, timing in stages.items()
+    ]
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time the SPQRP pipeline on synthetic cohorts."
+    )
+    parser.add_argument(
+        "-o", "--output", default=None, help="JSON file for the results."
+    )
+    parser.add_argument("--ranking", default=DEFAULT_RANKING_PATH)
+    parser.add_argument("--samples", type=int, nargs="+", default=[200, 1000, 4000])
+    parser.add_argument("--proteins", type=int, nargs="+", default=[20, 100])
+    parser.add_argument(
+        "--metrics",
+        nargs="+",
+        choices=["correlation", "fractional", "euclidean"],
+        default=["correlation", "euclidean"],
+    )
+    parser.add_argument(
+        "--evaluation",
+        nargs="+",
+        choices=["Threshold", "Nearest Neighbour"],
+        default=["Threshold"],
+    )
+    parser.add_argument("--samples-per-patient", type=int, default=2)
+    parser.add_argument("--missing-rate", type=float, default=0.1)
+    parser.add_argument("--swap-rate", type=float, default=0.02)
+    parser.add_argument("--percentile", type=float, default=0.5)
+    parser.add_argument("--fractional-p", type=float, default=0.01)
+    parser.add_argument(
+        "--min-overlap",
+        type=int,
+        default=None,
+        help="Pairwise-complete distances instead of mean imputation.",
+    )
+    parser.add_argument("--neighbours", type=int, default=10)
+    parser.add_argument(
+        "--cluster-method",
+        choices=["UMAP", "PCA", "MDS", *SCALABLE_METHODS],
+        default=None,
+        help="Also time compute_clustering with this representation.",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    if args.samples_per_patient < 2:
+        # param_k is samples_per_patient - 1 and needs at least one neighbour
+        parser.error("--samples-per-patient must be at least 2")
+    return args
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    own_process()
+    with open(args.ranking, "rb") as f:
+        prot_ranking = read_ranking_csv(f.read())
+
+    cases = [
+        {
+            "n_samples": n_samples,
+            "n_proteins": n_proteins,
+            "metric": metric,
+            "evaluation": evaluation,
+        }
+        for n_samples, n_proteins, metric, evaluation in itertools.product(
+            args.samples, args.proteins, args.metrics, args.evaluation
+        )
+    ]
+    results = []
+    for done, case in enumerate(cases, start=1):
+        rows = run_case(prot_ranking, case, args)
+        results += rows
+        timings = ", ".join(f"{r['stage']} {r['median']:.3f} s" for r in rows)
+        print(f"[{done}/{len(cases)}] {case}: {timings}")
+
+    report = {
+        "commit": git_commit(),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "arguments": vars(args),
+        "results": results,
+    }
+    output = args.output or f"benchmark-{report['commit'] or 'local'}.json"
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, default=float)
+    print(f"Results written to {output}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
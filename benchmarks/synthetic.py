@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+
+
+def generate_cohort(
+    prot_ranking,
+    n_patients,
+    samples_per_patient=2,
+    n_proteins=None,
+    missing_rate=0.1,
+    swap_rate=0.02,
+    seed=0,
+):
+    """
+    Seeded synthetic plasma proteome in the long format of the app (Sample_ID,
+    Patient_ID, Protein, Intensity) over the proteins of `prot_ranking`.
+
+    Log2 intensities are a protein baseline, a patient offset and sample noise.
+    The patient offsets are largest for the proteins ranked most important, so
+    that samples of a patient are closest on the top of the ranking. Values are
+    missing more often the lower they are, `missing_rate` (up to 0.5) of them
+    on average. A `swap_rate` fraction of the samples is mixed up in pairs
+    across patients by exchanging their Patient_ID labels.
+
+    Returns the data frame and a table of the swapped samples with their true
+    and recorded patient.
+    """
+    rng = np.random.default_rng(seed)
+    ranking = prot_ranking.drop_duplicates("Protein")
+    if n_proteins is not None:
+        ranking = ranking.head(n_proteins)
+    proteins = ranking["Protein"].to_numpy()
+    importance = ranking["Importance"].to_numpy(dtype=np.float64)
+    n_samples = n_patients * samples_per_patient
+
+    patient_codes = np.repeat(np.arange(n_patients), samples_per_patient)
+    baseline = rng.normal(22.0, 3.0, len(proteins))
+    patient_sd = 0.3 + 2.0 * np.sqrt(importance / importance.max())
+    patient_offsets = rng.normal(0.0, patient_sd, (n_patients, len(proteins)))
+    intensities = (
+        baseline
+        + patient_offsets[patient_codes]
+        + rng.normal(0.0, 0.4, (n_samples, len(proteins)))
+    ).astype(np.float32)
+
+    # missing not at random: the lower a value within its protein, the likelier
+    quantiles = intensities.argsort(axis=0).argsort(axis=0) / max(n_samples - 1, 1)
+    missing = rng.random(intensities.shape) < missing_rate * 2 * (1 - quantiles)
+    intensities[missing] = np.nan
+
+    patient_ids = np.array([f"P{i:06d}" for i in range(n_patients)])
+    sample_ids = np.char.add(
+        patient_ids[patient_codes],
+        np.char.add("_S", (np.arange(n_samples) % samples_per_patient).astype(str)),
+    )
+    recorded = patient_codes.copy()
+    n_swaps = int(n_samples * swap_rate) // 2
+    candidates = rng.permutation(n_samples)
+    swapped = []
+    for a, b in zip(candidates[::2], candidates[1::2]):
+        if len(swapped) == 2 * n_swaps:
+            break
+        if patient_codes[a] != patient_codes[b]:
+            recorded[[a, b]] = recorded[[b, a]]
+            swapped += [a, b]
+    swapped = np.sort(np.asarray(swapped, dtype=np.int64))
+
+    measured = ~missing
+    rows, columns = np.nonzero(measured)
+    df = pd.DataFrame(
+        {
+            "Sample_ID": pd.Categorical(sample_ids[rows]),
+            "Patient_ID": pd.Categorical(patient_ids[recorded[rows]]),
+            "Protein": pd.Categorical(proteins[columns]),
+            "Intensity": intensities[rows, columns],
+        }
+    )
+    swaps = pd.DataFrame(
+        {
+            "Sample_ID": sample_ids[swapped],
+            "True_Patient_ID": patient_ids[patient_codes[swapped]],
+            "Recorded_Patient_ID": patient_ids[recorded[swapped]],
+        }
+    )
+    return df, swaps
@@ -0,0 +1,199 @@
+import os
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+
+from cache import DiskCache, make_private_directory, partial_path
+from constants import CACHE_TTL_SECONDS, SCRATCH_DIR, SCRATCH_MAX_BYTES
+from distances import (
+    CHUNK_PAIRS,
+    condensed_block,
+    compact_neighbours,
+    condensed_row_bounds,
+    confusion_metrics,
+    fill_missing,
+    fill_undefined,
+    iter_row_chunks,
+    masked_blocks,
+    pair_counts_per_sample,
+    same_patient_rows,
+)
+from neighbours import BLOCK_ELEMENTS
+from parallel import balanced_row_blocks, parallel_map, worker_count
+from sketch import refined_percentile
+
+
+def scratch_cache():
+    # the least recently read distance files are deleted once over the budget
+    return DiskCache(SCRATCH_DIR, SCRATCH_MAX_BYTES, CACHE_TTL_SECONDS)
+
+
+def scratch_distances(
+    values,
+    metric,
+    fractional_p,
+    key,
+    n_jobs=None,
+    backend=None,
+    min_overlap=None,
+    means=None,
+):
+    """
+    blocked_condensed_distances into the scratch file of the distance `key`,
+    which later runs with the same key map again while it is kept.
+    """
+    scratch = scratch_cache()
+    condensed = scratch.get(key)
+    if condensed is None:
+        condensed = blocked_condensed_distances(
+            values,
+            metric,
+            fractional_p,
+            scratch.path(key, ".npy"),
+            n_jobs=n_jobs,
+            backend=backend,
+            min_overlap=min_overlap,
+            means=means,
+        )
+        scratch.evict()
+    return condensed
+
+
+@contextmanager
+def temporary_distances(
+    values,
+    metric,
+    fractional_p,
+    n_jobs=None,
+    backend=None,
+    min_overlap=None,
+    means=None,
+):
+    """
+    blocked_condensed_distances into a scratch file of its own that is deleted
+    on exit, for the candidates of an optimization sweep.
+    """
+    path = os.path.join(SCRATCH_DIR, f"candidate_{uuid.uuid4().hex}.npy")
+    try:
+        yield blocked_condensed_distances(
+            values,
+            metric,
+            fractional_p,
+            path,
+            n_jobs=n_jobs,
+            backend=backend,
+            min_overlap=min_overlap,
+            means=means,
+        )
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def write_block(path, values, block, metric, fractional_p, min_overlap=None):
+    r0, r1 = block
+    starts, stops = condensed_row_bounds(len(values))
+    condensed = np.load(path, mmap_mode="r+")
+    part = condensed_block(values, r0, r1, metric, fractional_p, min_overlap)
+    condensed[starts[r0] : stops[r1 - 1]] = part
+    condensed.flush()
+    # the largest distance of the block, for the pairs left without one
+    return np.fmax.reduce(part, initial=0.0)
+
+
+def blocked_condensed_distances(
+    values,
+    metric,
+    fractional_p,
+    path,
+    n_jobs=None,
+    backend=None,
+    min_overlap=None,
+    means=None,
+):
+    """
+    Compute the condensed float64 distances block by block into a memory-mapped
+    .npy file at `path`; fractional distances with a small p overflow float32. Workers write their row blocks into the file themselves,
+    so only the tiles in flight are held in memory. With `min_overlap` pairs are
+    compared over their shared proteins, see condensed_distances.
+    """
+    if os.path.exists(path):
+        return np.load(path, mmap_mode="r")
+    if min_overlap is None:
+        values = fill_missing(values, means)
+    n_samples = len(values)
+    n_pairs = n_samples * (n_samples - 1) // 2
+
+    make_private_directory(os.path.dirname(path))
+    # runs computing the same distances at once must not share the file
+    partial = partial_path(path)
+    np.lib.format.open_memmap(
+        partial, mode="w+", dtype=np.float64, shape=(n_pairs,)
+    ).flush()
+    n_jobs = worker_count(n_jobs)
+    if min_overlap is None:
+        blocks = balanced_row_blocks(n_samples, max(n_pairs // BLOCK_ELEMENTS, n_jobs))
+    else:
+        blocks = masked_blocks(n_samples, n_jobs)
+
+    def compute(block):
+        return write_block(partial, values, block, metric, fractional_p, min_overlap)
+
+    largest = max(parallel_map(compute, blocks, n_jobs, backend), default=0.0)
+    if min_overlap is not None:
+        condensed = np.load(partial, mmap_mode="r+")
+        for start in range(0, n_pairs, CHUNK_PAIRS):
+            fill_undefined(condensed[start : start + CHUNK_PAIRS], largest)
+        condensed.flush()
+        del condensed
+    # a crashed run must never leave a truncated file under the final name
+    os.replace(partial, path)
+    return np.load(path, mmap_mode="r")
+
+
+def streamed_sample_counts(condensed, patient_codes, threshold):
+    """Per-sample TP/FP/FN counts of the threshold classification, chunk by chunk."""
+    n_samples = len(patient_codes)
+    counts = {name: np.zeros(n_samples, dtype=np.int64) for name in ("TP", "FP", "FN")}
+    step = max(1, CHUNK_PAIRS // max(n_samples, 1))
+    for r0, r1, lo, hi in iter_row_chunks(n_samples, step):
+        belonging = np.asarray(condensed[lo:hi]) <= threshold
+        same_patient = same_patient_rows(patient_codes, r0, r1)
+        for name, mask in (
+            ("TP", belonging & same_patient),
+            ("FP", belonging & ~same_patient),
+            ("FN", ~belonging & same_patient),
+        ):
+            counts[name] += pair_counts_per_sample(np.flatnonzero(mask) + lo, n_samples)
+    return counts
+
+
+def evaluate_distances_streamed(
+    condensed, matrix, percentile, nearest_neighbours, summary
+):
+    """
+    evaluate_distances for a memory-mapped condensed array: the threshold is
+    refined from the distance sketch in `summary` and the confusion counts are
+    streamed from disk; no pair lists are built.
+    """
+    threshold = refined_percentile(condensed, summary, percentile)
+    sample_counts = streamed_sample_counts(condensed, matrix.patient_codes, threshold)
+    # every pair is counted once for each of its two samples
+    tp, fp, fn = (int(sample_counts[name].sum()) // 2 for name in ("TP", "FP", "FN"))
+    tn = len(condensed) - tp - fp - fn
+    neighbour_indices, neighbour_distances = compact_neighbours(nearest_neighbours)
+    return {
+        "eval_metrics": confusion_metrics(tp, fp, fn, tn),
+        "threshold": threshold,
+        "sample_counts": {
+            name: counts.astype(np.int32) for name, counts in sample_counts.items()
+        },
+        "condensed_distances": condensed,
+        "sample_ids": matrix.sample_ids,
+        "neighbour_indices": neighbour_indices,
+        "neighbour_distances": neighbour_distances,
+        "square": False,
+    }
@@ -0,0 +1,246 @@
+import hashlib
+import os
+import pickle
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+def fingerprint_bytes(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def estimate_nbytes(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.memmap):
+        # memory-mapped arrays live on disk and are paged in by the OS
+        return 0
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, (tuple, list)):
+        return sum(estimate_nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(estimate_nbytes(v) for v in value.values())
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """
+    Least recently used cache that evicts entries once `max_bytes` is exceeded.
+    With a `ttl` in seconds entries expire that long after they were stored.
+    """
+
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        # shared instances are used from the script threads of several sessions
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value, size, expires = self._entries[key]
+            if expires is not None and expires < time.time():
+                del self._entries[key]
+                self.current_bytes -= size
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            size = estimate_nbytes(value)
+            # an entry larger than the whole budget is handed back uncached
+            if size > self.max_bytes:
+                return value
+            expires = None if self.ttl is None else time.time() + self.ttl
+            self._entries[key] = (value, size, expires)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+
+_MISSING = object()
+
+
+class MappedArray:
+    """Stands in for a memory-mapped array so that only its path is pickled."""
+
+    def __init__(self, path):
+        self.path = path
+
+
+def detach_memmaps(value):
+    if isinstance(value, dict):
+        return {key: detach_memmaps(item) for key, item in value.items()}
+    if isinstance(value, (tuple, list)):
+        return type(value)(detach_memmaps(item) for item in value)
+    if isinstance(value, np.memmap) and value.filename is not None:
+        return MappedArray(value.filename)
+    return value
+
+
+def attach_memmaps(value):
+    if isinstance(value, dict):
+        return {key: attach_memmaps(item) for key, item in value.items()}
+    if isinstance(value, (tuple, list)):
+        return type(value)(attach_memmaps(item) for item in value)
+    if isinstance(value, MappedArray):
+        return np.load(value.path, mmap_mode="r")
+    return value
+
+
+def partial_path(path):
+    # unique per writer, threads of one process write at once as well
+    return f"{path}.{uuid.uuid4().hex}.partial"
+
+
+def make_private_directory(directory):
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+
+
+def owned_by_user(stat):
+    # files someone else could have written are never loaded
+    return not hasattr(os, "getuid") or stat.st_uid == os.getuid()
+
+
+class DiskCache:
+    """
+    Files under `directory`, one per key: arrays as .npy that are loaded memory
+    mapped, everything else pickled. The least recently read files are deleted
+    once `max_bytes` is exceeded and files older than `ttl` seconds are stale.
+    Only files owned by the current user are read.
+    """
+
+    def __init__(self, directory, max_bytes, ttl=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        make_private_directory(directory)
+
+    def path(self, key, extension):
+        name = hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+        return os.path.join(self.directory, f"{name}{extension}")
+
+    def get(self, key, default=None):
+        for extension in (".npy", ".pkl"):
+            path = self.path(key, extension)
+            try:
+                with open(path, "rb") as f:
+                    stat = os.fstat(f.fileno())
+                    if not owned_by_user(stat):
+                        continue
+                    modified = stat.st_mtime
+                    if self.ttl is not None and modified + self.ttl < time.time():
+                        os.remove(path)
+                        return default
+                    if extension == ".npy":
+                        value = np.load(path, mmap_mode="r")
+                    else:
+                        value = attach_memmaps(pickle.load(f))
+                # the access time orders eviction, the modification time the ttl
+                os.utime(path, (time.time(), modified))
+                return value
+            except (OSError, EOFError, pickle.UnpicklingError):
+                # missing, expired by another process or a scratch file is gone
+                continue
+        return default
+
+    def put(self, key, value):
+        if isinstance(value, np.memmap) or estimate_nbytes(value) > self.max_bytes:
+            # already on disk, or too large to keep
+            return value
+        if isinstance(value, np.ndarray) and value.dtype != object:
+            path = self.path(key, ".npy")
+            partial = partial_path(path)
+            with open(partial, "wb") as f:
+                np.save(f, value)
+        else:
+            path = self.path(key, ".pkl")
+            partial = partial_path(path)
+            with open(partial, "wb") as f:
+                pickle.dump(detach_memmaps(value), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(partial, path)
+        self.evict()
+        return value
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith((".npy", ".pkl")):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith((".npy", ".pkl")):
+                stat = entry.stat()
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class TieredCache:
+    """
+    An LRUCache in memory in front of a DiskCache that survives restarts. Without
+    a `disk` nothing is persisted.
+    """
+
+    def __init__(self, memory, disk):
+        self.memory = memory
+        self.disk = disk
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        value = self.memory.get(key, _MISSING)
+        if value is _MISSING and self.disk is not None:
+            value = self.disk.get(key, _MISSING)
+            if value is not _MISSING:
+                self.memory.put(key, value)
+        return default if value is _MISSING else value
+
+    def put(self, key, value, persist=True):
+        self.memory.put(key, value)
+        if persist and self.disk is not None:
+            self.disk.put(key, value)
+        return value
+
+    def clear(self):
+        self.memory.clear()
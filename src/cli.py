@@ -0,0 +1,286 @@
+import argparse
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from constants import DEFAULT_RANKING_FILE, VIEW_MAX_EDGES, VIEW_MAX_POINTS
+from embedding import EMBEDDING_QUALITY, SCALABLE_METHODS
+from ingest import (
+    TABLE_FORMATS,
+    detect_format,
+    fingerprint_path,
+    read_protein_table,
+    read_ranking_csv,
+)
+from distances import result_neighbours
+from instrumentation import own_process, performance_json
+from matrix import build_protein_matrix
+from pipeline import compute_clustering, compute_results, missing_columns_error
+from utils import with_neighbours
+from visualization import cluster_figure, layout_table
+
+DEFAULT_RANKING_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "data", DEFAULT_RANKING_FILE
+)
+MODES = {"optimize": "optimize parameters", "use": "use parameters"}
+EVALUATION_METHODS = {
+    "threshold": "Threshold",
+    "nearest-neighbour": "Nearest Neighbour",
+}
+
+
+def manifest_value(row, column):
+    value = row.get(column)
+    return value if isinstance(value, str) and value else None
+
+
+def find_cohorts(source):
+    """
+    (name, path, ranking path) of every cohort, either all protein tables in a
+    directory or the rows of a manifest CSV with a `path` and optional `name`
+    and `ranking` columns. Relative paths are resolved against the manifest.
+    """
+    if os.path.isdir(source):
+        paths = sorted(
+            os.path.join(source, file_name)
+            for file_name in os.listdir(source)
+            if os.path.splitext(file_name)[1].lower() in TABLE_FORMATS
+        )
+        return [(os.path.splitext(os.path.basename(p))[0], p, None) for p in paths]
+
+    base = os.path.dirname(os.path.abspath(source))
+    cohorts = []
+    for row in pd.read_csv(source).to_dict("records"):
+        path = os.path.join(base, row["path"])
+        name = (
+            manifest_value(row, "name") or os.path.splitext(os.path.basename(path))[0]
+        )
+        ranking = manifest_value(row, "ranking")
+        cohorts.append((name, path, ranking and os.path.join(base, ranking)))
+    return cohorts
+
+
+def write_table(df, path, fmt):
+    if fmt == "parquet":
+        df.to_parquet(f"{path}.parquet", index=False)
+    else:
+        df.to_csv(f"{path}.csv", index=False)
+
+
+def run_cohort(name, path, ranking_path, parameters, clustering, output_dir, fmt):
+    """Process one cohort and write its tables. Returns its row of the summary."""
+    summary = {"cohort": name, "path": path, "status": "ok", "error": None}
+    try:
+        with open(ranking_path, "rb") as f:
+            prot_ranking = read_ranking_csv(f.read())
+        df = read_protein_table(path, detect_format(path))
+        error = missing_columns_error(df, prot_ranking)
+        if error:
+            raise ValueError(error)
+        fingerprint = f"{fingerprint_path(path)}:{fingerprint_path(ranking_path)}"
+        matrix = build_protein_matrix(df, prot_ranking, fingerprint)
+        output = compute_results(matrix, parameters)
+
+        cohort_dir = os.path.join(output_dir, name)
+        os.makedirs(cohort_dir, exist_ok=True)
+        results = with_neighbours(
+            output["df_display"],
+            result_neighbours(output["result"]),
+            neighbours_as_list=fmt == "parquet",
+        ).drop(columns=["Patient Status", "Sample Status"])
+        write_table(results, os.path.join(cohort_dir, "results"), fmt)
+        write_table(
+            pd.DataFrame([output["metrics"]]), os.path.join(cohort_dir, "metrics"), fmt
+        )
+        summary.update(output["metrics"])
+        summary.update(output["used_params"])
+        summary["n_samples"] = matrix.n_samples
+        summary["seconds"] = output["performance"]["total_seconds"]
+        with open(os.path.join(cohort_dir, "performance.json"), "w") as f:
+            f.write(performance_json(output["performance"]))
+        summary["warnings"] = " ".join(output["messages"]) or None
+
+        if clustering is not None:
+            clusters = compute_clustering(
+                output["result"],
+                df,
+                clustering["method"],
+                clustering["n_neighbors"],
+                clustering["max_cluster_size"],
+                df_name=name,
+                distance_id=output["distance_key"],
+                values=matrix.top_n(output["used_params"]["n"]),
+                embedding_options={
+                    "quality": clustering["quality"],
+                    "seed": clustering["seed"],
+                    "metric": output["used_params"]["metric"],
+                    "fractional_p": output["used_params"]["fractional_p"],
+                },
+            )
+            write_table(
+                pd.DataFrame(
+                    list(clusters["cluster_assignment"].items()),
+                    columns=["Sample", "Cluster"],
+                ),
+                os.path.join(cohort_dir, "cluster_assignment"),
+                fmt,
+            )
+            for key in ("uncertain_nodes", "error_candidates"):
+                write_table(
+                    pd.DataFrame(list(clusters[key]), columns=["Sample"]),
+                    os.path.join(cohort_dir, key),
+                    fmt,
+                )
+            write_table(
+                layout_table(clusters["layout"]),
+                os.path.join(cohort_dir, "cluster_layout"),
+                fmt,
+            )
+            cluster_figure(
+                clusters["layout"],
+                clustering["method"],
+                VIEW_MAX_POINTS,
+                VIEW_MAX_EDGES,
+            ).write_html(
+                os.path.join(cohort_dir, "clustering.html"), include_plotlyjs="cdn"
+            )
+            summary["n_error_candidates"] = len(clusters["error_candidates"])
+            summary["clustering_seconds"] = clusters["performance"]["total_seconds"]
+            performance_path = os.path.join(cohort_dir, "clustering_performance.json")
+            with open(performance_path, "w") as f:
+                f.write(performance_json(clusters["performance"]))
+    except Exception as e:
+        # one broken plate must not stop the rest of the batch
+        summary.update(status="failed", error=str(e))
+    return summary
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the SPQRP sample QC headless over many cohorts."
+    )
+    parser.add_argument(
+        "cohorts", help="Directory of protein tables or a manifest CSV of cohorts."
+    )
+    parser.add_argument("-o", "--output", required=True, help="Output directory.")
+    parser.add_argument(
+        "--ranking",
+        default=DEFAULT_RANKING_PATH,
+        help="Protein ranking CSV for cohorts without their own ranking.",
+    )
+    parser.add_argument("--format", choices=["parquet", "csv"], default="parquet")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Cohorts processed in parallel (default: one per core).",
+    )
+    parser.add_argument("--mode", choices=list(MODES), default="optimize")
+    parser.add_argument(
+        "--metric",
+        choices=["correlation", "fractional", "euclidean"],
+        default="correlation",
+    )
+    parser.add_argument("--n", type=int, default=20)
+    parser.add_argument(
+        "--n-max", type=int, default=None, help="Sweep n up to n_max when optimizing."
+    )
+    parser.add_argument("--percentile", type=float, default=0.5)
+    parser.add_argument("--fractional-p", type=float, default=0.01)
+    parser.add_argument(
+        "--min-overlap",
+        type=int,
+        default=None,
+        help="Compare every sample pair over the proteins measured in both, requiring "
+        "at least this many, instead of imputing missing values with protein means.",
+    )
+    parser.add_argument(
+        "--optimization-metric",
+        choices=["F1", "fp+fn", "fp", "fn", "precision", "sensitivity"],
+        default="F1",
+    )
+    parser.add_argument(
+        "--evaluation", choices=list(EVALUATION_METHODS), default="threshold"
+    )
+    parser.add_argument("--k", type=int, default=1)
+    parser.add_argument("--neighbours", type=int, default=10)
+    parser.add_argument(
+        "--cluster-method",
+        choices=["UMAP", "PCA", "MDS", *SCALABLE_METHODS],
+        default=None,
+        help="Also cluster every cohort and represent it with this method.",
+    )
+    parser.add_argument("--cluster-neighbours", type=int, default=1)
+    parser.add_argument("--max-cluster-size", type=int, default=1)
+    parser.add_argument(
+        "--embedding-quality", choices=list(EMBEDDING_QUALITY), default="balanced"
+    )
+    parser.add_argument("--embedding-seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    parameters = {
+        "param_evaluation_method": EVALUATION_METHODS[args.evaluation],
+        "param_k": args.k,
+        "param_n": args.n,
+        "param_n_max": args.n_max,
+        "param_metric": args.metric,
+        "param_fractional_p": args.fractional_p,
+        "param_min_overlap": args.min_overlap,
+        "param_mode": MODES[args.mode],
+        "param_optimization_metric": args.optimization_metric,
+        "param_percentile": args.percentile,
+        "number_display_neighbours": args.neighbours,
+    }
+    clustering = None
+    if args.cluster_method is not None:
+        clustering = {
+            "method": args.cluster_method,
+            "n_neighbors": args.cluster_neighbours,
+            "max_cluster_size": args.max_cluster_size,
+            "quality": args.embedding_quality,
+            "seed": args.embedding_seed,
+        }
+
+    cohorts = find_cohorts(args.cohorts)
+    if not cohorts:
+        print(f"No cohorts found in {args.cohorts}.", file=sys.stderr)
+        return 1
+    os.makedirs(args.output, exist_ok=True)
+    workers = min(args.workers or os.cpu_count(), len(cohorts))
+    # the cores are shared out between cohorts, workers inherit the environment
+    os.environ.setdefault(
+        "SPQRP_N_WORKERS", str(max(1, (os.cpu_count() or 1) // workers))
+    )
+
+    tasks = [
+        (name, path, ranking or args.ranking, parameters, clustering, args.output)
+        for name, path, ranking in cohorts
+    ]
+    summaries = []
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=own_process,
+    ) as executor:
+        futures = [executor.submit(run_cohort, *task, args.format) for task in tasks]
+        for done, future in enumerate(as_completed(futures), start=1):
+            summary = future.result()
+            summaries.append(summary)
+            message = summary["error"] or "ok"
+            print(f"[{done}/{len(tasks)}] {summary['cohort']}: {message}")
+
+    summary = pd.DataFrame(summaries).sort_values("cohort")
+    write_table(summary, os.path.join(args.output, "summary"), args.format)
+    failed = int((summary["status"] == "failed").sum())
+    print(f"{len(summary) - failed} cohorts processed, {failed} failed.")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
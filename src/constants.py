@@ -1 +1,87 @@
+import os
+
 DEFAULT_RANKING_FILE = "ranked_classification_importance_cohort_a.csv"
+
+REQUIRED_COLUMNS_DF = ["Sample_ID", "Patient_ID", "Protein", "Intensity"]
+REQUIRED_COLUMNS_RANKING = ["Protein", "Importance"]
+
+PROTEIN_DF_DTYPES = {
+    "Sample_ID": "category",
+    "Patient_ID": "category",
+    "Protein": "category",
+    "Intensity": "float32",
+}
+
+# memory budget for parsed upload frames shared by all sessions
+INGEST_CACHE_MAX_BYTES = int(
+    os.environ.get("SPQRP_INGEST_CACHE_MAX_BYTES", 4 * 1024**3)
+)
+
+# memory budget for condensed pairwise distance arrays shared by all sessions
+DISTANCE_CACHE_MAX_BYTES = int(
+    os.environ.get("SPQRP_DISTANCE_CACHE_MAX_BYTES", 2 * 1024**3)
+)
+
+# memory budget for finished processing and clustering results
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("SPQRP_RESULT_CACHE_MAX_BYTES", 1024**3))
+
+# shared caches are persisted below CACHE_DIR, each within DISK_CACHE_MAX_BYTES;
+# only the current user may write there, since cached entries are unpickled
+CACHE_DIR = os.environ.get(
+    "SPQRP_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".spqrp", "cache")
+)
+DISK_CACHE_MAX_BYTES = int(os.environ.get("SPQRP_DISK_CACHE_MAX_BYTES", 20 * 1024**3))
+# seconds after which cached entries are recomputed
+CACHE_TTL_SECONDS = float(os.environ.get("SPQRP_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+
+# finished analyses and their parameter history; the oldest runs are deleted once
+# the store exceeds RESULT_STORE_MAX_BYTES or they are older than the max age
+RESULT_STORE_DIR = os.environ.get(
+    "SPQRP_RESULT_STORE_DIR", os.path.join(os.path.expanduser("~"), ".spqrp")
+)
+RESULT_STORE_MAX_BYTES = int(
+    os.environ.get("SPQRP_RESULT_STORE_MAX_BYTES", 50 * 1024**3)
+)
+RESULT_STORE_MAX_AGE_SECONDS = float(
+    os.environ.get("SPQRP_RESULT_STORE_MAX_AGE_SECONDS", 90 * 24 * 3600)
+)
+
+# workers for the distance stage and the optimization sweep, None uses all cores
+N_WORKERS = (
+    int(os.environ["SPQRP_N_WORKERS"]) if "SPQRP_N_WORKERS" in os.environ else None
+)
+# "threads" or "processes"
+PARALLEL_BACKEND = os.environ.get("SPQRP_PARALLEL_BACKEND", "threads")
+
+# from this cohort size on nearest neighbours come from a random projection forest
+APPROXIMATE_NEIGHBOURS_MIN_SAMPLES = int(
+    os.environ.get("SPQRP_APPROXIMATE_NEIGHBOURS_MIN_SAMPLES", 20000)
+)
+
+# memory budget of the fractional_p candidates an optimization sweeps at once
+OPTIMIZATION_MAX_BYTES = int(
+    os.environ.get("SPQRP_OPTIMIZATION_MAX_BYTES", 4 * 1024**3)
+)
+
+# from this cohort size on distances are computed in tiles into memory-mapped files
+OUT_OF_CORE_MIN_SAMPLES = int(os.environ.get("SPQRP_OUT_OF_CORE_MIN_SAMPLES", 20000))
+SCRATCH_DIR = os.environ.get(
+    "SPQRP_SCRATCH_DIR", os.path.join(os.path.expanduser("~"), ".spqrp", "scratch")
+)
+# disk budget of the distance files kept for later runs, least recently used go first
+SCRATCH_MAX_BYTES = int(os.environ.get("SPQRP_SCRATCH_MAX_BYTES", 50 * 1024**3))
+
+# rank error of the quantile sketch over pair distances of out-of-core cohorts
+SKETCH_EPSILON = float(os.environ.get("SPQRP_SKETCH_EPSILON", 0.001))
+
+# background processes running analyses, shared by all sessions of the server
+JOB_WORKERS = int(os.environ.get("SPQRP_JOB_WORKERS", 2))
+# seconds between progress updates of a running job in the UI
+JOB_POLL_SECONDS = float(os.environ.get("SPQRP_JOB_POLL_SECONDS", 1.0))
+# seconds after which the result of a finished job no session collected is dropped
+JOB_RESULT_TTL_SECONDS = float(os.environ.get("SPQRP_JOB_RESULT_TTL_SECONDS", 3600))
+
+# level of detail of the interactive cluster view, uncertain and error samples are
+# always drawn on top of these
+VIEW_MAX_POINTS = int(os.environ.get("SPQRP_VIEW_MAX_POINTS", 20000))
+VIEW_MAX_EDGES = int(os.environ.get("SPQRP_VIEW_MAX_EDGES", 50000))
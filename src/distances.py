@@ -0,0 +1,448 @@
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import cdist, pdist, squareform
+
+from masked import masked_tile, overlap_tile
+from neighbours import block_rows, condensed_rows, metric_arguments, neighbours_table
+from parallel import balanced_row_blocks, parallel_map, worker_count
+
+# pairs read from a condensed memmap per streaming step (128 MB of float64)
+CHUNK_PAIRS = 2**24
+# pairs per tile of the masked kernels, which hold several float64 tiles at once
+MASKED_BLOCK_PAIRS = 2**20
+
+# the pair lists of spqrp's evaluation result, built from condensed pair indices
+PAIR_KEYS = {
+    "TP": "True_Positive_Pairs",
+    "FP": "False_Positive_Pairs",
+    "FN": "False_Negative_Pairs",
+}
+
+
+def fill_missing(values, means=None):
+    """
+    Replace missing intensities by the protein mean, or by the given `means`,
+    copying only if needed.
+    """
+    missing = np.isnan(values)
+    if not missing.any():
+        return values
+    if means is None:
+        means = np.nanmean(values, axis=0)
+    return np.where(missing, means, values)
+
+
+def upper_pairs(tile):
+    # the pairs (i, j > i) of a tile of the rows r0 to r1 against the rows from r0
+    return np.concatenate([tile[i, i + 1 :] for i in range(len(tile))])
+
+
+def distance_tile(a, b, metric, fractional_p=None, min_overlap=None):
+    """
+    Distances between the rows of `a` and `b`, over the proteins measured in
+    both samples with `min_overlap`, see masked_tile.
+    """
+    if min_overlap is None:
+        return cdist(a, b, **metric_arguments(metric, fractional_p))
+    tile, _ = masked_tile(a, b, metric, fractional_p, min_overlap)
+    return tile
+
+
+def condensed_block(values, r0, r1, metric, fractional_p=None, min_overlap=None):
+    """Condensed distances of the pairs (i, j > i) of the rows r0 to r1."""
+    return upper_pairs(
+        distance_tile(values[r0:r1], values[r0:], metric, fractional_p, min_overlap)
+    )
+
+
+def masked_blocks(n_samples, n_jobs):
+    n_pairs = n_samples * (n_samples - 1) // 2
+    n_blocks = max(4 * n_jobs, n_pairs // MASKED_BLOCK_PAIRS)
+    return balanced_row_blocks(n_samples, n_blocks)
+
+
+def condensed_from_blocks(compute, n_samples, blocks, n_jobs, backend, dtype=None):
+    starts, stops = condensed_row_bounds(n_samples)
+    condensed = np.empty(stops[-1], dtype=dtype or np.float64)
+    parts = parallel_map(compute, blocks, n_jobs, backend)
+    for (r0, r1), part in zip(blocks, parts):
+        condensed[starts[r0] : stops[r1 - 1]] = part
+    return condensed
+
+
+def fill_undefined(condensed, largest=None):
+    """
+    Give the pairs without a distance (too few shared proteins) the largest
+    distance of all pairs, in place, so that they rank behind all other pairs.
+    """
+    undefined = np.isnan(condensed)
+    if undefined.any():
+        if largest is None:
+            largest = np.fmax.reduce(condensed, initial=0.0)
+        condensed[undefined] = largest
+    return condensed
+
+
+def condensed_distances(
+    values,
+    metric,
+    fractional_p=None,
+    n_jobs=None,
+    backend=None,
+    min_overlap=None,
+    means=None,
+):
+    """
+    Condensed distances of the rows of `values`. Missing intensities are imputed
+    with the protein means, or the given `means` (see ProteinMatrix.means), or
+    with `min_overlap` every pair is compared over the proteins measured in both
+    samples only, without an imputed copy.
+    """
+    n_jobs = worker_count(n_jobs)
+    if min_overlap is None:
+        values = fill_missing(values, means)
+        if n_jobs == 1:
+            return pdist(values, **metric_arguments(metric, fractional_p))
+        # blocks of about equal pair counts, a few per worker to even out stragglers
+        blocks = balanced_row_blocks(len(values), 4 * n_jobs)
+    else:
+        blocks = masked_blocks(len(values), n_jobs)
+
+    def compute(block):
+        return condensed_block(values, *block, metric, fractional_p, min_overlap)
+
+    condensed = condensed_from_blocks(compute, len(values), blocks, n_jobs, backend)
+    if min_overlap is not None:
+        fill_undefined(condensed)
+    return condensed
+
+
+def condensed_overlap(values, n_jobs=None, backend=None):
+    """Number of proteins measured in both samples of every pair, condensed."""
+    n_jobs = worker_count(n_jobs)
+    blocks = masked_blocks(len(values), n_jobs)
+
+    def compute(block):
+        r0, r1 = block
+        return upper_pairs(overlap_tile(values[r0:r1], values[r0:]))
+
+    dtype = np.uint16 if values.shape[1] < 2**16 else np.uint32
+    return condensed_from_blocks(
+        compute, len(values), blocks, n_jobs, backend, dtype=dtype
+    )
+
+
+def overlap_per_sample(overlap, n_samples, min_overlap):
+    """
+    The fewest proteins every sample shares with another sample, and with how
+    many samples it shares fewer than `min_overlap`.
+    """
+    fewest = np.empty(n_samples, dtype=np.int32)
+    below = np.empty(n_samples, dtype=np.int32)
+    step = block_rows(n_samples)
+    for start in range(0, n_samples, step):
+        stop = min(start + step, n_samples)
+        rows = condensed_rows(overlap, n_samples, np.arange(start, stop))
+        fewest[start:stop] = rows.min(axis=1)
+        below[start:stop] = (rows < min_overlap).sum(axis=1)
+    return {"fewest": fewest, "below": below}
+
+
+def condensed_row_bounds(n_samples):
+    """Offsets of the pairs (i, j > i) of every row i in a condensed array."""
+    lengths = np.arange(n_samples - 1, -1, -1, dtype=np.int64)
+    stops = np.cumsum(lengths)
+    return stops - lengths, stops
+
+
+def same_patient_mask(patient_codes):
+    starts, stops = condensed_row_bounds(len(patient_codes))
+    mask = np.empty(stops[-1] if len(stops) else 0, dtype=bool)
+    for i in range(len(patient_codes) - 1):
+        mask[starts[i] : stops[i]] = patient_codes[i + 1 :] == patient_codes[i]
+    return mask
+
+
+def iter_row_chunks(n_samples, step):
+    """Row ranges with the condensed slice holding all of their pairs (i, j > i)."""
+    starts, stops = condensed_row_bounds(n_samples)
+    for r0 in range(0, n_samples - 1, step):
+        r1 = min(r0 + step, n_samples - 1)
+        yield r0, r1, starts[r0], stops[r1 - 1]
+
+
+def same_patient_rows(patient_codes, r0, r1):
+    return np.concatenate(
+        [patient_codes[i + 1 :] == patient_codes[i] for i in range(r0, r1)]
+    )
+
+
+def condensed_to_pairs(indices, n_samples):
+    """Row and column of the condensed pair `indices`."""
+    indices = np.asarray(indices, dtype=np.int64)
+    starts, _ = condensed_row_bounds(n_samples)
+    rows = np.searchsorted(starts, indices, side="right") - 1
+    cols = indices - starts[rows] + rows + 1
+    return rows, cols
+
+
+def pairs_to_condensed(rows, cols, n_samples):
+    """Condensed indices of the pairs (rows, cols), see condensed_to_pairs."""
+    rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+    rows, cols = np.minimum(rows, cols), np.maximum(rows, cols)
+    starts, _ = condensed_row_bounds(n_samples)
+    return starts[rows] + cols - rows - 1
+
+
+def compact_indices(indices, n_pairs):
+    # condensed indices of in-memory cohorts fit into 32 bits
+    return indices.astype(np.uint32 if n_pairs < 2**32 else np.int64, copy=False)
+
+
+def compact_neighbours(nearest_neighbours):
+    indices, distances = nearest_neighbours
+    # fractional distances with a small p can exceed float32 and stay float64
+    largest = np.fmax.reduce(np.abs(distances), axis=None, initial=0.0)
+    if largest <= np.finfo(np.float32).max:
+        distances = distances.astype(np.float32, copy=False)
+    return indices.astype(np.int32, copy=False), distances
+
+
+def pair_counts_per_sample(pair_indices, n_samples):
+    rows, cols = condensed_to_pairs(pair_indices, n_samples)
+    return np.bincount(rows, minlength=n_samples) + np.bincount(
+        cols, minlength=n_samples
+    )
+
+
+def pair_list(indices, sample_ids):
+    rows, cols = condensed_to_pairs(indices, len(sample_ids))
+    return list(zip(sample_ids[rows], sample_ids[cols]))
+
+
+def confusion_metrics(tp, fp, fn, tn):
+    total = tp + fp + fn + tn
+    precision = tp / (tp + fp) if (tp + fp) > 0 else 0
+    sensitivity = tp / (tp + fn) if (tp + fn) > 0 else 0
+    specificity = tn / (tn + fp) if (tn + fp) > 0 else 0
+    f1 = (
+        2 * ((precision * sensitivity) / (precision + sensitivity))
+        if (precision + sensitivity) > 0
+        else 0
+    )
+    return {
+        "TP": tp,
+        "FP": fp,
+        "FN": fn,
+        "TN": tn,
+        "Accuracy": (tp + tn) / total if total > 0 else 0,
+        "Balanced_Accuracy": (sensitivity + specificity) / 2,
+        "Precision": precision,
+        "Sensitivity": sensitivity,
+        "F1": f1,
+    }
+
+
+def evaluate_distances(condensed, matrix, percentile, nearest_neighbours):
+    """
+    Classify all sample pairs with a distance up to the `percentile` threshold as
+    belonging and compare them to the patient labels. `nearest_neighbours` holds
+    the neighbour indices and distances per sample.
+
+    This replaces spqrp's perform_distance_evaluation_on_ranked_proteins, which
+    tests/test_spqrp_parity.py compares it with. The choices it makes where the
+    long data frame leaves room:
+    - duplicated measurements of a protein in a sample are averaged, see
+      build_protein_matrix;
+    - proteins of the top n of the ranking missing from the data frame are left
+      out, not replaced by lower ranked ones;
+    - missing intensities are the mean of the protein over all samples, see
+      fill_missing;
+    - the threshold is np.percentile with linear interpolation, and pairs at
+      exactly the threshold belong;
+    - neighbours at the same distance are in no defined order.
+    """
+    threshold = np.percentile(condensed, percentile)
+    belonging = condensed <= threshold
+    same_patient = same_patient_mask(matrix.patient_codes)
+
+    tp_pairs = np.flatnonzero(belonging & same_patient)
+    fp_pairs = np.flatnonzero(belonging & ~same_patient)
+    fn_pairs = np.flatnonzero(~belonging & same_patient)
+    # the true negatives are nearly all pairs, they are only counted
+    tn = len(condensed) - len(tp_pairs) - len(fp_pairs) - len(fn_pairs)
+
+    eval_metrics = confusion_metrics(len(tp_pairs), len(fp_pairs), len(fn_pairs), tn)
+    n_samples = matrix.n_samples
+    neighbour_indices, neighbour_distances = compact_neighbours(nearest_neighbours)
+    # pairs are kept as condensed indices, the sample ID tuples and the square
+    # matrix are only built for spqrp, see spqrp_result
+    return {
+        "eval_metrics": eval_metrics,
+        "threshold": threshold,
+        "sample_counts": {
+            "TP": pair_counts_per_sample(tp_pairs, n_samples).astype(np.int32),
+            "FP": pair_counts_per_sample(fp_pairs, n_samples).astype(np.int32),
+            "FN": pair_counts_per_sample(fn_pairs, n_samples).astype(np.int32),
+        },
+        "pair_indices": {
+            "TP": compact_indices(tp_pairs, len(condensed)),
+            "FP": compact_indices(fp_pairs, len(condensed)),
+            "FN": compact_indices(fn_pairs, len(condensed)),
+        },
+        "condensed_distances": condensed,
+        "sample_ids": matrix.sample_ids,
+        "neighbour_indices": neighbour_indices,
+        "neighbour_distances": neighbour_distances,
+        "square": True,
+    }
+
+
+def appended_blocks(
+    values, n_old, metric, fractional_p=None, min_overlap=None, means=None
+):
+    """
+    Distances of the rows from `n_old` on, the appended samples, to the rows
+    before them (m x n_old) and to each other (m x m), the only distances an
+    append computes. Missing values are imputed with `means`, the protein means
+    the earlier distances were computed with.
+    """
+    if min_overlap is None:
+        values = fill_missing(values, means)
+    old, new = values[:n_old], values[n_old:]
+    step = max(1, MASKED_BLOCK_PAIRS // max(len(new), 1))
+    cross = np.concatenate(
+        [
+            distance_tile(
+                new, old[start : start + step], metric, fractional_p, min_overlap
+            )
+            for start in range(0, n_old, step)
+        ],
+        axis=1,
+    )
+    inner = distance_tile(new, new, metric, fractional_p, min_overlap)
+    return cross, inner
+
+
+def appended_pairs(n_old, n_new):
+    """Condensed positions, rows and columns of the pairs added by new samples."""
+    n_samples = n_old + n_new
+    inner_rows, inner_cols = np.triu_indices(n_new, 1)
+    rows = np.concatenate([np.repeat(np.arange(n_old), n_new), inner_rows + n_old])
+    cols = np.concatenate(
+        [np.tile(np.arange(n_old, n_samples), n_old), inner_cols + n_old]
+    )
+    return pairs_to_condensed(rows, cols, n_samples), rows, cols
+
+
+def appended_condensed(condensed, n_old, n_samples, positions, distances):
+    """
+    Condensed distances after appending samples: every earlier row keeps its
+    pairs and gets those with the new samples, at `positions`, at its end. The
+    earlier pairs stay in order, so they fill all other positions.
+    """
+    earlier = np.ones(n_samples * (n_samples - 1) // 2, dtype=bool)
+    earlier[positions] = False
+    appended = np.empty(len(earlier), dtype=np.float64)
+    appended[earlier] = condensed
+    appended[positions] = distances
+    return appended
+
+
+def evaluate_appended(
+    result, condensed, matrix, n_old, positions, rows, cols, nearest_neighbours
+):
+    """
+    evaluate_distances after appending samples, from the result of the earlier
+    ones: only the added pairs are classified, with the distance threshold of
+    `result`, whose percentile among all pairs is returned as "percentile".
+    """
+    n_samples = matrix.n_samples
+    belonging = condensed[positions] <= result["threshold"]
+    same_patient = matrix.patient_codes[rows] == matrix.patient_codes[cols]
+    sample_counts, pair_indices = {}, {}
+    for name, added in (
+        ("TP", belonging & same_patient),
+        ("FP", belonging & ~same_patient),
+        ("FN", ~belonging & same_patient),
+    ):
+        # earlier pairs keep their class, at their position among all samples
+        earlier = pairs_to_condensed(
+            *condensed_to_pairs(result["pair_indices"][name], n_old), n_samples
+        )
+        pair_indices[name] = compact_indices(
+            np.sort(np.concatenate([earlier, positions[added]])), len(condensed)
+        )
+        counts = np.zeros(n_samples, dtype=np.int32)
+        counts[:n_old] = result["sample_counts"][name]
+        counts += (
+            np.bincount(rows[added], minlength=n_samples)
+            + np.bincount(cols[added], minlength=n_samples)
+        ).astype(np.int32)
+        sample_counts[name] = counts
+    tp, fp, fn = (len(pair_indices[name]) for name in ("TP", "FP", "FN"))
+    neighbour_indices, neighbour_distances = compact_neighbours(nearest_neighbours)
+    return {
+        "eval_metrics": confusion_metrics(tp, fp, fn, len(condensed) - tp - fp - fn),
+        "threshold": result["threshold"],
+        "percentile": 100 * (tp + fp) / len(condensed),
+        "sample_counts": sample_counts,
+        "pair_indices": pair_indices,
+        "condensed_distances": condensed,
+        "sample_ids": matrix.sample_ids,
+        "neighbour_indices": neighbour_indices,
+        "neighbour_distances": neighbour_distances,
+        "square": True,
+    }
+
+
+def appended_overlap(overlap, values, n_old, min_overlap):
+    """overlap_per_sample after appending the rows from `n_old` on."""
+    new = values[n_old:]
+    cross = overlap_tile(new, values[:n_old])
+    inner = overlap_tile(new, new)
+    np.fill_diagonal(inner, np.inf)
+    fewest = np.concatenate(
+        [
+            np.minimum(overlap["fewest"], cross.min(axis=0)),
+            np.minimum(cross.min(axis=1), inner.min(axis=1)),
+        ]
+    )
+    below = np.concatenate(
+        [
+            overlap["below"] + (cross < min_overlap).sum(axis=0),
+            (cross < min_overlap).sum(axis=1) + (inner < min_overlap).sum(axis=1),
+        ]
+    )
+    return {"fewest": fewest.astype(np.int32), "below": below.astype(np.int32)}
+
+
+def result_neighbours(result):
+    """Table of the nearest neighbour IDs and distances of every sample."""
+    return neighbours_table(
+        result["neighbour_indices"],
+        result["neighbour_distances"],
+        result["sample_ids"],
+    )
+
+
+def spqrp_result(result):
+    """
+    The evaluation result as spqrp's clustering expects it, with the pair lists,
+    the neighbour table and the square distance matrix. These are several times
+    the size of the condensed arrays and only built for a clustering run.
+    """
+    sample_ids = result["sample_ids"]
+    eval_metrics = dict(result["eval_metrics"])
+    for name, key in PAIR_KEYS.items():
+        eval_metrics[key] = pair_list(result["pair_indices"][name], sample_ids)
+    return {
+        **result,
+        "eval_metrics": eval_metrics,
+        "nearest_neighbours": result_neighbours(result),
+        "distance_matrix": pd.DataFrame(
+            squareform(np.asarray(result["condensed_distances"])),
+            index=sample_ids,
+            columns=sample_ids,
+        ),
+    }
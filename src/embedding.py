@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+from sklearn.decomposition import PCA
+
+from distances import fill_missing
+from neighbours import condensed_rows, metric_arguments
+
+SCALABLE_METHODS = ("Landmark MDS", "Randomized PCA", "Subsampled UMAP")
+# spqrp draws the scalable embeddings like the method they approximate
+PLOT_METHODS = {
+    "Landmark MDS": "MDS",
+    "Randomized PCA": "PCA",
+    "Subsampled UMAP": "UMAP",
+}
+
+# landmarks of the MDS, power iterations of the PCA and samples the UMAP is fitted on
+EMBEDDING_QUALITY = {
+    "fast": {"landmarks": 100, "power_iterations": 2, "umap_samples": 2000},
+    "balanced": {"landmarks": 300, "power_iterations": 4, "umap_samples": 5000},
+    "accurate": {"landmarks": 1000, "power_iterations": 7, "umap_samples": 20000},
+}
+
+
+def landmark_mds(condensed, n_samples, n_landmarks, seed=0):
+    """
+    Landmark MDS: classical MDS of a random subset of landmarks, every sample is
+    then placed by distance-based triangulation. O(N * landmarks) instead of the
+    O(N^2) memory and eigendecomposition of classical MDS.
+    """
+    rng = np.random.default_rng(seed)
+    n_landmarks = min(max(n_landmarks, 3), n_samples)
+    landmarks = np.sort(rng.choice(n_samples, n_landmarks, replace=False))
+    # squared distances of every sample to the landmarks, samples x landmarks
+    squared = condensed_rows(condensed, n_samples, landmarks, diagonal_value=0.0).T
+    squared **= 2
+
+    landmark_squared = squared[landmarks]
+    column_means = landmark_squared.mean(axis=0)
+    centred = (
+        landmark_squared
+        - column_means[None, :]
+        - landmark_squared.mean(axis=1)[:, None]
+        + landmark_squared.mean()
+    )
+    eigenvalues, eigenvectors = np.linalg.eigh(-0.5 * centred)
+    top = np.argsort(eigenvalues)[::-1][:2]
+    scale = np.sqrt(np.maximum(eigenvalues[top], np.finfo(np.float64).eps))
+    return -0.5 * (squared - column_means) @ (eigenvectors[:, top] / scale)
+
+
+def randomized_pca(values, power_iterations, seed=0):
+    """First two principal components of the protein matrix by randomized SVD."""
+    return PCA(
+        n_components=2,
+        svd_solver="randomized",
+        iterated_power=power_iterations,
+        random_state=seed,
+    ).fit_transform(fill_missing(values))
+
+
+def subsampled_umap(values, metric, fractional_p, n_fit, seed=0):
+    """
+    UMAP fitted on a random subsample of the samples, the remaining samples are
+    placed with the out-of-sample transform of the fitted model.
+    """
+    # umap-learn is installed with spqrp
+    import umap
+
+    values = fill_missing(values)
+    n_samples = len(values)
+    rng = np.random.default_rng(seed)
+    fit = np.sort(rng.choice(n_samples, min(n_fit, n_samples), replace=False))
+    arguments = metric_arguments(metric, fractional_p)
+    reducer = umap.UMAP(
+        n_components=2,
+        metric=arguments.pop("metric"),
+        metric_kwds=arguments or None,
+        random_state=seed,
+    )
+    coords = np.empty((n_samples, 2))
+    coords[fit] = reducer.fit_transform(values[fit])
+    rest = np.setdiff1d(np.arange(n_samples), fit)
+    if len(rest):
+        coords[rest] = reducer.transform(values[rest])
+    return coords
+
+
+def scalable_embedding(method, condensed, values, n_samples, options):
+    """2D coordinates, rows in sample order, for one of SCALABLE_METHODS."""
+    quality = EMBEDDING_QUALITY[options.get("quality", "balanced")]
+    seed = options.get("seed", 0)
+    if method == "Landmark MDS":
+        return landmark_mds(condensed, n_samples, quality["landmarks"], seed)
+    if method == "Randomized PCA":
+        return randomized_pca(values, quality["power_iterations"], seed)
+    if method == "Subsampled UMAP":
+        return subsampled_umap(
+            values,
+            options["metric"],
+            options.get("fractional_p"),
+            quality["umap_samples"],
+            seed,
+        )
+    raise ValueError(f"Unknown embedding method: {method}")
+
+
+def match_layout(template, coords, sample_ids):
+    """
+    `coords` in the container spqrp returned its own coordinates in (`template`),
+    so that both can be handed to its plotting the same way. Frames are aligned
+    by sample ID.
+    """
+    if isinstance(template, dict):
+        return {sample: np.asarray(xy) for sample, xy in zip(sample_ids, coords)}
+    if isinstance(template, pd.DataFrame):
+        frame = pd.DataFrame(
+            coords, index=pd.Index(sample_ids), columns=template.columns[:2]
+        )
+        if not template.index.isin(frame.index).all():
+            raise ValueError(
+                "The samples of spqrp's coordinates do not match those of the distances."
+            )
+        return frame.reindex(template.index)
+    return np.asarray(coords, dtype=np.asarray(template).dtype)
+
+
+def layout_coordinates(coords_2d, sample_ids):
+    """
+    (samples x 2) array, rows in the order of `sample_ids`, of coordinates in
+    any of spqrp's containers. Samples without coordinates are NaN.
+    """
+    if isinstance(coords_2d, dict):
+        missing = (np.nan, np.nan)
+        return np.array(
+            [np.asarray(coords_2d.get(s, missing))[:2] for s in sample_ids], dtype=float
+        ).reshape(-1, 2)
+    if isinstance(coords_2d, pd.DataFrame):
+        if coords_2d.index.isin(sample_ids).any():
+            coords_2d = coords_2d.reindex(sample_ids)
+        return coords_2d.iloc[:, :2].to_numpy(dtype=float)
+    return np.asarray(coords_2d, dtype=float)[:, :2]
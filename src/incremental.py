@@ -0,0 +1,63 @@
+import numpy as np
+from scipy.spatial.distance import pdist
+
+from distances import fill_missing
+
+INCREMENTAL_METRICS = ("euclidean", "fractional")
+
+
+class IncrementalDistances:
+    """
+    Per-pair partial sums sum(|x - y| ** q) over the top proteins of the ranking.
+    Moving to another n adds or subtracts the contribution of the changed protein
+    columns only, so a step in n costs O(delta n * pairs).
+    """
+
+    def __init__(self, matrix, metric, fractional_p=None):
+        if metric not in INCREMENTAL_METRICS:
+            raise ValueError(f"Metric {metric} is not additive over proteins.")
+        self.matrix = matrix
+        self.metric = metric
+        self.power = 2.0 if metric == "euclidean" else fractional_p
+        self.n_columns = 0
+        n_samples = matrix.n_samples
+        self._sums = np.zeros(n_samples * (n_samples - 1) // 2)
+
+    def matches(self, matrix, metric, fractional_p):
+        power = 2.0 if metric == "euclidean" else fractional_p
+        return (
+            self.matrix.fingerprint == matrix.fingerprint
+            and self.metric == metric
+            and self.power == power
+        )
+
+    def _contribution(self, start, stop):
+        # mean imputation is per protein, so a column slice imputes like the full matrix
+        means = self.matrix.imputation_means
+        columns = fill_missing(
+            self.matrix.values[:, start:stop],
+            None if means is None else means[start:stop],
+        )
+        if self.metric == "euclidean":
+            return pdist(columns, "sqeuclidean")
+        contribution = np.zeros_like(self._sums)
+        for j in range(columns.shape[1]):
+            contribution += pdist(columns[:, j : j + 1], "cityblock") ** self.power
+        return contribution
+
+    def distances(self, n):
+        target = self.matrix.n_columns(n)
+        if target == 0:
+            raise ValueError(
+                f"None of the top {n} proteins of the ranking are in the data frame."
+            )
+        if abs(target - self.n_columns) > target:
+            # rebuilding is cheaper than walking back over most of the columns
+            self._sums = self._contribution(0, target)
+        elif target > self.n_columns:
+            self._sums += self._contribution(self.n_columns, target)
+        elif target < self.n_columns:
+            self._sums -= self._contribution(target, self.n_columns)
+            np.maximum(self._sums, 0, out=self._sums)
+        self.n_columns = target
+        return self._sums ** (1 / self.power)
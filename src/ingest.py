@@ -0,0 +1,170 @@
+import hashlib
+import os
+from io import BytesIO
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from cache import fingerprint_bytes
+from constants import PROTEIN_DF_DTYPES, REQUIRED_COLUMNS_DF
+
+TABLE_FORMATS = {
+    ".csv": "csv",
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".feather": "ipc",
+    ".arrow": "ipc",
+    ".ipc": "ipc",
+}
+
+
+def detect_format(file_name):
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension not in TABLE_FORMATS:
+        supported = ", ".join(TABLE_FORMATS)
+        raise ValueError(
+            f"Unsupported file type '{extension}'. Supported types: {supported}"
+        )
+    return TABLE_FORMATS[extension]
+
+
+def fingerprint_path(path):
+    # hashing the content of multi-GB local files would cost as much as parsing them
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def frame_from_arrow(table):
+    if "Intensity" in table.column_names:
+        index = table.column_names.index("Intensity")
+        table = table.set_column(
+            index, "Intensity", pc.cast(table["Intensity"], pa.float32())
+        )
+    df = table.to_pandas(strings_to_categorical=True)
+    dtypes = {c: t for c, t in PROTEIN_DF_DTYPES.items() if c in df.columns}
+    return df.astype(dtypes)
+
+
+def protein_filter(proteins):
+    return pc.field("Protein").isin(pa.array(list(proteins)))
+
+
+def select_proteins(df, proteins):
+    """The rows of `df` measuring one of `proteins`."""
+    if "Protein" not in df.columns:
+        return df
+    df = df[df["Protein"].isin(proteins)].reset_index(drop=True)
+    df["Protein"] = df["Protein"].cat.remove_unused_categories()
+    return df
+
+
+def read_protein_table(source, fmt, proteins=None):
+    """
+    Read the required columns of a protein table from uploaded bytes or a local path.
+    If `proteins` is given only their rows are materialised.
+    """
+    if fmt == "csv" and not isinstance(source, str):
+        df = pd.read_csv(
+            BytesIO(source),
+            usecols=lambda column: column in REQUIRED_COLUMNS_DF,
+            dtype=PROTEIN_DF_DTYPES,
+        )
+        if proteins is not None:
+            df = select_proteins(df, proteins)
+        return df
+
+    if isinstance(source, str):
+        dataset = ds.dataset(source, format=fmt)
+        columns = [c for c in REQUIRED_COLUMNS_DF if c in dataset.schema.names]
+        expression = None
+        if proteins is not None and "Protein" in columns:
+            expression = protein_filter(proteins)
+        table = dataset.to_table(columns=columns, filter=expression)
+    elif fmt == "parquet":
+        schema = pq.read_schema(pa.BufferReader(source))
+        columns = [c for c in REQUIRED_COLUMNS_DF if c in schema.names]
+        expression = None
+        if proteins is not None and "Protein" in columns:
+            expression = protein_filter(proteins)
+        table = pq.read_table(
+            pa.BufferReader(source), columns=columns, filters=expression
+        )
+    else:
+        schema = pa.ipc.open_file(pa.BufferReader(source)).schema
+        columns = [c for c in REQUIRED_COLUMNS_DF if c in schema.names]
+        table = feather.read_table(
+            pa.BufferReader(source), columns=columns, memory_map=False
+        )
+        if proteins is not None and "Protein" in columns:
+            mask = pc.is_in(table["Protein"], value_set=pa.array(list(proteins)))
+            table = table.filter(mask)
+    return frame_from_arrow(table)
+
+
+def read_ranking_csv(data):
+    return pd.read_csv(BytesIO(data))
+
+
+def cache_key(source, reader, **options):
+    """The key of `source` parsed by `reader` with `options`, and its fingerprint."""
+    if isinstance(source, str):
+        fingerprint = fingerprint_path(source)
+    else:
+        fingerprint = fingerprint_bytes(source)
+    option_key = tuple(sorted(options.items()))
+    if option_key:
+        fingerprint = fingerprint_bytes(f"{fingerprint}:{option_key}".encode())
+    return (reader.__name__, fingerprint), fingerprint
+
+
+def load_cached(cache, source, reader, **options):
+    """
+    Parse `source` (file bytes or a local path) with `reader` once per distinct
+    content and reader options. Returns the frame and its fingerprint.
+    """
+    key, fingerprint = cache_key(source, reader, **options)
+    df = cache.get(key)
+    if df is None:
+        df = cache.put(key, reader(source, **options))
+    return df, fingerprint
+
+
+def load_protein_table(cache, source, fmt, proteins=None):
+    """
+    load_cached of read_protein_table. When all proteins of `source` were parsed
+    before, which happens when the ranking is loaded after the data frame, the
+    rows of `proteins` are selected from that frame instead of parsing again.
+    """
+    if proteins is not None:
+        full_key, _ = cache_key(source, read_protein_table, fmt=fmt)
+        full = cache.get(full_key)
+        if full is not None:
+            key, fingerprint = cache_key(
+                source, read_protein_table, fmt=fmt, proteins=proteins
+            )
+            df = cache.get(key)
+            if df is None:
+                df = cache.put(key, select_proteins(full, proteins))
+            return df, fingerprint
+    return load_cached(cache, source, read_protein_table, fmt=fmt, proteins=proteins)
+
+
+def append_frames(df, new_df):
+    """The rows of `new_df` after those of `df`, keeping the categorical columns."""
+    columns = {}
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype) and isinstance(
+            new_df[column].dtype, pd.CategoricalDtype
+        ):
+            columns[column] = union_categoricals(
+                [df[column], new_df[column]], ignore_order=True
+            )
+        else:
+            columns[column] = pd.concat([df[column], new_df[column]], ignore_index=True)
+    return pd.DataFrame(columns)
@@ -0,0 +1,205 @@
+import cProfile
+import importlib.util
+import io
+import json
+import marshal
+import pstats
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, where only profiled runs report memory
+    resource = None
+
+PROFILERS = ("cProfile", "pyinstrument")
+
+# set by own_process where this process runs one job at a time
+_exclusive = False
+
+
+def own_process():
+    """
+    Let stages reset the peak RSS of this process. Only for processes that run
+    one job at a time (job workers, the CLI, benchmarks): in the app server the
+    sessions are threads of one process and would reset each other's peaks.
+    """
+    global _exclusive
+    _exclusive = True
+
+
+def process_peak_rss_bytes():
+    """High-water mark of the resident memory over the lifetime of this process."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def reset_peak_rss():
+    """
+    Restart the high-water mark read by peak_rss_bytes. Only Linux allows this,
+    elsewhere False is returned.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss_bytes():
+    """High-water mark of the resident memory since the last reset_peak_rss."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def available_profilers():
+    return [
+        profiler
+        for profiler in PROFILERS
+        if profiler == "cProfile" or importlib.util.find_spec(profiler) is not None
+    ]
+
+
+class Instrumentation:
+    """
+    Wall time and memory high-water mark of every stage of one run. The peak
+    RSS of a stage is only measured on Linux in processes claimed with
+    own_process, elsewhere the peak of the whole process so far is reported
+    instead. With a `profiler` the run is also
+    profiled and the memory of every stage traced.
+    Instances are picklable between runs, so that stages timed in the app can
+    be continued in a background job.
+    """
+
+    def __init__(self, profiler=None):
+        self.profiler = profiler
+        self.stages = []
+        self.profile = None
+        self.profile_stats = None
+
+    @contextmanager
+    def stage(self, name):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+        # stages of an owned process run one after the other, so the process peak
+        # since the reset is the stage peak
+        reset = _exclusive and reset_peak_rss()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append(
+                {
+                    "stage": name,
+                    "seconds": time.perf_counter() - start,
+                    "peak_rss_bytes": peak_rss_bytes() if reset else None,
+                    # the reset also restarts the lifetime peak of the kernel
+                    "process_peak_rss_bytes": (
+                        None if reset else process_peak_rss_bytes()
+                    ),
+                    "peak_traced_bytes": (
+                        tracemalloc.get_traced_memory()[1] if tracing else None
+                    ),
+                }
+            )
+
+    @contextmanager
+    def profiling(self):
+        """Profile the enclosed stages with `self.profiler`, if one is set."""
+        if self.profiler is None:
+            yield
+            return
+        # both profilers only see the calling thread, not the distance workers
+        if self.profiler == "pyinstrument":
+            from pyinstrument import Profiler
+
+            profiler = Profiler()
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        try:
+            yield
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+            if self.profiler == "pyinstrument":
+                profiler.stop()
+                self.profile = profiler.output_text()
+            else:
+                profiler.disable()
+                text = io.StringIO()
+                stats = pstats.Stats(profiler, stream=text)
+                stats.sort_stats("cumulative").print_stats(40)
+                self.profile = text.getvalue()
+                profiler.create_stats()
+                # the format of pstats.Stats.dump_stats, readable by snakeviz & co.
+                self.profile_stats = marshal.dumps(profiler.stats)
+
+    def report(self):
+        return {
+            "stages": list(self.stages),
+            "total_seconds": sum(stage["seconds"] for stage in self.stages),
+            "profiler": self.profiler,
+            "profile": self.profile,
+            "profile_stats": self.profile_stats,
+        }
+
+
+def performance_table(performance):
+    """One row per stage with its time, share of the run and memory in MiB."""
+    table = pd.DataFrame(
+        performance["stages"],
+        columns=[
+            "stage",
+            "seconds",
+            "peak_rss_bytes",
+            "process_peak_rss_bytes",
+            "peak_traced_bytes",
+        ],
+    )
+    total = performance["total_seconds"] or 1.0
+
+    def mib(column):
+        return table[column].astype(float) / 1024**2
+
+    return pd.DataFrame(
+        {
+            "Stage": table["stage"],
+            "Seconds": table["seconds"],
+            "Share": table["seconds"] / total,
+            "Stage peak RSS (MiB)": mib("peak_rss_bytes"),
+            "Process-wide peak RSS (MiB)": mib("process_peak_rss_bytes"),
+            "Peak traced (MiB)": mib("peak_traced_bytes"),
+        }
+    )
+
+
+def without_profile(performance):
+    # the binary profile is only downloaded as its own .prof file
+    if performance is None:
+        return None
+    return {key: value for key, value in performance.items() if key != "profile_stats"}
+
+
+def performance_json(performance):
+    return json.dumps(without_profile(performance), indent=2)
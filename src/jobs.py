@@ -0,0 +1,141 @@
+import multiprocessing
+import threading
+import time
+import uuid
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+
+from cache import attach_memmaps, detach_memmaps
+from constants import JOB_RESULT_TTL_SECONDS, JOB_WORKERS
+from instrumentation import own_process
+from pipeline import use_persistent_caches
+
+# intermediates (matrix pivots, distance caches) a worker process keeps between jobs
+WORKER_STATE = {}
+
+_lock = threading.Lock()
+_executor = None
+_manager = None
+_jobs = {}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def initialize_worker():
+    # workers share the disk caches of the app and run one job at a time
+    use_persistent_caches()
+    own_process()
+
+
+def get_executor():
+    # one pool per server process, shared by all sessions and tabs
+    global _executor, _manager
+    with _lock:
+        if _executor is None:
+            context = multiprocessing.get_context("spawn")
+            _manager = context.Manager()
+            _executor = ProcessPoolExecutor(
+                max_workers=JOB_WORKERS,
+                mp_context=context,
+                initializer=initialize_worker,
+            )
+        return _executor, _manager
+
+
+def run_job(function, args, kwargs, progress, cancel):
+    def report(label, fraction):
+        # cancellation is cooperative and takes effect at the next stage
+        if cancel.is_set():
+            raise JobCancelled()
+        progress.update(label=label, fraction=fraction)
+
+    progress.update(state="running")
+    args, kwargs = attach_memmaps(args), attach_memmaps(kwargs)
+    return detach_memmaps(
+        function(*args, state=WORKER_STATE, progress=report, **kwargs)
+    )
+
+
+def submit_job(function, *args, **kwargs):
+    """
+    Run `function(*args, state=..., progress=..., **kwargs)` in the background
+    pool and return a job ID. `function` has to be importable by the workers.
+    """
+    executor, manager = get_executor()
+    job_id = uuid.uuid4().hex
+    progress = manager.dict(state="queued", label="Queued", fraction=0.0)
+    cancel = manager.Event()
+    future = executor.submit(
+        run_job,
+        function,
+        detach_memmaps(args),
+        detach_memmaps(kwargs),
+        progress,
+        cancel,
+    )
+    job = {
+        "future": future,
+        "progress": progress,
+        "cancel": cancel,
+        "submitted": time.time(),
+        "finished": None,
+    }
+    future.add_done_callback(lambda _: job.update(finished=time.time()))
+    drop_stale_jobs()
+    with _lock:
+        _jobs[job_id] = job
+    return job_id
+
+
+def drop_stale_jobs():
+    # results no session collected in time, e.g. of closed tabs, are not kept
+    now = time.time()
+    with _lock:
+        for job_id, job in list(_jobs.items()):
+            finished = job["finished"]
+            if finished is not None and finished + JOB_RESULT_TTL_SECONDS < now:
+                del _jobs[job_id]
+
+
+def job_status(job_id):
+    job = _jobs.get(job_id)
+    if job is None:
+        return {"state": "unknown", "label": "Unknown job", "fraction": 0.0}
+    future = job["future"]
+    status = dict(job["progress"])
+    if future.done():
+        if future.cancelled():
+            status["state"] = "cancelled"
+        elif isinstance(future.exception(), JobCancelled):
+            status["state"] = "cancelled"
+        elif future.exception() is not None:
+            status["state"] = "failed"
+        else:
+            status["state"] = "done"
+    status["elapsed"] = time.time() - job["submitted"]
+    return status
+
+
+def cancel_job(job_id):
+    job = _jobs.get(job_id)
+    if job is not None:
+        job["cancel"].set()
+        job["future"].cancel()
+
+
+def forget_job(job_id):
+    """Drop a job whose result is no longer wanted, cancelling it if unfinished."""
+    cancel_job(job_id)
+    with _lock:
+        _jobs.pop(job_id, None)
+
+
+def pop_job_result(job_id):
+    """Result of a finished job, which is then forgotten. Raises the job's error."""
+    with _lock:
+        job = _jobs.pop(job_id)
+    try:
+        return attach_memmaps(job["future"].result())
+    except CancelledError:
+        raise JobCancelled()
@@ -7,10 +7,12 @@ from ui.process_and_download import (
     run_clustering_button,
     render_clustering_results,
 )
-from utils import initialize_session_state
+from pipeline import use_caches
+from ui.session import initialize_session_state, shared_caches
 
 
 def main():
+    use_caches(shared_caches())
     initialize_session_state()
     st.title("SPQRP - Protein Sample Analysis")
 
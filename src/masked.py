@@ -0,0 +1,97 @@
+import numpy as np
+
+# pairs with fewer proteins measured in both samples get no distance by default
+DEFAULT_MIN_OVERLAP = 3
+
+
+def observed_parts(values, centre):
+    """Values minus `centre` with missing ones set to 0, and the observed mask."""
+    observed = ~np.isnan(values)
+    filled = np.where(observed, values - centre, 0.0)
+    return filled, observed.astype(np.float64)
+
+
+def column_centre(values):
+    # protein means of the observed values, 0 for proteins without any
+    observed = ~np.isnan(values)
+    sums = np.where(observed, values, 0.0).sum(axis=0, dtype=np.float64)
+    return sums / np.maximum(observed.sum(axis=0), 1)
+
+
+def row_centre(values):
+    return column_centre(values.T)[:, None]
+
+
+def masked_euclidean(a, b):
+    # sum over shared proteins of (x - y)^2 = x^2 . m_b + m_a . y^2 - 2 x . y; the
+    # protein means are subtracted first, which keeps the products well conditioned
+    centre = column_centre(b)
+    xa, ma = observed_parts(a, centre)
+    xb, mb = observed_parts(b, centre)
+    counts = ma @ mb.T
+    sums = (xa**2) @ mb.T + ma @ (xb**2).T - 2 * (xa @ xb.T)
+    np.maximum(sums, 0, out=sums)
+    return sums, counts
+
+
+def masked_fractional(a, b, fractional_p):
+    # |x - y|^p has no product form for p < 1, the proteins are summed one by one
+    sums = np.zeros((len(a), len(b)))
+    for j in range(a.shape[1]):
+        terms = np.abs(a[:, j, None] - b[None, :, j]) ** fractional_p
+        np.add(sums, terms, out=sums, where=~np.isnan(terms))
+    ma = (~np.isnan(a)).astype(np.float64)
+    mb = (~np.isnan(b)).astype(np.float64)
+    return sums, ma @ mb.T
+
+
+def masked_correlation(a, b):
+    # Pearson correlation over the shared proteins of every pair from the sums of
+    # x, y, x^2, y^2 and xy restricted to them. Subtracting the sample means first
+    # does not change any correlation and avoids cancellation in the differences.
+    xa, ma = observed_parts(a, row_centre(a))
+    xb, mb = observed_parts(b, row_centre(b))
+    counts = ma @ mb.T
+    sum_a = xa @ mb.T
+    sum_b = ma @ xb.T
+    covariance = counts * (xa @ xb.T) - sum_a * sum_b
+    variance_a = counts * ((xa**2) @ mb.T) - sum_a**2
+    variance_b = counts * (ma @ (xb**2).T) - sum_b**2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        correlation = covariance / np.sqrt(variance_a * variance_b)
+    correlation[~((variance_a > 0) & (variance_b > 0))] = np.nan
+    return 1 - np.clip(correlation, -1, 1), counts
+
+
+def masked_tile(a, b, metric, fractional_p=None, min_overlap=DEFAULT_MIN_OVERLAP):
+    """
+    Distances between the rows of `a` and `b` over the proteins measured in both
+    samples of every pair (missing intensities are NaN), and the number of these
+    proteins per pair. Euclidean and fractional sums are scaled up to all proteins,
+    so that pairs with fewer shared proteins do not look closer. Pairs sharing
+    fewer than `min_overlap` proteins, and correlations of constant samples, are
+    NaN.
+    """
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    if metric == "correlation":
+        distances, counts = masked_correlation(a, b)
+    elif metric in ("euclidean", "fractional"):
+        power = 2.0 if metric == "euclidean" else fractional_p
+        if metric == "euclidean":
+            sums, counts = masked_euclidean(a, b)
+        else:
+            sums, counts = masked_fractional(a, b, fractional_p)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            distances = (sums * (a.shape[1] / counts)) ** (1 / power)
+    else:
+        raise ValueError(f"Unknown metric: {metric}")
+    distances[counts < max(min_overlap, 1)] = np.nan
+    return distances, counts
+
+
+def overlap_tile(a, b):
+    """Number of proteins measured in both samples of every pair of rows."""
+    ma = (~np.isnan(a)).astype(np.float32)
+    mb = (~np.isnan(b)).astype(np.float32)
+    return ma @ mb.T
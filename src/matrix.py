@@ -0,0 +1,125 @@
+import warnings
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+
+@dataclass
+class ProteinMatrix:
+    """Dense samples x proteins intensities with protein columns in ranking order."""
+
+    values: np.ndarray
+    sample_ids: np.ndarray
+    patient_ids: np.ndarray
+    patient_codes: np.ndarray
+    proteins: np.ndarray
+    ranks: np.ndarray
+    fingerprint: str
+    # protein means missing intensities are imputed with, None for the means of
+    # all samples; appended samples keep those of the analysis they extend
+    imputation_means: np.ndarray = None
+
+    @property
+    def n_samples(self):
+        return len(self.sample_ids)
+
+    def n_columns(self, n):
+        # top n proteins of the ranking that are measured in the data frame
+        return int(np.searchsorted(self.ranks, n))
+
+    def top_n(self, n):
+        n_columns = self.n_columns(n)
+        if n_columns == 0:
+            raise ValueError(
+                f"None of the top {n} proteins of the ranking are in the data frame."
+            )
+        # Fortran order keeps every column slice a contiguous, zero-copy view
+        return self.values[:, :n_columns]
+
+    def means(self, n):
+        if self.imputation_means is None:
+            return None
+        return self.imputation_means[: self.n_columns(n)]
+
+
+def build_protein_matrix(df, prot_ranking, fingerprint):
+    ranking = pd.Index(prot_ranking["Protein"]).drop_duplicates()
+    proteins = df["Protein"].astype("category")
+    category_ranks = ranking.get_indexer(proteins.cat.categories)
+    row_ranks = category_ranks[proteins.cat.codes.to_numpy()]
+
+    sample_codes, sample_ids = pd.factorize(df["Sample_ID"])
+    patient_codes, patient_ids = pd.factorize(df["Patient_ID"])
+    intensities = df["Intensity"].to_numpy(dtype=np.float64)
+
+    keep = (row_ranks >= 0) & (sample_codes >= 0) & ~np.isnan(intensities)
+    ranks = np.unique(row_ranks[keep])
+    columns = np.searchsorted(ranks, row_ranks[keep])
+
+    n_samples, n_proteins = len(sample_ids), len(ranks)
+    flat = sample_codes[keep].astype(np.int64) * n_proteins + columns
+    sums = np.bincount(
+        flat, weights=intensities[keep], minlength=n_samples * n_proteins
+    )
+    counts = np.bincount(flat, minlength=n_samples * n_proteins)
+    # duplicated measurements of a protein in a sample are averaged
+    with np.errstate(invalid="ignore", divide="ignore"):
+        values = np.where(counts > 0, sums / counts, np.nan)
+    values = np.asfortranarray(values.reshape(n_samples, n_proteins), dtype=np.float32)
+
+    # same sample -> patient assignment as dict(zip(Sample_ID, Patient_ID))
+    codes, reversed_first = np.unique(sample_codes[::-1], return_index=True)
+    last_rows = len(sample_codes) - 1 - reversed_first[codes >= 0]
+
+    return ProteinMatrix(
+        values=values,
+        sample_ids=np.asarray(sample_ids, dtype=object),
+        patient_ids=np.asarray(patient_ids, dtype=object),
+        patient_codes=patient_codes[last_rows],
+        proteins=ranking.to_numpy()[ranks],
+        ranks=ranks,
+        fingerprint=fingerprint,
+    )
+
+
+def append_samples(matrix, df, prot_ranking, fingerprint):
+    """
+    `matrix` with the samples of `df` appended as new rows on its protein columns,
+    so that the rows and distances of the samples analysed before stay valid.
+    Proteins only measured in the new samples are left out, and missing values
+    are imputed with the protein means of the samples analysed before.
+    """
+    new = build_protein_matrix(df, prot_ranking, fingerprint)
+    duplicated = pd.Index(matrix.sample_ids).intersection(new.sample_ids)
+    if len(duplicated):
+        raise ValueError(
+            f"{len(duplicated)} of the new samples are already in the analysis, "
+            f"e.g. {duplicated[0]}."
+        )
+    columns = pd.Index(new.proteins).get_indexer(matrix.proteins)
+    measured = columns >= 0
+    values = np.full((new.n_samples, len(matrix.proteins)), np.nan, dtype=np.float32)
+    values[:, measured] = new.values[:, columns[measured]]
+
+    patient_ids = pd.Index(matrix.patient_ids)
+    added = pd.Index(new.patient_ids)
+    patient_ids = patient_ids.append(added[~added.isin(patient_ids)])
+    new_codes = patient_ids.get_indexer(new.patient_ids[new.patient_codes])
+
+    imputation_means = matrix.imputation_means
+    if imputation_means is None:
+        with warnings.catch_warnings():
+            # proteins without any value stay missing, as in fill_missing
+            warnings.simplefilter("ignore", RuntimeWarning)
+            imputation_means = np.nanmean(matrix.values, axis=0)
+    return ProteinMatrix(
+        values=np.asfortranarray(np.concatenate([matrix.values, values])),
+        sample_ids=np.concatenate([matrix.sample_ids, new.sample_ids]),
+        patient_ids=np.asarray(patient_ids, dtype=object),
+        patient_codes=np.concatenate([matrix.patient_codes, new_codes]),
+        proteins=matrix.proteins,
+        ranks=matrix.ranks,
+        fingerprint=fingerprint,
+        imputation_means=imputation_means,
+    )
@@ -0,0 +1,191 @@
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import cdist
+
+from masked import column_centre, masked_tile
+
+# elements of one square row block read from a condensed array (~128 MB of float64)
+BLOCK_ELEMENTS = 2**24
+
+
+def block_rows(n_samples):
+    return max(1, BLOCK_ELEMENTS // max(n_samples, 1))
+
+
+def condensed_rows(condensed, n_samples, rows, diagonal_value=np.inf):
+    """The given rows of the square distance matrix from a condensed array."""
+    rows = np.asarray(rows, dtype=np.int64)[:, None]
+    cols = np.arange(n_samples, dtype=np.int64)[None, :]
+    i, j = np.minimum(rows, cols), np.maximum(rows, cols)
+    index = n_samples * i - i * (i + 1) // 2 + j - i - 1
+    diagonal = rows == cols
+    block = np.asarray(condensed[np.where(diagonal, 0, index)], dtype=np.float64)
+    block[diagonal] = diagonal_value
+    return block
+
+
+def condensed_row_block(condensed, n_samples, start, stop):
+    """Rows `start` to `stop` of the square distance matrix, diagonal set to inf."""
+    return condensed_rows(condensed, n_samples, np.arange(start, stop))
+
+
+def smallest_k(block, k, offset_indices=None):
+    """Column indices and values of the k smallest entries per row, sorted."""
+    if k < block.shape[1]:
+        part = np.argpartition(block, k - 1, axis=1)[:, :k]
+    else:
+        part = np.broadcast_to(np.arange(block.shape[1]), block.shape).copy()
+    values = np.take_along_axis(block, part, axis=1)
+    order = np.argsort(values, axis=1, kind="stable")
+    part = np.take_along_axis(part, order, axis=1)
+    values = np.take_along_axis(values, order, axis=1)
+    if offset_indices is not None:
+        part = np.take_along_axis(offset_indices, part, axis=1)
+    return part, values
+
+
+def top_k_neighbours(condensed, n_samples, k):
+    """
+    Exact k nearest neighbours of every sample from a condensed distance array.
+    Row blocks are partitioned with argpartition, so only O(N * k) is kept.
+    """
+    k = min(k, n_samples - 1)
+    indices = np.empty((n_samples, k), dtype=np.int64)
+    distances = np.empty((n_samples, k), dtype=np.float64)
+    step = block_rows(n_samples)
+    for start in range(0, n_samples, step):
+        stop = min(start + step, n_samples)
+        block = condensed_row_block(condensed, n_samples, start, stop)
+        indices[start:stop], distances[start:stop] = smallest_k(block, k)
+    return indices, distances
+
+
+def appended_neighbours(indices, distances, cross, inner, k):
+    """
+    k nearest neighbours after appending samples, from those of the n_old
+    earlier samples and the distances of the new ones to them (`cross`, m x
+    n_old) and to each other (`inner`, m x m). The earlier samples only compare
+    their neighbours to the new samples, so this is O((k + m) * n_old).
+    """
+    n_old, n_new = cross.shape[1], len(inner)
+    k = min(k, n_old + n_new - 1)
+    candidates = np.concatenate(
+        [
+            indices,
+            np.broadcast_to(np.arange(n_old, n_old + n_new), (n_old, n_new)),
+        ],
+        axis=1,
+    )
+    earlier = smallest_k(
+        np.concatenate([distances, cross.T], axis=1), k, offset_indices=candidates
+    )
+    block = np.concatenate([cross, inner], axis=1)
+    block[np.arange(n_new), n_old + np.arange(n_new)] = np.inf
+    new = smallest_k(block, k)
+    return (
+        np.concatenate([earlier[0], new[0]]),
+        np.concatenate([earlier[1], new[1]]),
+    )
+
+
+def neighbours_table(indices, distances, sample_ids):
+    columns = {}
+    for k in range(indices.shape[1]):
+        columns[f"Neighbor_{k + 1}"] = sample_ids[indices[:, k]]
+        columns[f"Distance_{k + 1}"] = distances[:, k]
+    return pd.DataFrame(columns, index=pd.Index(sample_ids, name="Sample_ID"))
+
+
+def metric_arguments(metric, fractional_p):
+    if metric == "correlation":
+        return {"metric": "correlation"}
+    if metric == "euclidean":
+        return {"metric": "euclidean"}
+    if metric == "fractional":
+        return {"metric": "minkowski", "p": fractional_p}
+    raise ValueError(f"Unknown metric: {metric}")
+
+
+class RandomProjectionForest:
+    """
+    Approximate k nearest neighbours: every tree splits the samples at the median
+    of random projections until leaves hold at most `leaf_size` samples, and only
+    samples sharing a leaf in some tree are compared with the exact metric.
+    """
+
+    def __init__(self, n_trees=8, leaf_size=64, seed=0):
+        self.n_trees = n_trees
+        self.leaf_size = leaf_size
+        self.seed = seed
+
+    def leaves(self, points, leaf_size, rng):
+        leaves, stack = [], [np.arange(len(points))]
+        while stack:
+            members = stack.pop()
+            if len(members) <= leaf_size:
+                leaves.append(members)
+                continue
+            direction = rng.standard_normal(points.shape[1])
+            projection = points[members] @ direction
+            median = np.median(projection)
+            left = members[projection < median]
+            right = members[projection >= median]
+            if len(left) == 0 or len(right) == 0:
+                # ties at the median, fall back to an even split
+                half = len(members) // 2
+                order = np.argsort(projection, kind="stable")
+                left, right = members[order[:half]], members[order[half:]]
+            stack.extend((left, right))
+        return leaves
+
+    def kneighbors(self, values, k, metric, fractional_p=None, min_overlap=None):
+        """
+        `values` without missing intensities, or with `min_overlap` with missing
+        ones compared pairwise-complete, see masked_tile.
+        """
+        n_samples = len(values)
+        k = min(k, n_samples - 1)
+        points = values
+        if min_overlap is not None:
+            # the trees split mean imputed points, only the leaves compare exactly
+            points = np.where(np.isnan(values), column_centre(values), values)
+        if metric == "correlation":
+            # correlation distance orders like euclidean distance of standardized rows
+            centred = points - points.mean(axis=1, keepdims=True)
+            norms = np.linalg.norm(centred, axis=1, keepdims=True)
+            points = centred / np.where(norms > 0, norms, 1)
+        arguments = metric_arguments(metric, fractional_p)
+
+        # every leaf has to offer at least k candidates besides the sample itself
+        leaf_size = max(self.leaf_size, 2 * (k + 1))
+        indices = np.full((n_samples, k), -1, dtype=np.int64)
+        distances = np.full((n_samples, k), np.inf)
+        rng = np.random.default_rng(self.seed)
+        for _ in range(self.n_trees):
+            for leaf in self.leaves(points, leaf_size, rng):
+                if min_overlap is None:
+                    block = cdist(values[leaf], values[leaf], **arguments)
+                else:
+                    block, _ = masked_tile(
+                        values[leaf], values[leaf], metric, fractional_p, min_overlap
+                    )
+                    block[np.isnan(block)] = np.inf
+                np.fill_diagonal(block, np.inf)
+                candidates = np.broadcast_to(leaf, block.shape)
+                merged_indices = np.concatenate([indices[leaf], candidates], axis=1)
+                merged = np.concatenate([distances[leaf], block], axis=1)
+                # a neighbour already found through another tree must not count twice
+                order = np.argsort(merged_indices, axis=1, kind="stable")
+                sorted_indices = np.take_along_axis(merged_indices, order, axis=1)
+                duplicate = np.zeros_like(merged, dtype=bool)
+                duplicate[:, 1:] = sorted_indices[:, 1:] == sorted_indices[:, :-1]
+                np.put_along_axis(
+                    merged,
+                    order,
+                    np.where(duplicate, np.inf, np.take_along_axis(merged, order, 1)),
+                    axis=1,
+                )
+                indices[leaf], distances[leaf] = smallest_k(
+                    merged, k, offset_indices=merged_indices
+                )
+        return indices, distances
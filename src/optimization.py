@@ -0,0 +1,239 @@
+from contextlib import nullcontext
+
+import numpy as np
+
+from blocked import temporary_distances
+from constants import OPTIMIZATION_MAX_BYTES, OUT_OF_CORE_MIN_SAMPLES, SKETCH_EPSILON
+from distances import condensed_distances, same_patient_mask
+from incremental import INCREMENTAL_METRICS, IncrementalDistances
+from parallel import parallel_map, worker_count
+from sketch import sketch_distances, sketch_threshold_curve
+
+PERCENTILE_GRID = np.round(np.arange(0, 1001) * 0.1, 1)
+# the range and step of fractional_p in the app and the CLI
+FRACTIONAL_P_GRID = np.round(np.arange(1, 101) * 0.01, 2)
+# only every COARSE_STEP-th fractional_p is scored before refining around the best
+COARSE_STEP = 10
+REFINED_CANDIDATES = 2
+# float64 bytes per pair a sweep holds at once: the incremental sums, the
+# contribution of the next columns, the candidate distances, their sort order,
+# sorted copy and cumulative counts
+SWEEP_BYTES_PER_PAIR = 48
+
+
+def sorted_percentiles(sorted_distances, percentiles):
+    # same linear interpolation as np.percentile, without sorting again
+    positions = percentiles / 100 * (len(sorted_distances) - 1)
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.ceil(positions).astype(np.int64)
+    weight = positions - lower
+    return (
+        sorted_distances[lower]
+        + (sorted_distances[upper] - sorted_distances[lower]) * weight
+    )
+
+
+def threshold_curve(condensed, same_patient, percentiles=PERCENTILE_GRID):
+    """TP/FP/FN/TN counts of the threshold classification for every percentile."""
+    order = np.argsort(condensed, kind="stable")
+    sorted_distances = condensed[order]
+    tp_cumulative = np.cumsum(same_patient[order])
+
+    thresholds = sorted_percentiles(sorted_distances, percentiles)
+    belonging = np.searchsorted(sorted_distances, thresholds, side="right")
+    tp = np.where(belonging > 0, tp_cumulative[np.maximum(belonging - 1, 0)], 0)
+    fp = belonging - tp
+    fn = tp_cumulative[-1] - tp
+    tn = len(condensed) - belonging - fn
+    return {
+        "percentile": percentiles,
+        "threshold": thresholds,
+        "TP": tp,
+        "FP": fp,
+        "FN": fn,
+        "TN": tn,
+    }
+
+
+def ratio(numerator, denominator):
+    numerator = numerator.astype(np.float64)
+    return np.divide(
+        numerator,
+        denominator,
+        out=np.zeros_like(numerator),
+        where=denominator > 0,
+    )
+
+
+def strategy_scores(curve, optimization_strategy):
+    """Scores of all percentiles for an optimization strategy, higher is better."""
+    tp, fp, fn = curve["TP"], curve["FP"], curve["FN"]
+    precision = ratio(tp, tp + fp)
+    sensitivity = ratio(tp, tp + fn)
+    f1 = ratio(2 * precision * sensitivity, precision + sensitivity)
+    scores = {
+        "F1": f1,
+        "fp+fn": -(fp + fn),
+        "fp": -fp,
+        "fn": -fn,
+        "precision": precision,
+        "sensitivity": sensitivity,
+    }
+    if optimization_strategy not in scores:
+        raise ValueError(f"Unknown optimization strategy: {optimization_strategy}")
+    return scores[optimization_strategy], f1
+
+
+def best_percentile(curve, optimization_strategy):
+    scores, f1 = strategy_scores(curve, optimization_strategy)
+    # ties of the strategy score go to the percentile with the better F1
+    best = np.lexsort((-f1, -scores))[0]
+    return {
+        "score": float(scores[best]),
+        "F1": float(f1[best]),
+        "percentile": float(curve["percentile"][best]),
+    }
+
+
+def sweep_n(
+    matrix,
+    metric,
+    fractional_p,
+    n_values,
+    optimization_strategy,
+    distance_lookup=None,
+    n_jobs=None,
+    min_overlap=None,
+):
+    """Best percentile over all `n_values` for one metric and fractional_p."""
+    out_of_core = matrix.n_samples >= OUT_OF_CORE_MIN_SAMPLES
+    if distance_lookup is not None:
+
+        def candidate_distances(n):
+            return nullcontext(distance_lookup(n))
+
+    elif out_of_core:
+
+        def candidate_distances(n):
+            # only scored, the O(N^2) file of every candidate is deleted right after
+            return temporary_distances(
+                matrix.top_n(n),
+                metric,
+                fractional_p,
+                n_jobs=n_jobs,
+                min_overlap=min_overlap,
+                means=matrix.means(n),
+            )
+
+    elif metric in INCREMENTAL_METRICS and min_overlap is None:
+        engine = IncrementalDistances(matrix, metric, fractional_p)
+
+        def candidate_distances(n):
+            return nullcontext(engine.distances(n))
+
+    else:
+
+        def candidate_distances(n):
+            return nullcontext(
+                condensed_distances(
+                    matrix.top_n(n),
+                    metric,
+                    fractional_p,
+                    n_jobs=n_jobs,
+                    min_overlap=min_overlap,
+                    means=matrix.means(n),
+                )
+            )
+
+    same_patient = None
+    if not out_of_core:
+        same_patient = same_patient_mask(matrix.patient_codes)
+
+    best = None
+    for n in n_values:
+        with candidate_distances(n) as condensed:
+            if out_of_core:
+                # the O(N^2) distances are never sorted, the curve comes from a sketch
+                summary = sketch_distances(
+                    condensed, matrix.patient_codes, SKETCH_EPSILON
+                )
+                curve = sketch_threshold_curve(summary, PERCENTILE_GRID)
+            else:
+                curve = threshold_curve(condensed, same_patient)
+        candidate = best_percentile(curve, optimization_strategy)
+        if best is None or candidate["score"] > best["score"]:
+            best = dict(candidate, n=n, fractional_p=fractional_p)
+    return best
+
+
+def sweep_workers(matrix):
+    """Sweeps to run at once, as many as cores and OPTIMIZATION_MAX_BYTES allow."""
+    if matrix.n_samples >= OUT_OF_CORE_MIN_SAMPLES:
+        # the candidates of out-of-core sweeps are on disk
+        return worker_count()
+    n_pairs = matrix.n_samples * (matrix.n_samples - 1) // 2
+    fitting = OPTIMIZATION_MAX_BYTES // max(SWEEP_BYTES_PER_PAIR * n_pairs, 1)
+    return max(1, min(worker_count(), fitting))
+
+
+def sweep_fractional_p(
+    matrix, p_values, n_values, optimization_strategy, backend, min_overlap=None
+):
+    def sweep(p):
+        # the fractional_p grid is the parallel axis, each sweep stays on one core
+        return sweep_n(
+            matrix,
+            "fractional",
+            p,
+            n_values,
+            optimization_strategy,
+            n_jobs=1,
+            min_overlap=min_overlap,
+        )
+
+    return parallel_map(sweep, p_values, n_jobs=sweep_workers(matrix), backend=backend)
+
+
+def optimize_distance_parameters(
+    matrix,
+    metric,
+    n_values,
+    optimization_strategy,
+    distance_lookup=None,
+    backend=None,
+    min_overlap=None,
+):
+    """
+    Optimize the percentile (and fractional_p for the fractional metric) for every
+    n in `n_values`. Returns the best candidate as a dict.
+    """
+    if metric != "fractional":
+        return sweep_n(
+            matrix,
+            metric,
+            None,
+            n_values,
+            optimization_strategy,
+            distance_lookup,
+            min_overlap=min_overlap,
+        )
+
+    coarse = FRACTIONAL_P_GRID[::COARSE_STEP]
+    results = sweep_fractional_p(
+        matrix, coarse, n_values, optimization_strategy, backend, min_overlap
+    )
+
+    # only the grid around the best coarse candidates is refined
+    ranked = sorted(results, key=lambda r: r["score"], reverse=True)
+    refine = set()
+    for candidate in ranked[:REFINED_CANDIDATES]:
+        distance_to_grid = np.abs(FRACTIONAL_P_GRID - candidate["fractional_p"])
+        index = int(np.argmin(distance_to_grid))
+        low = max(index - COARSE_STEP + 1, 0)
+        high = min(index + COARSE_STEP, len(FRACTIONAL_P_GRID))
+        refine.update(FRACTIONAL_P_GRID[low:high].tolist())
+    refine -= set(coarse.tolist())
+    results += sweep_fractional_p(
+        matrix, sorted(refine), n_values, optimization_strategy, backend, min_overlap
+    )
+    return max(results, key=lambda r: r["score"])
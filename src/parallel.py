@@ -0,0 +1,52 @@
+import os
+
+from joblib import Parallel, delayed, parallel_config
+from threadpoolctl import threadpool_limits
+
+from constants import N_WORKERS, PARALLEL_BACKEND
+
+BACKENDS = {"threads": "threading", "processes": "loky"}
+
+
+def worker_count(n_jobs=None):
+    return max(1, n_jobs or N_WORKERS or os.cpu_count() or 1)
+
+
+def blas_threads(n_jobs):
+    # every worker gets an even share of the cores for its BLAS calls
+    return max(1, (os.cpu_count() or 1) // n_jobs)
+
+
+def parallel_map(function, items, n_jobs=None, backend=None):
+    """
+    `[function(item) for item in items]` on a pool of workers. `backend` is
+    "threads" or "processes"; BLAS thread pools are limited so that workers times
+    BLAS threads does not exceed the cores.
+    """
+    items = list(items)
+    n_jobs = min(worker_count(n_jobs), max(len(items), 1))
+    if n_jobs == 1:
+        return [function(item) for item in items]
+
+    backend = backend or PARALLEL_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, use one of {list(BACKENDS)}")
+    tasks = (delayed(function)(item) for item in items)
+    if backend == "threads":
+        with threadpool_limits(limits=blas_threads(n_jobs)):
+            return Parallel(n_jobs=n_jobs, backend="threading")(tasks)
+    with parallel_config(backend="loky", inner_max_num_threads=blas_threads(n_jobs)):
+        return Parallel(n_jobs=n_jobs)(tasks)
+
+
+def balanced_row_blocks(n_samples, n_blocks):
+    """Row ranges of a condensed array holding roughly the same number of pairs."""
+    n_pairs = n_samples * (n_samples - 1) // 2
+    bounds, pairs, start = [], 0, 0
+    target = n_pairs / max(n_blocks, 1)
+    for row in range(n_samples - 1):
+        pairs += n_samples - row - 1
+        if pairs >= target * (len(bounds) + 1) or row == n_samples - 2:
+            bounds.append((start, row + 1))
+            start = row + 1
+    return bounds
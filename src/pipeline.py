@@ -0,0 +1,889 @@
+import os
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+from utils import (
+    get_missing_columns,
+    build_results_table,
+    calculate_f1_based_on_nn_counts,
+    f1_per_sample_and_patient,
+    nn_counts_from_indices,
+    nn_k_message,
+)
+from constants import (
+    APPROXIMATE_NEIGHBOURS_MIN_SAMPLES,
+    CACHE_DIR,
+    CACHE_TTL_SECONDS,
+    DISK_CACHE_MAX_BYTES,
+    DISTANCE_CACHE_MAX_BYTES,
+    INGEST_CACHE_MAX_BYTES,
+    OUT_OF_CORE_MIN_SAMPLES,
+    REQUIRED_COLUMNS_DF,
+    REQUIRED_COLUMNS_RANKING,
+    RESULT_CACHE_MAX_BYTES,
+    SKETCH_EPSILON,
+)
+from cache import DiskCache, LRUCache, TieredCache
+from instrumentation import Instrumentation
+from matrix import append_samples, build_protein_matrix
+from distances import (
+    appended_blocks,
+    appended_condensed,
+    appended_overlap,
+    appended_pairs,
+    compact_neighbours,
+    condensed_distances,
+    condensed_overlap,
+    evaluate_appended,
+    evaluate_distances,
+    fill_missing,
+    fill_undefined,
+    overlap_per_sample,
+    spqrp_result,
+    upper_pairs,
+)
+from incremental import INCREMENTAL_METRICS, IncrementalDistances
+from optimization import optimize_distance_parameters
+from neighbours import (
+    RandomProjectionForest,
+    appended_neighbours,
+    smallest_k,
+    top_k_neighbours,
+)
+from sketch import sketch_distances
+from embedding import PLOT_METHODS, SCALABLE_METHODS, match_layout, scalable_embedding
+from visualization import UNCERTAIN, appended_layout, cluster_labels, cluster_layout
+from blocked import evaluate_distances_streamed, scratch_distances
+import sys
+
+sys.path.append("../")
+from spqrp.core import (
+    cluster_samples_iteratively,
+    plot_distances_neighbours_with_coloring_hue,
+)
+
+# the cheapest representation, used when only the graph is needed
+GRAPH_ONLY_METHOD = "PCA"
+
+METRICS_ORDER = [
+    ("TP", "True Positives"),
+    ("FP", "False Positives"),
+    ("FN", "False Negatives"),
+    ("TN", "True Negatives"),
+    ("Accuracy", "Accuracy"),
+    ("Precision", "Precision"),
+    ("Sensitivity", "Sensitivity"),
+    ("F1", "F1 Score"),
+]
+
+
+def report(progress, label, fraction):
+    if progress is not None:
+        progress(label, fraction)
+
+
+def missing_columns_error(df, prot_ranking):
+    missing_columns_df = get_missing_columns(REQUIRED_COLUMNS_DF, df)
+    missing_columns_ranking = get_missing_columns(
+        REQUIRED_COLUMNS_RANKING, prot_ranking
+    )
+
+    if missing_columns_df or missing_columns_ranking:
+        delimiter = ", "
+        missing_columns_text_df = delimiter.join(missing_columns_df)
+        missing_columns_text_ranking = delimiter.join(missing_columns_ranking)
+        return (
+            f"{len(missing_columns_df)} missing required columns for the dataframe: {missing_columns_text_df}\n \n"
+            f"{len(missing_columns_ranking)} missing required columns for the protein_ranking: {missing_columns_text_ranking}"
+        )
+    return None
+
+
+CACHE_MAX_BYTES = {
+    "ingest": INGEST_CACHE_MAX_BYTES,
+    "distances": DISTANCE_CACHE_MAX_BYTES,
+    "results": RESULT_CACHE_MAX_BYTES,
+    "clustering": RESULT_CACHE_MAX_BYTES,
+}
+
+# the caches of this process; memory only unless persistent ones are installed
+CACHES = {}
+
+
+def use_caches(caches):
+    CACHES.update(caches)
+
+
+def persistent_caches():
+    """Caches backed by files under CACHE_DIR/name that survive a restart."""
+    return {
+        name: TieredCache(
+            LRUCache(max_bytes, CACHE_TTL_SECONDS),
+            DiskCache(
+                os.path.join(CACHE_DIR, name), DISK_CACHE_MAX_BYTES, CACHE_TTL_SECONDS
+            ),
+        )
+        for name, max_bytes in CACHE_MAX_BYTES.items()
+    }
+
+
+def use_persistent_caches():
+    use_caches(persistent_caches())
+
+
+def get_cache(name):
+    cache = CACHES.get(name)
+    if cache is None:
+        cache = CACHES.setdefault(
+            name, TieredCache(LRUCache(CACHE_MAX_BYTES[name], CACHE_TTL_SECONDS), None)
+        )
+    return cache
+
+
+def ingest_cache():
+    return get_cache("ingest")
+
+
+def get_protein_matrix(df, prot_ranking, fingerprint):
+    # the pivot to samples x proteins is built once per data frame and ranking and
+    # shared by all sessions next to the parsed frames it is built from
+    cache = ingest_cache()
+    key = ("protein_matrix", fingerprint)
+    matrix = cache.get(key)
+    if matrix is None:
+        matrix = cache.put(
+            key, build_protein_matrix(df, prot_ranking, fingerprint), persist=False
+        )
+    return matrix
+
+
+def get_appended_matrix(base_matrix, df, prot_ranking, fingerprint):
+    """
+    `base_matrix` with the samples of `df` appended, see append_samples. Its
+    rows and imputation can not be rebuilt from the combined data frame, so it
+    is kept on disk under its own key and read back with appended_matrix.
+    """
+    cache = ingest_cache()
+    key = ("appended_matrix", fingerprint)
+    matrix = cache.get(key)
+    if matrix is None:
+        matrix = cache.put(
+            key, append_samples(base_matrix, df, prot_ranking, fingerprint)
+        )
+    return matrix
+
+
+def appended_matrix(fingerprint):
+    matrix = ingest_cache().get(("appended_matrix", fingerprint))
+    if matrix is None:
+        raise ValueError(
+            "The appended samples are no longer cached. Load the data frame and append the samples again."
+        )
+    return matrix
+
+
+def distance_key(matrix, n, metric, fractional_p, min_overlap=None):
+    return (
+        matrix.fingerprint,
+        matrix.n_columns(n),
+        metric,
+        fractional_p if metric == "fractional" else None,
+        min_overlap,
+    )
+
+
+def distance_cache():
+    return get_cache("distances")
+
+
+def results_cache():
+    return get_cache("results")
+
+
+def results_key(dataset, parameters):
+    return (dataset, tuple(sorted(parameters.items())))
+
+
+def clustering_key(result_key, clustering_params):
+    return ("clustering", result_key, tuple(sorted(clustering_params.items())))
+
+
+def get_condensed_distances(
+    matrix, n, metric, fractional_p, state, persist=False, min_overlap=None
+):
+    """
+    Condensed distances of the top n proteins from the cache shared by all
+    sessions. Only `persist`ed entries are also written to disk, so that the
+    candidates of an optimization sweep stay in memory. With `min_overlap` pairs
+    are compared over their shared proteins instead of imputing missing values.
+    """
+    # scoring parameters and the percentile only re-threshold these cached distances
+    cache = distance_cache()
+    key = distance_key(matrix, n, metric, fractional_p, min_overlap)
+    condensed = cache.get(key)
+    if condensed is None:
+        if matrix.n_samples >= OUT_OF_CORE_MIN_SAMPLES:
+            condensed = scratch_distances(
+                matrix.top_n(n),
+                metric,
+                fractional_p,
+                key,
+                min_overlap=min_overlap,
+                means=matrix.means(n),
+            )
+        elif metric in INCREMENTAL_METRICS and min_overlap is None:
+            engine = state.get("incremental_distances")
+            if engine is None or not engine.matches(matrix, metric, fractional_p):
+                engine = IncrementalDistances(matrix, metric, fractional_p)
+                state["incremental_distances"] = engine
+            condensed = engine.distances(n)
+        else:
+            condensed = condensed_distances(
+                matrix.top_n(n),
+                metric,
+                fractional_p,
+                min_overlap=min_overlap,
+                means=matrix.means(n),
+            )
+        condensed.setflags(write=False)
+        cache.put(key, condensed, persist=persist)
+    return condensed
+
+
+def get_overlap(matrix, n, min_overlap):
+    """
+    Per sample, the fewest of the top n proteins shared with another sample and
+    the number of samples sharing fewer than `min_overlap`, for quality control.
+    """
+    cache = distance_cache()
+    key = ("overlap", matrix.fingerprint, matrix.n_columns(n), min_overlap)
+    overlap = cache.get(key)
+    if overlap is None:
+        counts = condensed_overlap(matrix.top_n(n))
+        overlap = cache.put(
+            key, overlap_per_sample(counts, matrix.n_samples, min_overlap)
+        )
+    return overlap
+
+
+def get_nearest_neighbours(
+    matrix, condensed, n, metric, fractional_p, k, state, min_overlap=None
+):
+    key = (distance_key(matrix, n, metric, fractional_p, min_overlap), k)
+    cached = state.get("nearest_neighbours")
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    if matrix.n_samples >= APPROXIMATE_NEIGHBOURS_MIN_SAMPLES:
+        values = matrix.top_n(n)
+        if min_overlap is None:
+            values = fill_missing(values, matrix.means(n))
+        nearest_neighbours = RandomProjectionForest().kneighbors(
+            values, k, metric, fractional_p, min_overlap
+        )
+    else:
+        nearest_neighbours = top_k_neighbours(condensed, matrix.n_samples, k)
+    nearest_neighbours = compact_neighbours(nearest_neighbours)
+    state["nearest_neighbours"] = (key, nearest_neighbours)
+    return nearest_neighbours
+
+
+def get_distance_summary(
+    matrix, condensed, n, metric, fractional_p, state, min_overlap=None
+):
+    key = distance_key(matrix, n, metric, fractional_p, min_overlap)
+    cached = state.get("distance_summary")
+    if cached is None or cached[0] != key:
+        summary = sketch_distances(condensed, matrix.patient_codes, SKETCH_EPSILON)
+        state["distance_summary"] = (key, summary)
+    return state["distance_summary"][1]
+
+
+def get_nn_counts(matrix, neighbour_indices, key, state):
+    # per-k counts are kept so that a change of k only re-reads a column
+    cached = state.get("nn_counts")
+    if cached is None or cached[0] != key:
+        nn_counts = nn_counts_from_indices(
+            np.arange(matrix.n_samples), neighbour_indices, matrix.patient_codes
+        )
+        state["nn_counts"] = (key, nn_counts)
+    return state["nn_counts"][1]
+
+
+def compute_results(
+    matrix, parameters, state=None, progress=None, instrumentation=None
+):
+    """
+    Distance evaluation and scoring of a protein matrix without any UI. `state`
+    holds the reusable intermediates (the session state in the app, a plain dict
+    elsewhere) and `progress(label, fraction)` is called between stages. The
+    stages are timed into `instrumentation`, whose report is returned as
+    "performance".
+    """
+    state = {} if state is None else state
+    instrumentation = instrumentation or Instrumentation()
+    with instrumentation.profiling():
+        output = evaluate_and_score(
+            matrix, parameters, state, progress, instrumentation
+        )
+    output["performance"] = instrumentation.report()
+    return output
+
+
+def score_samples(
+    matrix,
+    result,
+    param_evaluation_method,
+    param_k,
+    key,
+    number_neighbours_table,
+    messages,
+    state,
+):
+    """F1 per sample and per patient and the patients with too few samples."""
+    warning_patients = None
+    if param_evaluation_method == "Threshold":
+        sample_counts = result["sample_counts"]
+        F1_per_sample, F1_per_patient = f1_per_sample_and_patient(
+            matrix.sample_ids,
+            matrix.patient_ids,
+            matrix.patient_codes,
+            sample_counts["TP"],
+            sample_counts["FP"],
+            sample_counts["FN"],
+        )
+    elif param_evaluation_method == "Nearest Neighbour":
+        nn_key = (key, number_neighbours_table)
+        nn_counts = get_nn_counts(matrix, result["neighbour_indices"], nn_key, state)
+        message = nn_k_message(param_k, nn_counts)
+        if message:
+            messages.append(message)
+        F1_per_sample, F1_per_patient, warning_patients = (
+            calculate_f1_based_on_nn_counts(
+                nn_counts,
+                matrix.sample_ids,
+                matrix.patient_ids,
+                matrix.patient_codes,
+                n=param_k,
+            )
+        )
+    return F1_per_sample, F1_per_patient, warning_patients
+
+
+def evaluate_and_score(matrix, parameters, state, progress, instrumentation):
+    n = parameters["param_n"]
+    metric = parameters["param_metric"]
+    percentile = parameters["param_percentile"]
+    fractional_p = parameters["param_fractional_p"]
+    param_evaluation_method = parameters["param_evaluation_method"]
+    param_k = parameters["param_k"]
+    mode = parameters["param_mode"]
+    optimization_metric = parameters["param_optimization_metric"]
+    number_neighbours_table = parameters["number_display_neighbours"]
+    n_max = parameters.get("param_n_max") or n
+    min_overlap = parameters.get("param_min_overlap")
+    messages = []
+
+    if mode == "optimize parameters":
+        report(progress, "Optimizing parameters", 0.0)
+
+        def cached_distances(n_candidate):
+            return get_condensed_distances(
+                matrix,
+                n_candidate,
+                metric,
+                fractional_p,
+                state,
+                min_overlap=min_overlap,
+            )
+
+        if matrix.n_samples < OUT_OF_CORE_MIN_SAMPLES:
+            distance_lookup = cached_distances
+        else:
+            # out-of-core candidates are written to temporary files by the sweep
+            distance_lookup = None
+
+        with instrumentation.stage("Optimization"):
+            optimized_params = optimize_distance_parameters(
+                matrix=matrix,
+                metric=metric,
+                n_values=range(n, max(n, n_max) + 1),
+                optimization_strategy=optimization_metric,
+                distance_lookup=distance_lookup,
+                min_overlap=min_overlap,
+            )
+        n = optimized_params["n"]
+        if metric == "fractional":
+            fractional_p = optimized_params["fractional_p"]
+        percentile = optimized_params["percentile"]
+    used_params = {
+        "n": n,
+        "metric": metric,
+        "percentile": percentile,
+        "fractional_p": fractional_p,
+        "param_evaluation_method": param_evaluation_method,
+        "param_k": param_k,
+        "min_overlap": min_overlap,
+    }
+
+    report(progress, "Computing distances", 0.4)
+    with instrumentation.stage("Distances"):
+        condensed = get_condensed_distances(
+            matrix,
+            n,
+            metric,
+            fractional_p,
+            state,
+            persist=True,
+            min_overlap=min_overlap,
+        )
+    report(progress, "Finding nearest neighbours", 0.6)
+    with instrumentation.stage("Nearest neighbours"):
+        nearest_neighbours = get_nearest_neighbours(
+            matrix,
+            condensed,
+            n,
+            metric,
+            fractional_p,
+            number_neighbours_table,
+            state,
+            min_overlap,
+        )
+    report(progress, "Evaluating distances", 0.75)
+    with instrumentation.stage("Distance evaluation"):
+        if matrix.n_samples >= OUT_OF_CORE_MIN_SAMPLES:
+            summary = get_distance_summary(
+                matrix, condensed, n, metric, fractional_p, state, min_overlap
+            )
+            result = evaluate_distances_streamed(
+                condensed, matrix, percentile, nearest_neighbours, summary
+            )
+        else:
+            result = evaluate_distances(
+                condensed, matrix, percentile, nearest_neighbours
+            )
+
+    if min_overlap is not None and matrix.n_samples < OUT_OF_CORE_MIN_SAMPLES:
+        with instrumentation.stage("Overlap QC"):
+            result["overlap"] = get_overlap(matrix, n, min_overlap)
+
+    return scored_output(
+        matrix,
+        result,
+        used_params,
+        distance_key(matrix, n, metric, fractional_p, min_overlap),
+        number_neighbours_table,
+        messages,
+        state,
+        progress,
+        instrumentation,
+    )
+
+
+def scored_output(
+    matrix,
+    result,
+    used_params,
+    key,
+    number_neighbours_table,
+    messages,
+    state,
+    progress,
+    instrumentation,
+):
+    """F1 scores and the results table of an evaluated `result`."""
+    eval_metric = result.get("eval_metrics", {})
+    raw_metrics = {
+        display_name: eval_metric.get(name, 0) for name, display_name in METRICS_ORDER
+    }
+
+    report(progress, "Scoring samples", 0.9)
+    sample_patient_mapping = dict(
+        zip(matrix.sample_ids, matrix.patient_ids[matrix.patient_codes])
+    )
+    with instrumentation.stage("F1 scoring"):
+        F1_per_sample, F1_per_patient, warning_patients = score_samples(
+            matrix,
+            result,
+            used_params["param_evaluation_method"],
+            used_params["param_k"],
+            key,
+            number_neighbours_table,
+            messages,
+            state,
+        )
+
+    with instrumentation.stage("Results table"):
+        # the neighbour columns are added when the table is shown or written
+        df_display = build_results_table(
+            F1_per_sample, F1_per_patient, sample_patient_mapping
+        )
+        if "overlap" in result:
+            positions = pd.Index(matrix.sample_ids).get_indexer(
+                df_display["Sample ID"].to_numpy()
+            )
+            df_display["Fewest Shared Proteins"] = result["overlap"]["fewest"][
+                positions
+            ]
+            df_display["Samples Below Min Overlap"] = result["overlap"]["below"][
+                positions
+            ]
+    report(progress, "Processing complete", 1.0)
+    return {
+        "df_display": df_display,
+        "metrics": raw_metrics,
+        "warning_patients": warning_patients,
+        "used_params": used_params,
+        "distance_key": key,
+        "result": result,
+        "messages": messages,
+    }
+
+
+def append_results(
+    matrix,
+    n_base,
+    base_output,
+    parameters,
+    state=None,
+    progress=None,
+    instrumentation=None,
+):
+    """
+    compute_results for `matrix`, whose first `n_base` samples were evaluated in
+    `base_output` with `parameters` and the rest appended since (see
+    append_samples). Only the distances of the m new samples to all samples are
+    computed, O(m * N), and the neighbours, pair classes and F1 scores updated
+    with them. The condensed distances of all samples are still copied into a
+    new array, O((N + m)^2) in memory and time. The distance parameters and the
+    distance threshold of the base run are kept, they are not optimized again.
+    """
+    state = {} if state is None else state
+    instrumentation = instrumentation or Instrumentation()
+    with instrumentation.profiling():
+        output = append_and_score(
+            matrix,
+            n_base,
+            base_output,
+            parameters,
+            state,
+            progress,
+            instrumentation,
+        )
+    output["performance"] = instrumentation.report()
+    return output
+
+
+def append_and_score(
+    matrix, n_base, base_output, parameters, state, progress, instrumentation
+):
+    base_result = base_output["result"]
+    used_params = dict(base_output["used_params"])
+    n = used_params["n"]
+    metric = used_params["metric"]
+    fractional_p = used_params["fractional_p"]
+    min_overlap = used_params.get("min_overlap")
+    number_neighbours_table = parameters["number_display_neighbours"]
+    if not base_result.get("square") or matrix.n_samples >= min(
+        OUT_OF_CORE_MIN_SAMPLES, APPROXIMATE_NEIGHBOURS_MIN_SAMPLES
+    ):
+        raise ValueError(
+            "Samples can only be appended to results with exact distances and neighbours in memory, run the processing again on all samples."
+        )
+    values = matrix.top_n(n)
+    key = distance_key(matrix, n, metric, fractional_p, min_overlap)
+
+    report(progress, "Computing distances of the new samples", 0.1)
+    with instrumentation.stage("Appended distances"):
+        cross, inner = appended_blocks(
+            values, n_base, metric, fractional_p, min_overlap, matrix.means(n)
+        )
+        if min_overlap is not None:
+            largest = max(
+                float(np.max(base_result["condensed_distances"])),
+                np.fmax.reduce(cross.ravel(), initial=0.0),
+                np.fmax.reduce(inner.ravel(), initial=0.0),
+            )
+            fill_undefined(cross, largest)
+            fill_undefined(inner, largest)
+        positions, rows, cols = appended_pairs(n_base, matrix.n_samples - n_base)
+        condensed = appended_condensed(
+            base_result["condensed_distances"],
+            n_base,
+            matrix.n_samples,
+            positions,
+            np.concatenate([cross.T.ravel(), upper_pairs(inner)]),
+        )
+        condensed.setflags(write=False)
+        distance_cache().put(key, condensed, persist=True)
+
+    report(progress, "Updating nearest neighbours", 0.5)
+    with instrumentation.stage("Nearest neighbours"):
+        nearest_neighbours = compact_neighbours(
+            appended_neighbours(
+                base_result["neighbour_indices"],
+                base_result["neighbour_distances"],
+                cross,
+                inner,
+                number_neighbours_table,
+            )
+        )
+        state["nearest_neighbours"] = (
+            (key, number_neighbours_table),
+            nearest_neighbours,
+        )
+        # nearest earlier samples of every new one, which place it in the clusters
+        base_neighbours, _ = smallest_k(cross, min(number_neighbours_table, n_base))
+
+    report(progress, "Evaluating the new pairs", 0.75)
+    with instrumentation.stage("Distance evaluation"):
+        result = evaluate_appended(
+            base_result,
+            condensed,
+            matrix,
+            n_base,
+            positions,
+            rows,
+            cols,
+            nearest_neighbours,
+        )
+    used_params["percentile"] = result["percentile"]
+    if min_overlap is not None:
+        with instrumentation.stage("Overlap QC"):
+            base_overlap = base_result.get("overlap")
+            if base_overlap is None:
+                base_overlap = overlap_per_sample(
+                    condensed_overlap(values[:n_base]), n_base, min_overlap
+                )
+            result["overlap"] = appended_overlap(
+                base_overlap, values, n_base, min_overlap
+            )
+
+    output = scored_output(
+        matrix,
+        result,
+        used_params,
+        key,
+        number_neighbours_table,
+        [],
+        state,
+        progress,
+        instrumentation,
+    )
+    output["appended"] = {
+        "n_base": n_base,
+        "base_neighbours": base_neighbours.astype(np.int32),
+    }
+    return output
+
+
+def append_clustering(clustering, output):
+    """
+    `clustering` of the base samples of an append_results `output` extended to
+    the appended ones without clustering again, see appended_layout. spqrp's
+    transitive results stay those of the base samples.
+    """
+    appended = output["appended"]
+    n_base = appended["n_base"]
+    sample_ids = output["result"]["sample_ids"][n_base:]
+    layout = appended_layout(
+        clustering["layout"], sample_ids, appended["base_neighbours"]
+    )
+    new = np.arange(n_base, len(layout["codes"]))
+    labels = cluster_labels(layout, new)
+    assignment = dict(clustering["cluster_assignment"])
+    assignment.update(
+        (sample, label)
+        for sample, label in zip(sample_ids, labels)
+        if label is not None
+    )
+    uncertain = sample_ids[(layout["flags"][new] & UNCERTAIN) > 0]
+    return {
+        **clustering,
+        "layout": layout,
+        "cluster_assignment": assignment,
+        "uncertain_nodes": list(clustering["uncertain_nodes"]) + list(uncertain),
+    }
+
+
+def clustering_cache():
+    return get_cache("clustering")
+
+
+def get_graph_and_embedding(
+    result,
+    df,
+    method,
+    n_neighbors,
+    max_cluster_size,
+    distance_id,
+    values=None,
+    embedding_options=None,
+    progress=None,
+    instrumentation=None,
+):
+    """
+    The neighbour graph depends on the clustering parameters and the 2D
+    embedding only on the distances and the method, so both are cached apart
+    and only the stage whose inputs changed is recomputed. SCALABLE_METHODS are
+    computed here, the other methods by spqrp together with the graph. The graph
+    always comes from spqrp, which builds the square distance matrix, so the
+    memory of the clustering grows with the square of the number of samples.
+    """
+    if distance_id is not None:
+        cache = clustering_cache()
+    else:
+        cache = LRUCache(RESULT_CACHE_MAX_BYTES)
+    instrumentation = instrumentation or Instrumentation()
+    options = embedding_options or {}
+    graph_key = ("graph", distance_id, n_neighbors, max_cluster_size)
+    embedding_key = ("embedding", distance_id, method)
+    if method in SCALABLE_METHODS:
+        embedding_key += (options.get("quality"), options.get("seed"))
+    g, coords_2d = cache.get(graph_key), cache.get(embedding_key)
+
+    def spqrp_clustering(spqrp_method):
+        # the square matrix and the pair lists are only built when spqrp runs
+        return cluster_samples_iteratively(
+            spqrp_result(result),
+            df,
+            spqrp_method,
+            n_neighbors=n_neighbors,
+            max_component_size=max_cluster_size,
+        )
+
+    spqrp_method = GRAPH_ONLY_METHOD if method in SCALABLE_METHODS else method
+    spqrp_coords = None
+    if g is None or (coords_2d is None and method not in SCALABLE_METHODS):
+        if coords_2d is not None:
+            spqrp_method = GRAPH_ONLY_METHOD
+        report(progress, f"Clustering with the {spqrp_method} representation", 0.0)
+        with instrumentation.stage(f"Graph clustering ({spqrp_method})"):
+            g, spqrp_coords = spqrp_clustering(spqrp_method)
+        cache.put(graph_key, g)
+        cache.put(("embedding", distance_id, spqrp_method), spqrp_coords)
+        if spqrp_method == method:
+            coords_2d = spqrp_coords
+
+    if coords_2d is None:
+        report(progress, f"Computing the {method} embedding", 0.4)
+        # spqrp's own coordinates show in which container it expects them
+        template = spqrp_coords
+        if template is None:
+            template = cache.get(("embedding", distance_id, GRAPH_ONLY_METHOD))
+        if template is None:
+            with instrumentation.stage(f"Graph clustering ({GRAPH_ONLY_METHOD})"):
+                _, template = spqrp_clustering(GRAPH_ONLY_METHOD)
+        sample_ids = pd.Index(result["sample_ids"])
+        with instrumentation.stage(f"Embedding ({method})"):
+            coords = scalable_embedding(
+                method, result["condensed_distances"], values, len(sample_ids), options
+            )
+        coords_2d = cache.put(embedding_key, match_layout(template, coords, sample_ids))
+    return g, coords_2d
+
+
+def compute_clustering(
+    result,
+    df,
+    method,
+    n_neighbors,
+    max_cluster_size,
+    df_name,
+    distance_id=None,
+    values=None,
+    embedding_options=None,
+    state=None,
+    progress=None,
+    instrumentation=None,
+):
+    """
+    Graph clustering of a distance evaluation result and the cluster layout
+    drawn by the interactive view. Graphs and embeddings are reused across
+    calls with the same `distance_id`, the distance_key of the result.
+    `values` (the protein matrix of the distances, rows in sample order) and
+    `embedding_options` (quality, seed, metric, fractional_p) are used by the
+    SCALABLE_METHODS. The stages are timed into `instrumentation`, whose report
+    is returned as "performance".
+    """
+    if not result.get("square"):
+        raise ValueError(
+            "Clustering needs the full distance matrix in memory, which is not built for cohorts computed out of core."
+        )
+    instrumentation = instrumentation or Instrumentation()
+    with instrumentation.profiling():
+        output = cluster_and_lay_out(
+            result,
+            df,
+            method,
+            n_neighbors,
+            max_cluster_size,
+            df_name,
+            distance_id,
+            values,
+            embedding_options,
+            progress,
+            instrumentation,
+        )
+    output["performance"] = instrumentation.report()
+    return output
+
+
+def cluster_and_lay_out(
+    result,
+    df,
+    method,
+    n_neighbors,
+    max_cluster_size,
+    df_name,
+    distance_id,
+    values,
+    embedding_options,
+    progress,
+    instrumentation,
+):
+    g, coords_2d = get_graph_and_embedding(
+        result,
+        df,
+        method,
+        n_neighbors,
+        max_cluster_size,
+        distance_id,
+        values=values,
+        embedding_options=embedding_options,
+        progress=progress,
+        instrumentation=instrumentation,
+    )
+
+    report(progress, "Assigning clusters", 0.7)
+    with instrumentation.stage("Cluster assignment"):
+        res = plot_distances_neighbours_with_coloring_hue(
+            df=df,
+            G=g,
+            coords_2d=coords_2d,
+            method=PLOT_METHODS.get(method, method),
+            return_clusters=True,
+            df_name=df_name,
+        )
+        # spqrp also draws a matplotlib figure, the view is built from the layout
+        plt.close("all")
+
+    report(progress, "Laying out clusters", 0.9)
+    with instrumentation.stage("Cluster layout"):
+        layout = cluster_layout(
+            g,
+            coords_2d,
+            result["sample_ids"],
+            res["cluster_assignments"],
+            res["uncertain_nodes"],
+            res["error_candidates"],
+        )
+    report(progress, "Clustering complete", 1.0)
+    return {
+        "layout": layout,
+        "cluster_assignment": res["cluster_assignments"],
+        "transitive_results": res["transitive_results"],
+        "uncertain_nodes": res["uncertain_nodes"],
+        "error_candidates": res["error_candidates"],
+    }
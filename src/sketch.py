@@ -0,0 +1,144 @@
+import numpy as np
+
+from distances import CHUNK_PAIRS, iter_row_chunks, same_patient_rows
+
+
+class KLLSketch:
+    """
+    Mergeable KLL quantile sketch. Level h stores items of weight 2**h; a level
+    that outgrows its capacity is sorted and every other item is promoted. Ranks
+    are within about `epsilon * n` of the exact rank.
+    """
+
+    def __init__(self, epsilon=0.001, seed=0):
+        self.epsilon = epsilon
+        self.k = int(np.ceil(2 / epsilon))
+        self.n = 0
+        self.levels = [np.empty(0)]
+        self.rng = np.random.default_rng(seed)
+
+    def capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(2, int(np.ceil(self.k * (2 / 3) ** depth)))
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.n += len(values)
+        self.compress()
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, values in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], values])
+        self.n += other.n
+        self.compress()
+
+    def compress(self):
+        level = 0
+        while level < len(self.levels):
+            values = self.levels[level]
+            if len(values) > self.capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                values = np.sort(values)
+                # an odd item out stays behind so that weights are preserved
+                even = len(values) // 2 * 2
+                kept = values[even:]
+                offset = self.rng.integers(2)
+                promoted = values[offset:even:2]
+                self.levels[level] = kept
+                self.levels[level + 1] = np.concatenate(
+                    [self.levels[level + 1], promoted]
+                )
+            level += 1
+
+    def weighted_items(self):
+        values = np.concatenate(self.levels)
+        weights = np.concatenate(
+            [np.full(len(items), 2**level) for level, items in enumerate(self.levels)]
+        )
+        order = np.argsort(values, kind="stable")
+        return values[order], np.cumsum(weights[order])
+
+    def quantile(self, q):
+        values, cumulative = self.weighted_items()
+        ranks = np.asarray(q) * cumulative[-1]
+        positions = np.searchsorted(cumulative, ranks, side="left")
+        return values[np.minimum(positions, len(values) - 1)]
+
+    def rank(self, x):
+        values, cumulative = self.weighted_items()
+        positions = np.searchsorted(values, x, side="right")
+        cumulative = np.concatenate([[0], cumulative])
+        return cumulative[positions]
+
+
+def sketch_distances(condensed, patient_codes, epsilon):
+    """
+    One streaming pass over a condensed distance array: a quantile sketch of all
+    distances plus the exact, sorted distances of the few same-patient pairs.
+    """
+    sketch = KLLSketch(epsilon)
+    same_patient_distances = []
+    n_samples = len(patient_codes)
+    step = max(1, CHUNK_PAIRS // max(n_samples, 1))
+    for r0, r1, lo, hi in iter_row_chunks(n_samples, step):
+        chunk = np.asarray(condensed[lo:hi])
+        sketch.update(chunk)
+        same_patient = same_patient_rows(patient_codes, r0, r1)
+        same_patient_distances.append(chunk[same_patient])
+    return {
+        "sketch": sketch,
+        "same_patient_distances": np.sort(np.concatenate(same_patient_distances)),
+        "n_pairs": len(condensed),
+    }
+
+
+def sketch_threshold_curve(summary, percentiles):
+    """threshold_curve from a distance sketch, in memory independent of the pairs."""
+    thresholds = summary["sketch"].quantile(np.asarray(percentiles) / 100)
+    same_distances = summary["same_patient_distances"]
+    belonging = np.round(summary["sketch"].rank(thresholds)).astype(np.int64)
+    tp = np.searchsorted(same_distances, thresholds, side="right")
+    belonging = np.maximum(belonging, tp)
+    fn = len(same_distances) - tp
+    return {
+        "percentile": np.asarray(percentiles),
+        "threshold": thresholds,
+        "TP": tp,
+        "FP": belonging - tp,
+        "FN": fn,
+        "TN": summary["n_pairs"] - belonging - fn,
+    }
+
+
+def refined_percentile(condensed, summary, percentile):
+    """
+    Exact np.percentile of the distances: the sketch brackets the wanted ranks and
+    one pass collects only the distances inside that bracket.
+    """
+    n_pairs = len(condensed)
+    position = percentile / 100 * (n_pairs - 1)
+    lower, upper = int(np.floor(position)), int(np.ceil(position))
+    margin = 2 * summary["sketch"].epsilon
+    while True:
+        # the sketch may have dropped the extremes, so the outermost brackets are open
+        low, high = -np.inf, np.inf
+        if lower / n_pairs - margin > 0:
+            low = summary["sketch"].quantile(lower / n_pairs - margin)
+        if upper / n_pairs + margin < 1:
+            high = summary["sketch"].quantile(upper / n_pairs + margin)
+        below, band = 0, []
+        for start in range(0, n_pairs, CHUNK_PAIRS):
+            chunk = np.asarray(condensed[start : start + CHUNK_PAIRS])
+            below += int(np.count_nonzero(chunk < low))
+            band.append(chunk[(chunk >= low) & (chunk <= high)])
+        band = np.sort(np.concatenate(band))
+        if below <= lower and upper < below + len(band):
+            break
+        # the sketch error exceeded its bound, widen the bracket
+        margin *= 2
+    lower_value, upper_value = band[lower - below], band[upper - below]
+    return lower_value + (upper_value - lower_value) * (position - lower)
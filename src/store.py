@@ -0,0 +1,348 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from cache import partial_path
+from distances import PAIR_KEYS
+from instrumentation import without_profile
+from visualization import layout_table, table_layout
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    dataset TEXT NOT NULL,
+    dataset_name TEXT,
+    parameters TEXT NOT NULL,
+    parent INTEGER,
+    summary TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_lookup ON runs (kind, dataset, parameters, parent);
+"""
+
+
+def to_json(value):
+    # numpy scalars and other non-JSON values of the result dicts
+    return json.dumps(
+        value,
+        sort_keys=True,
+        default=lambda v: v.item() if hasattr(v, "item") else str(v),
+    )
+
+
+class ResultStore:
+    """
+    Finished analyses on disk: one directory of Parquet and .npy files per run
+    and a SQLite index of the runs by dataset fingerprint and parameters.
+    Distances and neighbour arrays are loaded memory mapped. The distances are
+    kept once per distance key and hard linked into the runs that use them.
+    The oldest runs are deleted once the store exceeds `max_bytes` and runs
+    older than `max_age` seconds are deleted.
+    """
+
+    def __init__(self, directory, max_bytes=None, max_age=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(os.path.join(directory, "runs"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "distances"), exist_ok=True)
+        with self.connect() as connection:
+            connection.executescript(SCHEMA)
+
+    @contextmanager
+    def connect(self):
+        # a connection per call, the store is used from several session threads
+        connection = sqlite3.connect(
+            os.path.join(self.directory, "index.sqlite"), timeout=30
+        )
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    @contextmanager
+    def new_run_directory(self, run_id):
+        # a run only becomes visible to find() once all of its files are written
+        path = self.run_directory(run_id)
+        partial_path = f"{path}.partial"
+        os.makedirs(partial_path, exist_ok=True)
+        yield partial_path
+        os.replace(partial_path, path)
+
+    def run_directory(self, run_id):
+        return os.path.join(self.directory, "runs", str(run_id))
+
+    def insert(self, kind, dataset, dataset_name, parameters, parent, summary):
+        with self.connect() as connection:
+            cursor = connection.execute(
+                "INSERT INTO runs (kind, dataset, dataset_name, parameters, parent, "
+                "summary, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    kind,
+                    dataset,
+                    dataset_name,
+                    to_json(parameters),
+                    parent,
+                    to_json(summary),
+                    time.time(),
+                ),
+            )
+            return cursor.lastrowid
+
+    def find(self, kind, dataset, parameters, parent=None):
+        with self.connect() as connection:
+            row = connection.execute(
+                "SELECT id FROM runs WHERE kind = ? AND dataset = ? AND parameters = ? "
+                "AND parent IS ? ORDER BY id DESC LIMIT 1",
+                (kind, dataset, to_json(parameters), parent),
+            ).fetchone()
+        if row is None or not os.path.isdir(self.run_directory(row[0])):
+            return None
+        return row[0]
+
+    def summary(self, run_id):
+        with self.connect() as connection:
+            row = connection.execute(
+                "SELECT summary FROM runs WHERE id = ?", (run_id,)
+            ).fetchone()
+        return json.loads(row[0])
+
+    def history(self, dataset, kind="processing"):
+        """Earlier runs on a dataset, newest first, with their parameters."""
+        with self.connect() as connection:
+            history = pd.read_sql_query(
+                "SELECT id, dataset_name, parameters, created FROM runs "
+                "WHERE kind = ? AND dataset = ? ORDER BY id DESC",
+                connection,
+                params=(kind, dataset),
+            )
+        history["created"] = pd.to_datetime(history["created"], unit="s")
+        return history
+
+    def delete(self, run_id):
+        with self.connect() as connection:
+            children = connection.execute(
+                "SELECT id FROM runs WHERE parent = ?", (run_id,)
+            ).fetchall()
+            connection.execute(
+                "DELETE FROM runs WHERE id = ? OR parent = ?", (run_id, run_id)
+            )
+        for deleted in [run_id] + [child for child, in children]:
+            shutil.rmtree(self.run_directory(deleted), ignore_errors=True)
+        self.remove_unused_distances()
+
+    def distances_path(self, key):
+        name = hashlib.blake2b(to_json(key).encode(), digest_size=16).hexdigest()
+        return os.path.join(self.directory, "distances", f"{name}.npy")
+
+    def save_distances(self, key, condensed, path):
+        path = os.path.join(path, "condensed_distances.npy")
+        if key is None:
+            np.save(path, condensed)
+            return
+        shared_path = self.distances_path(key)
+        if not os.path.exists(shared_path):
+            partial = partial_path(shared_path)
+            with open(partial, "wb") as f:
+                np.save(f, condensed)
+            os.replace(partial, shared_path)
+        try:
+            os.link(shared_path, path)
+        except OSError:
+            # no hard links on this file system, or removed by a concurrent prune
+            np.save(path, condensed)
+
+    def remove_unused_distances(self):
+        # distances only linked from the distances directory belong to no run
+        for entry in os.scandir(os.path.join(self.directory, "distances")):
+            if entry.name.endswith(".npy") and entry.stat().st_nlink == 1:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+    def file_sizes(self):
+        """
+        The size of every file of the store by inode, so that hard linked distances
+        are counted once, and the inodes of each run directory.
+        """
+        sizes, run_files = {}, {}
+        for name in ("runs", "distances"):
+            top = os.path.join(self.directory, name)
+            for root, _, names in os.walk(top):
+                run = os.path.relpath(root, top).split(os.sep)[0]
+                for file_name in names:
+                    try:
+                        stat = os.stat(os.path.join(root, file_name))
+                    except OSError:
+                        continue
+                    inode = (stat.st_dev, stat.st_ino)
+                    sizes[inode] = stat.st_size
+                    if name == "runs":
+                        run_files.setdefault(run, set()).add(inode)
+        return sizes, run_files
+
+    def disk_usage(self):
+        sizes, _ = self.file_sizes()
+        return sum(sizes.values())
+
+    def prune(self, keep=None):
+        """Delete the oldest runs, except `keep`, down to the retention limits."""
+        if self.max_bytes is None and self.max_age is None:
+            return
+        with self.connect() as connection:
+            runs = connection.execute(
+                "SELECT id, parent, created FROM runs ORDER BY id"
+            ).fetchall()
+        children = {}
+        for run_id, parent, _ in runs:
+            if parent is not None:
+                children.setdefault(parent, []).append(str(run_id))
+        # the usage is measured once and reduced by the files of the deleted runs
+        sizes, run_files = self.file_sizes()
+        usage = sum(sizes.values())
+        links = {}
+        for inodes in run_files.values():
+            for inode in inodes:
+                links[inode] = links.get(inode, 0) + 1
+        for run_id, parent, created in runs:
+            if parent is not None or run_id == keep:
+                continue
+            expired = self.max_age is not None and created + self.max_age < time.time()
+            if not expired and (self.max_bytes is None or usage <= self.max_bytes):
+                break
+            self.delete(run_id)
+            for run in [str(run_id)] + children.get(run_id, []):
+                for inode in run_files.pop(run, ()):
+                    links[inode] -= 1
+                    # shared distances are removed with the last run linking them
+                    if links[inode] == 0:
+                        usage -= sizes[inode]
+
+    def save_processing(self, dataset, dataset_name, parameters, output):
+        result = output["result"]
+        summary = {
+            "metrics": output["metrics"],
+            "used_params": output["used_params"],
+            "warning_patients": output["warning_patients"],
+            "messages": output["messages"],
+            "eval_metrics": result["eval_metrics"],
+            "threshold": result["threshold"],
+            "square": bool(result.get("square")),
+            "performance": without_profile(output.get("performance")),
+            "distance_key": output.get("distance_key"),
+        }
+        run_id = self.insert(
+            "processing", dataset, dataset_name, parameters, None, summary
+        )
+        with self.new_run_directory(run_id) as path:
+            output["df_display"].to_parquet(os.path.join(path, "results.parquet"))
+            pd.DataFrame({"Sample_ID": result["sample_ids"]}).to_parquet(
+                os.path.join(path, "samples.parquet")
+            )
+            self.save_distances(
+                output.get("distance_key"), result["condensed_distances"], path
+            )
+            for name in ("neighbour_indices", "neighbour_distances"):
+                np.save(os.path.join(path, f"{name}.npy"), result[name])
+            for name, counts in result["sample_counts"].items():
+                np.save(os.path.join(path, f"sample_counts_{name}.npy"), counts)
+            for name, indices in result.get("pair_indices", {}).items():
+                np.save(os.path.join(path, f"pairs_{name}.npy"), indices)
+        self.prune(keep=run_id)
+        return run_id
+
+    def load_processing(self, run_id):
+        """The output of compute_results as it was saved under `run_id`."""
+        summary = self.summary(run_id)
+        path = self.run_directory(run_id)
+
+        def load(name):
+            return np.load(os.path.join(path, name), mmap_mode="r")
+
+        samples = pd.read_parquet(os.path.join(path, "samples.parquet"))
+        result = {
+            "eval_metrics": {
+                key: value
+                for key, value in summary["eval_metrics"].items()
+                if key not in PAIR_KEYS.values()
+            },
+            "threshold": summary["threshold"],
+            "sample_counts": {
+                name: load(f"sample_counts_{name}.npy") for name in ("TP", "FP", "FN")
+            },
+            "condensed_distances": load("condensed_distances.npy"),
+            "sample_ids": samples["Sample_ID"].to_numpy(),
+            "neighbour_indices": load("neighbour_indices.npy"),
+            "neighbour_distances": load("neighbour_distances.npy"),
+            "square": summary["square"],
+        }
+        if os.path.exists(os.path.join(path, "pairs_TP.npy")):
+            result["pair_indices"] = {
+                name: load(f"pairs_{name}.npy") for name in PAIR_KEYS
+            }
+        distance_key = summary.get("distance_key")
+        if distance_key is not None:
+            distance_key = tuple(distance_key)
+        return {
+            "df_display": pd.read_parquet(os.path.join(path, "results.parquet")),
+            "metrics": summary["metrics"],
+            "warning_patients": summary["warning_patients"],
+            "used_params": summary["used_params"],
+            "distance_key": distance_key,
+            "result": result,
+            "messages": summary["messages"],
+            "performance": summary.get("performance"),
+        }
+
+    def save_clustering(self, dataset, dataset_name, parameters, parent, clustering):
+        summary = {
+            "transitive_results": clustering["transitive_results"],
+            "performance": without_profile(clustering.get("performance")),
+        }
+        run_id = self.insert(
+            "clustering", dataset, dataset_name, parameters, parent, summary
+        )
+        with self.new_run_directory(run_id) as path:
+            pd.DataFrame(
+                list(clustering["cluster_assignment"].items()),
+                columns=["Sample", "Cluster"],
+            ).to_parquet(os.path.join(path, "cluster_assignment.parquet"))
+            for key in ("uncertain_nodes", "error_candidates"):
+                pd.DataFrame(list(clustering[key]), columns=["Sample"]).to_parquet(
+                    os.path.join(path, f"{key}.parquet")
+                )
+            layout = clustering["layout"]
+            layout_table(layout).to_parquet(os.path.join(path, "layout.parquet"))
+            np.save(os.path.join(path, "edges.npy"), layout["edges"])
+        self.prune(keep=parent)
+        return run_id
+
+    def load_clustering(self, run_id):
+        summary = self.summary(run_id)
+        path = self.run_directory(run_id)
+        assignment = pd.read_parquet(os.path.join(path, "cluster_assignment.parquet"))
+        clustering = {
+            "cluster_assignment": dict(
+                zip(assignment["Sample"], assignment["Cluster"])
+            ),
+            "transitive_results": summary["transitive_results"],
+            "performance": summary.get("performance"),
+        }
+        for key in ("uncertain_nodes", "error_candidates"):
+            samples = pd.read_parquet(os.path.join(path, f"{key}.parquet"))
+            clustering[key] = samples["Sample"].tolist()
+        clustering["layout"] = table_layout(
+            pd.read_parquet(os.path.join(path, "layout.parquet")),
+            np.load(os.path.join(path, "edges.npy"), mmap_mode="r"),
+        )
+        return clustering
@@ -1,5 +1,7 @@
 import streamlit as st
-from utils import reset_outputs, reset_clustering_outputs
+from ui.session import reset_outputs, reset_clustering_outputs
+from embedding import EMBEDDING_QUALITY, SCALABLE_METHODS
+from masked import DEFAULT_MIN_OVERLAP
 
 
 def parameters_interface():
@@ -66,12 +68,21 @@ def parameters_interface():
                 key="number_display_neighbours",
                 on_change=reset_outputs,
             )
+            # only changes how the table is shown, the results are kept
+            st.checkbox(
+                "Keep nearest neighbours and distances as list columns instead of text.",
+                key="neighbours_as_list",
+            )
 
         with left_col:
             df_ranking = st.session_state.get("df_protein_ranking")
 
+            max_n = len(st.session_state["df_protein_ranking"])
+            if st.session_state.get("ingest_top_n"):
+                # proteins beyond the loaded top n were never read from the file
+                max_n = min(max_n, st.session_state["ingest_top_n"])
             if df_ranking is not None and len(df_ranking) > 0:
-                default_value = min(20, len(df_ranking))
+                default_value = min(20, max_n)
             else:
                 # fallback if not available
                 default_value = 1
@@ -82,7 +93,7 @@ def parameters_interface():
             param_n = st.number_input(
                 "n :number of top n proteins from the ranking used for the distance calculation.",
                 min_value=1,
-                max_value=len(st.session_state["df_protein_ranking"]),
+                max_value=max_n,
                 value=default_value,
                 step=1,
                 key="param_n",
@@ -101,6 +112,23 @@ def parameters_interface():
                 on_change=reset_outputs,
             )
 
+            pairwise_complete = st.checkbox(
+                "Compare every sample pair over the proteins measured in both samples instead of imputing missing values with the protein mean.",
+                key="param_pairwise_complete",
+                on_change=reset_outputs,
+            )
+            param_min_overlap = None
+            if pairwise_complete:
+                if "param_min_overlap" not in st.session_state:
+                    st.session_state["param_min_overlap"] = DEFAULT_MIN_OVERLAP
+                param_min_overlap = st.number_input(
+                    "min_overlap: fewest shared proteins for a pair to get a distance. Pairs sharing fewer count as farthest apart.",
+                    min_value=1,
+                    step=1,
+                    key="param_min_overlap",
+                    on_change=reset_outputs,
+                )
+
             if "param_mode" not in st.session_state:
                 st.session_state["param_mode"] = "optimize parameters"
             param_mode = st.selectbox(
@@ -162,12 +190,27 @@ def parameters_interface():
             else:
                 st.session_state["param_optimization_metric"] = "F1"
 
+            param_n_max = None
+            if param_mode == "optimize parameters":
+                if "param_n_max" not in st.session_state:
+                    st.session_state["param_n_max"] = param_n
+                param_n_max = st.number_input(
+                    "n_max: also optimize n by sweeping it from n to n_max.",
+                    min_value=1,
+                    max_value=max_n,
+                    step=1,
+                    key="param_n_max",
+                    on_change=reset_outputs,
+                )
+
         parameters = {
             "param_evaluation_method": param_evaluation_method,
             "param_k": param_k,
             "param_n": param_n,
+            "param_n_max": param_n_max,
             "param_metric": param_metric,
             "param_fractional_p": param_fractional_p,
+            "param_min_overlap": param_min_overlap,
             "param_mode": param_mode,
             "param_optimization_metric": param_optimization_metric,
             "param_percentile": param_percentile,
@@ -208,18 +251,42 @@ def clustering_interface():
 
         if "param_method" not in st.session_state:
             st.session_state["param_method"] = "UMAP"
+        methods = ["UMAP", "PCA", "MDS", *SCALABLE_METHODS]
         param_method = st.selectbox(
             "Method for representing the clustering :",
-            ["UMAP", "PCA", "MDS"],
-            index=["UMAP", "PCA", "MDS"].index(st.session_state["param_method"]),
+            methods,
+            index=methods.index(st.session_state["param_method"]),
             key="param_method",
             on_change=reset_clustering_outputs,
+            help="The scalable methods only speed up the 2D embedding. The graph clustering by spqrp still builds the full square distance matrix, whose memory grows with the square of the number of samples, and cohorts computed out of core can not be clustered.",
         )
 
+        param_embedding_quality = None
+        param_embedding_seed = None
+        if param_method in SCALABLE_METHODS:
+            # landmarks of the MDS, power iterations of the PCA, UMAP sample size
+            param_embedding_quality = st.select_slider(
+                "Embedding quality: faster or more accurate for large cohorts.",
+                options=list(EMBEDDING_QUALITY),
+                value="balanced",
+                key="param_embedding_quality",
+                on_change=reset_clustering_outputs,
+            )
+            param_embedding_seed = st.number_input(
+                "Random seed of the embedding.",
+                min_value=0,
+                value=0,
+                step=1,
+                key="param_embedding_seed",
+                on_change=reset_clustering_outputs,
+            )
+
         parameters = {
             "param_n_cluster_neighbours": param_n_cluster_neighbours,
             "param_max_cluster_size": param_max_cluster_size,
             "param_method": param_method,
+            "param_embedding_quality": param_embedding_quality,
+            "param_embedding_seed": param_embedding_seed,
         }
         return parameters
     return None
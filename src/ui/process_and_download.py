@@ -1,6 +1,153 @@
+import json
 import streamlit as st
 import pandas as pd
-from data_processing import process_data, process_clustering
+from constants import (
+    JOB_POLL_SECONDS,
+    RESULT_STORE_DIR,
+    RESULT_STORE_MAX_AGE_SECONDS,
+    RESULT_STORE_MAX_BYTES,
+    VIEW_MAX_EDGES,
+    VIEW_MAX_POINTS,
+)
+from distances import result_neighbours
+from data_processing import (
+    dataset_fingerprint,
+    processing_error,
+    session_instrumentation,
+    session_protein_matrix,
+    status_progress,
+)
+from instrumentation import (
+    Instrumentation,
+    available_profilers,
+    performance_json,
+    performance_table,
+)
+from jobs import JobCancelled, cancel_job, job_status, pop_job_result, submit_job
+from pipeline import (
+    append_clustering,
+    append_results,
+    clustering_key,
+    compute_clustering,
+    compute_results,
+    missing_columns_error,
+    results_cache,
+    results_key,
+)
+from store import ResultStore
+from utils import with_neighbours
+from visualization import cluster_figure, layout_table
+
+FINISHED_JOB_STATES = ("done", "failed", "cancelled")
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def job_monitor(job_key, title):
+    """Progress of the background job under `job_key`, refreshed on its own."""
+    job_id = st.session_state.get(job_key)
+    if job_id is None:
+        return
+    status = job_status(job_id)
+    if status["state"] in FINISHED_JOB_STATES or status["state"] == "unknown":
+        # the full script run collects the result
+        st.rerun()
+    with st.status(f"🔍 {title}: {status['label']}...", expanded=True):
+        st.progress(status["fraction"], text=f"{status['elapsed']:.0f} s")
+        if st.button("Cancel", key=f"cancel_{job_key}"):
+            cancel_job(job_id)
+
+
+def collect_job(job_key):
+    """Result of the job under `job_key` once it has finished, otherwise None."""
+    job_id = st.session_state.get(job_key)
+    if job_id is None:
+        return None
+    state = job_status(job_id)["state"]
+    if state == "unknown":
+        # the server restarted since the job was submitted
+        st.session_state[job_key] = None
+        return None
+    if state not in FINISHED_JOB_STATES:
+        return None
+    st.session_state[job_key] = None
+    return pop_job_result(job_id)
+
+
+def profiler_select(key):
+    """The profiler chosen for the next run, None when it is not profiled."""
+    with st.expander("Profiling"):
+        profiler = st.selectbox(
+            "Profile the next run",
+            ["Off", *available_profilers()],
+            key=key,
+            help="Profiles the run and traces the memory of every stage. Profiled runs are always recomputed and run slower.",
+        )
+    return None if profiler == "Off" else profiler
+
+
+def render_performance(performance, name):
+    if not performance:
+        return
+    with st.expander("Performance"):
+        st.caption(f"Total {performance['total_seconds']:.2f} s")
+        st.dataframe(
+            performance_table(performance).style.format(
+                {
+                    "Seconds": "{:.3f}",
+                    "Share": "{:.0%}",
+                    "Stage peak RSS (MiB)": "{:.0f}",
+                    "Process-wide peak RSS (MiB)": "{:.0f}",
+                    "Peak traced (MiB)": "{:.1f}",
+                },
+                na_rep="",
+            ),
+            hide_index=True,
+        )
+        st.download_button(
+            label="Download Performance as JSON",
+            data=performance_json(performance),
+            file_name=f"{name}_performance.json",
+            mime="application/json",
+            key=f"{name}_performance_json",
+        )
+        if performance.get("profile"):
+            st.code(performance["profile"], language=None)
+        if performance.get("profile_stats"):
+            st.download_button(
+                label="Download cProfile Stats",
+                data=performance["profile_stats"],
+                file_name=f"{name}.prof",
+                mime="application/octet-stream",
+                key=f"{name}_profile_stats",
+            )
+
+
+def results_display_table():
+    """
+    The results table with the nearest neighbours of every sample. The session
+    only keeps the compact table, this one is rendered when shown and shared by
+    all sessions showing the same result.
+    """
+    df_display = st.session_state["df_display"]
+    if "Nearest Neighbors" in df_display.columns:
+        # loaded runs saved with their neighbour column
+        return df_display
+    neighbours_as_list = st.session_state.get("neighbours_as_list", False)
+    result = st.session_state["result_distances"]
+    result_key = st.session_state.get("result_key")
+    if result_key is None:
+        return with_neighbours(
+            df_display, result_neighbours(result), neighbours_as_list
+        )
+    key = ("display", result_key, neighbours_as_list)
+    table = results_cache().get(key)
+    if table is None:
+        table = results_cache().put(
+            key,
+            with_neighbours(df_display, result_neighbours(result), neighbours_as_list),
+            persist=False,
+        )
+    return table
 
 
 def render_results_summary():
@@ -16,6 +163,7 @@ def render_results_summary():
         with params_used_column:
             st.subheader("Used Parameters")
             st.json(st.session_state["params"])
+            render_performance(st.session_state.get("performance"), "processing")
         with overall_evaluation_column:
             if st.session_state.get("metrics") is not None:
                 st.subheader("📈 Evaluation Metrics (over all samples)")
@@ -28,17 +176,17 @@ def render_results_summary():
         st.subheader("📋 Results Scoring")
         patient_status_summary = (
             st.session_state["df_display"]
-            .groupby("Patient ID")["Sample Status"]
+            .groupby("Patient ID", observed=True)["Sample Status"]
             .apply(lambda statuses: " ".join(statuses))
             .reset_index(name="Samples Status Summary")
         )
         patient_summary = patient_status_summary
         st.dataframe(patient_summary)
 
-        st.dataframe(st.session_state["df_display"])
+        display_table = results_display_table()
+        st.dataframe(display_table)
 
-        download_df = st.session_state["df_display"].copy()
-        download_df = download_df.drop(columns=["Patient Status", "Sample Status"])
+        download_df = display_table.drop(columns=["Patient Status", "Sample Status"])
         csv = download_df.to_csv(index=False)
         st.download_button(
             label="Download table as CSV",
@@ -50,59 +198,351 @@ def render_results_summary():
         st.info("No data processed yet. Please upload and/ or configure your data.")
 
 
+@st.cache_resource
+def get_result_store():
+    return ResultStore(
+        RESULT_STORE_DIR, RESULT_STORE_MAX_BYTES, RESULT_STORE_MAX_AGE_SECONDS
+    )
+
+
+def find_processing_output(dataset, parameters):
+    """A finished analysis from the shared cache or the result store, else None."""
+    store = get_result_store()
+    key = results_key(dataset, parameters)
+    run_id = store.find("processing", dataset, parameters)
+    output = results_cache().get(key)
+    if output is None and run_id is not None:
+        output = results_cache().put(key, store.load_processing(run_id), persist=False)
+    elif output is not None and run_id is None:
+        run_id = save_processing_output(dataset, parameters, output)
+    return output, run_id
+
+
+def save_processing_output(dataset, parameters, output):
+    # the store keeps results on disk, the cache only holds them in memory
+    results_cache().put(results_key(dataset, parameters), output, persist=False)
+    return get_result_store().save_processing(
+        dataset, st.session_state.get("uploaded_file_name"), parameters, output
+    )
+
+
+def store_processing_output(output, key, run_id, message="Processing complete!"):
+    for warning in output["messages"]:
+        st.warning(warning)
+    st.session_state["result_distances"] = output["result"]
+    st.session_state["df_display"] = output["df_display"]
+    st.session_state["metrics"] = output["metrics"]
+    st.session_state["params"] = output["used_params"]
+    st.session_state["refresh_data"] = False
+    st.session_state["warning_patients"] = output["warning_patients"]
+    st.session_state["result_key"] = key
+    st.session_state["distance_key"] = output.get("distance_key")
+    st.session_state["result_run_id"] = run_id
+    st.session_state["performance"] = output.get("performance")
+    st.success(message)
+
+
 def run_processing_button(parameters):
     if (
         st.session_state["df"] is not None
         and st.session_state["df_protein_ranking"] is not None
     ):
-        if st.button("Run Processing"):
-            df_display, metrics, warning_patients, used_params, error = process_data(
-                st.session_state["df"],
-                st.session_state["df_protein_ranking"],
-                parameters,
+        output = None
+        try:
+            output = collect_job("processing_job")
+        except JobCancelled:
+            st.warning("Processing cancelled.")
+        except Exception as e:
+            st.error(processing_error(e))
+        if output is not None:
+            dataset, job_parameters = st.session_state["processing_job_request"]
+            run_id = save_processing_output(dataset, job_parameters, output)
+            store_processing_output(
+                output, results_key(dataset, job_parameters), run_id
             )
+        running = st.session_state.get("processing_job") is not None
+        profiler = profiler_select("processing_profiler")
+        if st.button("Run Processing", disabled=running):
+            error = missing_columns_error(
+                st.session_state["df"], st.session_state["df_protein_ranking"]
+            )
+            try:
+                if not error:
+                    dataset = dataset_fingerprint()
+                    # this or another session may have run the same analysis before
+                    cached, run_id = None, None
+                    if profiler is None:
+                        cached, run_id = find_processing_output(dataset, parameters)
+                    if cached is not None:
+                        store_processing_output(
+                            cached, results_key(dataset, parameters), run_id
+                        )
+                    else:
+                        instrumentation = session_instrumentation(profiler)
+                        with instrumentation.stage("Pivoting"):
+                            matrix = session_protein_matrix(
+                                st.session_state["df"],
+                                st.session_state["df_protein_ranking"],
+                            )
+                        st.session_state["processing_job"] = submit_job(
+                            compute_results,
+                            matrix,
+                            parameters,
+                            instrumentation=instrumentation,
+                        )
+                        st.session_state["processing_job_request"] = (
+                            dataset,
+                            parameters,
+                        )
+            except Exception as e:
+                error = processing_error(e)
             if error:
                 st.error(error)
-            else:
-                st.session_state["df_display"] = df_display
-                st.session_state["metrics"] = metrics
-                st.session_state["params"] = used_params
-                st.session_state["refresh_data"] = False
-                st.session_state["warning_patients"] = warning_patients
-                st.success("Processing complete!")
+        if st.session_state.get("processing_job") is not None:
+            job_monitor("processing_job", "Processing")
+        else:
+            run_append_button()
+        render_run_history()
     else:
         st.info(
             "⬆️ Please upload your protein data frame to enable parameter selection and processing."
         )
 
 
+def run_append_button():
+    """
+    Button to add the samples appended since the results shown to them, see
+    append_results. A clustering shown is extended to the new samples as well.
+    """
+    append_base = st.session_state.get("append_base")
+    result_key = st.session_state.get("result_key")
+    if (
+        append_base is None
+        or result_key is None
+        or result_key[0] != append_base["dataset"]
+    ):
+        return
+    st.info(
+        "Samples were appended since the results shown. Add them to the results with the same parameters and threshold, which only computes the distances of the new samples, or run the processing again on all samples."
+    )
+    if not st.button("Add Appended Samples"):
+        return
+    try:
+        matrix = session_protein_matrix(
+            st.session_state["df"], st.session_state["df_protein_ranking"]
+        )
+        parameters = dict(result_key[1])
+        base_output = {
+            "result": st.session_state["result_distances"],
+            "used_params": st.session_state["params"],
+        }
+        with st.status("🔍 Adding samples...", expanded=True) as status:
+            output = append_results(
+                matrix,
+                append_base["n_samples"],
+                base_output,
+                parameters,
+                state=st.session_state,
+                progress=status_progress(status),
+                instrumentation=Instrumentation(),
+            )
+            status.update(label="✅ Samples added!", state="complete")
+    except Exception as e:
+        st.error(processing_error(e))
+        return
+    dataset = dataset_fingerprint()
+    run_id = save_processing_output(dataset, parameters, output)
+    store_processing_output(
+        output,
+        results_key(dataset, parameters),
+        run_id,
+        f"Added {matrix.n_samples - append_base['n_samples']} samples.",
+    )
+    st.session_state["append_base"] = None
+    clustering = st.session_state.get("clustering_result")
+    if clustering is not None:
+        st.session_state["clustering_result"] = append_clustering(clustering, output)
+        # the next run of the same parameters clusters all samples again
+        st.session_state["last_params"] = None
+
+
+def render_run_history():
+    """Earlier runs on the current dataset, any of which can be loaded again."""
+    dataset = dataset_fingerprint()
+    history = get_result_store().history(dataset)
+    if history.empty:
+        return
+    with st.expander(f"Run history ({len(history)} runs on this dataset)"):
+        parameters = history["parameters"].map(json.loads)
+        st.dataframe(
+            pd.concat(
+                [history[["id", "created"]], pd.json_normalize(parameters.tolist())],
+                axis=1,
+            ),
+            hide_index=True,
+        )
+        run_id = st.selectbox(
+            "Run",
+            history["id"].tolist(),
+            format_func=lambda run_id: f"Run {run_id}",
+            key="history_run_id",
+        )
+        if st.button("Load run", key="load_history_run"):
+            run_parameters = parameters[history["id"] == run_id].iloc[0]
+            key = results_key(dataset, run_parameters)
+            output = results_cache().get(key)
+            if output is None:
+                output = results_cache().put(
+                    key, get_result_store().load_processing(run_id), persist=False
+                )
+            store_processing_output(output, key, run_id, f"Loaded run {run_id}.")
+
+
+def store_clustering_result(clustering_result, params):
+    st.session_state["clustering_result"] = clustering_result
+    st.session_state["last_params"] = params
+    st.success("✅ Clustering complete!")
+
+
+def find_clustering_result(key, params):
+    clustering_result = results_cache().get(key)
+    if clustering_result is None:
+        store = get_result_store()
+        run_id = store.find(
+            "clustering",
+            dataset_fingerprint(),
+            params,
+            parent=st.session_state.get("result_run_id"),
+        )
+        if run_id is not None:
+            clustering_result = results_cache().put(
+                key, store.load_clustering(run_id), persist=False
+            )
+    return clustering_result
+
+
 def run_clustering_button(parameters):
     """
-    Button to trigger clustering computation. Stores everything in st.session_state.
+    Button to queue the clustering computation. The result is stored in
+    st.session_state once the background job has finished.
     """
     if (
         st.session_state.get("df") is not None
         and st.session_state.get("df_protein_ranking") is not None
         and st.session_state.get("result_distances") is not None
     ):
-        if st.button("Run Clustering"):
-            result = st.session_state["result_distances"]
-            df = st.session_state["df"]
-            method = parameters["param_method"]
-            n_neighbors = parameters["param_n_cluster_neighbours"]
-            max_cluster_size = parameters["param_max_cluster_size"]
-
-            process_clustering(
-                result=result,
-                df=df,
-                method=method,
-                n_neighbors=n_neighbors,
-                max_cluster_size=max_cluster_size,
+        clustering_result = None
+        try:
+            clustering_result = collect_job("clustering_job")
+        except JobCancelled:
+            st.warning("Clustering cancelled.")
+        except Exception as e:
+            st.error(f"❌ An unexpected error occurred during clustering:\n{str(e)}")
+        if clustering_result is not None:
+            results_cache().put(
+                st.session_state["clustering_job_key"],
+                clustering_result,
+                persist=False,
             )
+            get_result_store().save_clustering(
+                dataset_fingerprint(),
+                st.session_state.get("uploaded_file_name"),
+                st.session_state["clustering_job_params"],
+                st.session_state.get("result_run_id"),
+                clustering_result,
+            )
+            store_clustering_result(
+                clustering_result, st.session_state["clustering_job_params"]
+            )
+        running = st.session_state.get("clustering_job") is not None
+        profiler = profiler_select("clustering_profiler")
+        if st.button("Run Clustering", disabled=running):
+            result = st.session_state["result_distances"]
+            current_params = {
+                "method": parameters["param_method"],
+                "n_neighbors": parameters["param_n_cluster_neighbours"],
+                "max_cluster_size": parameters["param_max_cluster_size"],
+                "embedding_quality": parameters["param_embedding_quality"],
+                "embedding_seed": parameters["param_embedding_seed"],
+            }
+            key = clustering_key(st.session_state.get("result_key"), current_params)
+
+            # Only recompute if clustering_result is missing or params changed
+            if not result.get("square"):
+                st.error(
+                    "Clustering needs the full distance matrix in memory, which is not built for cohorts computed out of core."
+                )
+            elif (
+                st.session_state.get("clustering_result") is None
+                or st.session_state.get("last_params") != current_params
+                or profiler is not None
+            ):
+                cached = None
+                if profiler is None:
+                    cached = find_clustering_result(key, current_params)
+                if cached is not None:
+                    store_clustering_result(cached, current_params)
+                else:
+                    used_params = st.session_state["params"]
+                    matrix = session_protein_matrix(
+                        st.session_state["df"], st.session_state["df_protein_ranking"]
+                    )
+                    st.session_state["clustering_job"] = submit_job(
+                        compute_clustering,
+                        result,
+                        st.session_state["df"],
+                        current_params["method"],
+                        current_params["n_neighbors"],
+                        current_params["max_cluster_size"],
+                        df_name=st.session_state["uploaded_file_name"],
+                        # graphs and embeddings only depend on the distances
+                        distance_id=st.session_state.get("distance_key"),
+                        values=matrix.top_n(used_params["n"]),
+                        embedding_options={
+                            "quality": current_params["embedding_quality"],
+                            "seed": current_params["embedding_seed"],
+                            "metric": used_params["metric"],
+                            "fractional_p": used_params["fractional_p"],
+                        },
+                        instrumentation=Instrumentation(profiler),
+                    )
+                    st.session_state["clustering_job_params"] = current_params
+                    st.session_state["clustering_job_key"] = key
+        if st.session_state.get("clustering_job") is not None:
+            job_monitor("clustering_job", "Clustering")
     else:
         st.info("⬆️ Please upload your data and run processing before clustering.")
 
 
+def render_cluster_view(layout, method):
+    n_samples = len(layout["sample_ids"])
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        max_points = n_samples
+        if n_samples > 1000:
+            max_points = st.slider(
+                "Samples drawn",
+                min_value=1000,
+                max_value=n_samples,
+                value=min(VIEW_MAX_POINTS, n_samples),
+                step=1000,
+                help="Large cohorts are thinned for drawing, uncertain samples and error candidates are always shown.",
+            )
+    with col2:
+        show_edges = st.checkbox("Show neighbour edges", value=True)
+    # only the arrays are sent to the browser, zooming and panning happen there
+    st.plotly_chart(
+        cluster_figure(layout, method, max_points, VIEW_MAX_EDGES, show_edges),
+        use_container_width=True,
+    )
+    st.download_button(
+        label="Download Cluster Layout as CSV",
+        data=layout_table(layout).to_csv(index=False).encode("utf-8"),
+        file_name=f"{method}_cluster_layout.csv",
+        mime="text/csv",
+    )
+
+
 def render_clustering_results():
     if (
         "clustering_result" in st.session_state
@@ -113,13 +553,9 @@ def render_clustering_results():
 
         # --- Figure ---
         st.subheader(f"Clustering Result ({method})")
-        st.image(cached["fig_bytes"])
-        st.download_button(
-            label="Download Clustering as PNG",
-            data=cached["fig_bytes"],
-            file_name=f"{method}_clustering.png",
-            mime="image/png",
-        )
+        render_cluster_view(cached["layout"], method)
+
+        render_performance(cached.get("performance"), "clustering")
 
         # --- Transitive results ---
         if cached["transitive_results"]:
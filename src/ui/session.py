@@ -0,0 +1,42 @@
+import streamlit as st
+
+from pipeline import persistent_caches
+
+
+@st.cache_resource
+def shared_caches():
+    # shared by all sessions of the server process and persisted under CACHE_DIR
+    return persistent_caches()
+
+
+def initialize_session_state():
+    default_state = {
+        "df": None,
+        "df_protein_ranking": None,
+        "df_display": None,
+        "metrics": None,
+        "params": {},
+        "refresh_data": False,
+        "warning_patients": [],
+        "param_k": 1,
+        "param_n": 20,
+        "number_display_neighbours": 4,
+        "result_distances": None,
+        "df_fingerprint": None,
+        "ranking_fingerprint": None,
+        "processing_job": None,
+        "clustering_job": None,
+    }
+
+    for key, default_value in default_state.items():
+        if key not in st.session_state:
+            st.session_state[key] = default_value
+
+
+def reset_outputs():
+    st.session_state["df_display"] = None
+    st.session_state["formatted_metrics"] = None
+
+
+def reset_clustering_outputs():
+    st.session_state["clustering_result"] = None
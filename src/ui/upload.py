@@ -1,40 +1,106 @@
 import streamlit as st
 import os
-import pandas as pd
 
 from constants import DEFAULT_RANKING_FILE
+from data_processing import append_session_samples, forget_session_jobs
+from instrumentation import Instrumentation
+from pipeline import get_cache
+from ingest import (
+    TABLE_FORMATS,
+    detect_format,
+    load_cached,
+    load_protein_table,
+    read_protein_table,
+    read_ranking_csv,
+)
+from utils import top_ranked_proteins
 
 
-def upload_and_preview_data():
-    # --- Protein Data Frame Upload Section ---
-    st.subheader("Step 1: Upload Your Protein Data Frame")
-    if "df" not in st.session_state:
-        st.session_state["df"] = None
+def append_samples_interface(ingest_cache):
+    with st.expander("Add samples to the current analysis"):
+        new_file = st.file_uploader(
+            "Upload new plates or samples in the same format (CSV, Parquet or Arrow/Feather)",
+            type=[extension.lstrip(".") for extension in TABLE_FORMATS],
+            key="append_df_uploader",
+            help="The samples are appended to the loaded data frame. The results can then be updated with only the distances of the new samples, instead of processing all samples again.",
+        )
+        if st.session_state.get("df_protein_ranking") is None:
+            return
+        if new_file is not None and st.button("Append samples", key="append_samples"):
+            try:
+                new_df, new_fingerprint = load_cached(
+                    ingest_cache,
+                    new_file.getvalue(),
+                    read_protein_table,
+                    fmt=detect_format(new_file.name),
+                )
+                append_session_samples(new_df, new_fingerprint, new_file.name)
+            except Exception as e:
+                st.error(f"❌ Could not append `{new_file.name}`:\n{str(e)}")
+            else:
+                st.success(
+                    f"Appended {new_df['Sample_ID'].nunique()} samples of `{new_file.name}`."
+                )
 
-    uploaded_file = st.file_uploader(
-        "Upload data frame CSV File (required)",
-        type=["csv"],
-        key="protein_df_uploader",
-        help="You must upload your main protein data frame here.",
-    )
 
+def protein_table_section(ingest_cache, uploaded_file, local_path, ingest_top_n):
+    proteins = None
+    if ingest_top_n > 0:
+        if st.session_state.get("df_protein_ranking") is not None:
+            proteins = top_ranked_proteins(
+                st.session_state["df_protein_ranking"], ingest_top_n
+            )
+        else:
+            st.warning(
+                "No protein ranking loaded yet, loading all proteins of the data frame."
+            )
+
+    source, source_name = None, None
     if uploaded_file is not None:
-        df = pd.read_csv(uploaded_file)
-        st.session_state["df"] = df
-        st.session_state["uploaded_file_name"] = uploaded_file.name
-        st.success(f"Protein data frame uploaded: `{uploaded_file.name}`")
-        st.session_state["formatted_metrics"] = None
+        source, source_name = uploaded_file.getvalue(), uploaded_file.name
+    elif local_path:
+        if os.path.isfile(local_path):
+            source, source_name = local_path, os.path.basename(local_path)
+        else:
+            st.error(f"File not found: `{local_path}`")
+
+    if source is not None:
+        instrumentation = Instrumentation()
+        try:
+            with instrumentation.stage("Parsing"):
+                df, fingerprint = load_protein_table(
+                    ingest_cache, source, detect_format(source_name), proteins
+                )
+        except Exception as e:
+            st.error(f"❌ Could not read `{source_name}`:\n{str(e)}")
+        else:
+            # samples appended to this file stay until another file is loaded
+            if fingerprint != st.session_state.get("appended_to"):
+                # reruns read the frame from the cache, only a new file is timed
+                if fingerprint != st.session_state.get("df_fingerprint"):
+                    st.session_state["ingest_stages"] = instrumentation.stages
+                    forget_session_jobs()
+                st.session_state["df"] = df
+                st.session_state["df_fingerprint"] = fingerprint
+                st.session_state["uploaded_file_name"] = source_name
+                st.session_state["appended_to"] = None
+                st.session_state["append_base"] = None
+            st.success(f"Protein data frame loaded: `{source_name}`")
+            st.session_state["formatted_metrics"] = None
     elif st.session_state["df"] is not None:
         st.info(
             f"Using previously uploaded data frame: `{st.session_state.get('uploaded_file_name', 'Unnamed file')}`"
         )
     else:
-        st.warning("⚠️ Please upload your protein data frame CSV file to proceed.")
+        st.warning("⚠️ Please upload your protein data frame file to proceed.")
 
     if st.session_state["df"] is not None:
         st.write("Preview of uploaded protein intensity data:")
         st.dataframe(st.session_state["df"].head())
+        append_samples_interface(ingest_cache)
+
 
+def protein_ranking_section(ingest_cache):
     # --- Protein Ranking Upload Section ---
     st.subheader("Step 2: Upload or Use Default Protein Ranking")
     current_dir = os.path.dirname(__file__)
@@ -52,8 +118,11 @@ def upload_and_preview_data():
     )
 
     if uploaded_protein_ranking is not None:
-        df_protein_ranking = pd.read_csv(uploaded_protein_ranking)
+        df_protein_ranking, fingerprint = load_cached(
+            ingest_cache, uploaded_protein_ranking.getvalue(), read_ranking_csv
+        )
         st.session_state["df_protein_ranking"] = df_protein_ranking
+        st.session_state["ranking_fingerprint"] = fingerprint
         st.session_state["ranking_file_name"] = uploaded_protein_ranking.name
         st.success(f"Protein ranking file uploaded: `{uploaded_protein_ranking.name}`")
     elif (
@@ -64,9 +133,13 @@ def upload_and_preview_data():
         name = st.session_state.get("ranking_file_name", "Default ranking file")
         st.info(f"Using previously loaded ranking file: `{name}`")
     elif os.path.exists(default_file_path):
-        df_protein_ranking = pd.read_csv(default_file_path)
+        with open(default_file_path, "rb") as f:
+            df_protein_ranking, fingerprint = load_cached(
+                ingest_cache, f.read(), read_ranking_csv
+            )
         st.session_state["ranking_file_name"] = DEFAULT_RANKING_FILE
         st.session_state["df_protein_ranking"] = df_protein_ranking
+        st.session_state["ranking_fingerprint"] = fingerprint
         st.info(
             f"Using default protein ranking file from data folder {DEFAULT_RANKING_FILE}."
         )
@@ -85,4 +158,41 @@ def upload_and_preview_data():
             height=100,
             use_container_width=True,
         )
+
+
+def upload_and_preview_data():
+    # --- Protein Data Frame Upload Section ---
+    st.subheader("Step 1: Upload Your Protein Data Frame")
+    if "df" not in st.session_state:
+        st.session_state["df"] = None
+    # parsed frames are shared by every session that opens the same file
+    ingest_cache = get_cache("ingest")
+
+    uploaded_file = st.file_uploader(
+        "Upload data frame CSV, Parquet or Arrow/Feather File (required)",
+        type=[extension.lstrip(".") for extension in TABLE_FORMATS],
+        key="protein_df_uploader",
+        help="You must upload your main protein data frame here.",
+    )
+
+    with st.expander("Large data frames"):
+        local_path = st.text_input(
+            "Load the data frame from a local file path instead (CSV, Parquet or Arrow/Feather)",
+            key="protein_df_path",
+            help="For files too large for the browser upload. The path is read on the machine running the app.",
+        )
+        if "ingest_top_n" not in st.session_state:
+            st.session_state["ingest_top_n"] = 0
+        ingest_top_n = st.number_input(
+            "Only load the top n proteins of the protein ranking (0 loads all proteins).",
+            min_value=0,
+            step=1,
+            key="ingest_top_n",
+        )
+
+    # the ranking is read first, as it selects the proteins loaded from the table
+    table_section = st.container()
+    protein_ranking_section(ingest_cache)
+    with table_section:
+        protein_table_section(ingest_cache, uploaded_file, local_path, ingest_top_n)
     st.divider()
@@ -1,34 +1,7 @@
-import streamlit as st
-from collections import defaultdict
+import warnings
 
-
-def initialize_session_state():
-    default_state = {
-        "df": None,
-        "df_protein_ranking": None,
-        "df_display": None,
-        "metrics": None,
-        "params": {},
-        "refresh_data": False,
-        "warning_patients": [],
-        "param_k": 1,
-        "param_n": 20,
-        "number_display_neighbours": 4,
-        "result_distances": None,
-    }
-
-    for key, default_value in default_state.items():
-        if key not in st.session_state:
-            st.session_state[key] = default_value
-
-
-def reset_outputs():
-    st.session_state["df_display"] = None
-    st.session_state["formatted_metrics"] = None
-
-
-def reset_clustering_outputs():
-    st.session_state["clustering_result"] = None
+import numpy as np
+import pandas as pd
 
 
 def get_missing_columns(required_columns, df):
@@ -39,21 +12,22 @@ def get_missing_columns(required_columns, df):
     return missing_columns
 
 
+def top_ranked_proteins(prot_ranking, n):
+    return tuple(prot_ranking["Protein"].head(n))
+
+
 def sum_up_per_sample(pairs, d):
-    for pair in pairs:
-        p1, p2 = pair
-        d[p1] = d.get(p1, 0) + 1
-        d[p2] = d.get(p2, 0) + 1
+    if len(pairs) == 0:
+        return d
+    counts = pd.Series(np.asarray(pairs, dtype=object).ravel()).value_counts()
+    for sample, count in counts.items():
+        d[sample] = d.get(sample, 0) + int(count)
     return d
 
 
-def f1_color(f1):
-    if f1 >= 0.8:
-        return "🟢"
-    elif f1 >= 0.5:
-        return "🟡"
-    else:
-        return "🔴"
+def f1_colors(f1):
+    f1 = np.asarray(f1, dtype=np.float64)
+    return np.select([f1 >= 0.8, f1 >= 0.5], ["🟢", "🟡"], default="🔴")
 
 
 def format_neighbors_with_distances(row):
@@ -66,125 +40,195 @@ def format_neighbors_with_distances(row):
     return ", ".join(neighbors)
 
 
-def calculate_f1_based_on_nn_neighbour(df, neighbors_df, sample_patient_mapping, n):
+def format_neighbors_column(neighbors_df):
+    """format_neighbors_with_distances over all rows, one column pair at a time."""
+    neighbors = neighbors_df.iloc[:, 0::2].astype(str)
+    distances = neighbors_df.iloc[:, 1::2].astype(str)
+    formatted = neighbors.iloc[:, 0] + " (" + distances.iloc[:, 0] + ")"
+    for i in range(1, neighbors.shape[1]):
+        formatted = (
+            formatted + ", " + neighbors.iloc[:, i] + " (" + distances.iloc[:, i] + ")"
+        )
+    return formatted
+
+
+def build_results_table(
+    F1_per_sample,
+    F1_per_patient,
+    sample_patient_mapping,
+    nearest_neighbours=None,
+    neighbours_as_list=False,
+):
+    """
+    One row per sample, grouped by patient in the order of `F1_per_patient`,
+    with categorical ID and status columns. The neighbour columns are only
+    added with `nearest_neighbours`, see with_neighbours.
+    """
+    sample_patients = pd.Series(sample_patient_mapping)
+    patient_position = pd.Index(list(F1_per_patient)).get_indexer(
+        sample_patients.to_numpy()
+    )
+    keep = np.flatnonzero(patient_position >= 0)
+    order = keep[np.argsort(patient_position[keep], kind="stable")]
+    sample_patients = sample_patients.iloc[order]
+    samples = sample_patients.index
+
+    patient_f1 = sample_patients.map(F1_per_patient).to_numpy()
+    sample_f1 = samples.map(F1_per_sample).to_numpy()
+
+    df_display = pd.DataFrame(
+        {
+            "Patient ID": pd.Categorical(sample_patients.to_numpy()),
+            "Patient F1": patient_f1,
+            "Patient Status": pd.Categorical(f1_colors(patient_f1)),
+            "Sample ID": pd.Categorical(samples.to_numpy()),
+            "Sample F1": sample_f1,
+            "Sample Status": pd.Categorical(f1_colors(sample_f1)),
+        }
+    )
+    if nearest_neighbours is None:
+        return df_display
+    return with_neighbours(df_display, nearest_neighbours, neighbours_as_list)
+
+
+def with_neighbours(df_display, nearest_neighbours, neighbours_as_list=False):
+    """
+    A copy of the results table with the nearest neighbours of every sample.
+    With `neighbours_as_list` the neighbours and their distances are kept as list
+    columns instead of one formatted string.
+    """
+    df_display = df_display.copy()
+    neighbours = nearest_neighbours.reindex(df_display["Sample ID"].to_numpy())
+    if neighbours_as_list:
+        df_display["Nearest Neighbors"] = neighbours.iloc[:, 0::2].to_numpy().tolist()
+        df_display["Neighbor Distances"] = neighbours.iloc[:, 1::2].to_numpy().tolist()
+    else:
+        df_display["Nearest Neighbors"] = format_neighbors_column(neighbours).to_numpy()
+    return df_display
 
-    tp_per_sample = dict()
-    fp_per_sample = defaultdict(int)
-    fn_per_sample = dict()
 
-    # subset of dataframe with only nearest neighbors and not distances
+def nn_counts_per_k(neighbors_df, sample_ids, patient_codes):
+    """
+    TP/FP/FN per sample for every k from 1 to the number of retrieved neighbours.
+    Returns arrays of shape (samples, k) with rows in `sample_ids` order.
+    """
     neighbor_cols = [col for col in neighbors_df.columns if col.startswith("Neighbor")]
-    neighbors_df = neighbors_df[neighbor_cols]
-    max_n = len(neighbors_df.columns)
-    if n > max_n:
-        st.warning(
-            f"k (number nearest neighbours for scoring):{n} larger then number of retrieved nearest neighbors. Using the maximal number of neighbors available: {len(neighbors_df.columns)}."
-        )
-        n = len(neighbors_df.columns)
-    neighbors = neighbors_df.iloc[:, :n]
-
-    patient_to_samples = defaultdict(list)
-    warning_patients = []
-
-    for sample, patient in sample_patient_mapping.items():
-        patient_to_samples[patient].append(sample)
-    for patient, samples in patient_to_samples.items():
-        if len(samples) <= n:
-            warning_patients.append(patient)
-
-    for sample in neighbors.index:
-        # get nearest neighbors
-        nn = neighbors.loc[sample]
-        patient = sample_patient_mapping[sample]
-
-        for n in nn:
-            n_patient = sample_patient_mapping[n]
-            if n_patient != patient:
-                fp_per_sample[sample] = fp_per_sample.get(sample, 0) + 1
-            elif n_patient == patient:
-                tp_per_sample[sample] = tp_per_sample.get(sample, 0) + 1
-
-        samples_per_patient = patient_to_samples[patient]
-
-        fn_per_sample[sample] = (
-            len(samples_per_patient) - 1 - tp_per_sample.get(sample, 0)
-        )
-    F1_per_sample, F1_per_patient = calculate_f1_scores(
-        df, tp_per_sample, fp_per_sample, fn_per_sample, sample_patient_mapping
+    neighbor_ids = neighbors_df[neighbor_cols].to_numpy()
+    samples = pd.Index(sample_ids)
+    rows = samples.get_indexer(neighbors_df.index)
+    neighbor_codes = samples.get_indexer(neighbor_ids.ravel()).reshape(
+        neighbor_ids.shape
     )
+    return nn_counts_from_indices(rows, neighbor_codes, patient_codes)
 
-    return F1_per_sample, F1_per_patient, warning_patients
 
+def nn_counts_from_indices(rows, neighbor_codes, patient_codes):
+    """nn_counts_per_k of the neighbour sample positions of the samples `rows`."""
+    own_patients = patient_codes[rows]
+    matches = patient_codes[neighbor_codes] == own_patients[:, None]
+    patient_sizes = np.bincount(patient_codes)
 
-def calculate_f1_scores(
-    df, tp_per_sample, fp_per_sample, fn_per_sample, sample_patient_mapping
+    shape = (len(patient_codes), neighbor_codes.shape[1])
+    tp, fp, fn = (np.zeros(shape, dtype=np.int32) for _ in range(3))
+    tp[rows] = np.cumsum(matches, axis=1)
+    fp[rows] = np.arange(1, shape[1] + 1) - tp[rows]
+    fn[rows] = (patient_sizes[own_patients] - 1)[:, None] - tp[rows]
+    return {"TP": tp, "FP": fp, "FN": fn}
+
+
+def nn_k_message(n, nn_counts):
+    max_n = nn_counts["TP"].shape[1]
+    if n > max_n:
+        return f"k (number nearest neighbours for scoring):{n} larger then number of retrieved nearest neighbors. Using the maximal number of neighbors available: {max_n}."
+    return None
+
+
+def calculate_f1_based_on_nn_counts(
+    nn_counts, sample_ids, patient_ids, patient_codes, n
 ):
-    tp_per_patient = defaultdict(int)
-    fp_per_patient = defaultdict(int)
-    fn_per_patient = defaultdict(int)
-    F1_per_sample = dict()
-    F1_per_patient = dict()
-    for sample in df["Sample_ID"].unique():
-        current_tp = tp_per_sample[sample] if sample in tp_per_sample else 0
-        current_fp = fp_per_sample[sample] if sample in fp_per_sample else 0
-        current_fn = fn_per_sample[sample] if sample in fn_per_sample else 0
-        precision = (
-            current_tp / (current_tp + current_fp)
-            if (current_tp + current_fp) > 0
-            else 0
-        )
-        sensitivity = (
-            current_tp / (current_tp + current_fn)
-            if (current_tp + current_fn) > 0
-            else 0
-        )
-        F1 = (
-            2 * ((precision * sensitivity) / (precision + sensitivity))
-            if (precision + sensitivity) > 0
-            else 0
-        )
+    # callers clip k to the retrieved neighbours and warn about it
+    n = min(n, nn_counts["TP"].shape[1])
+    patient_sizes = np.bincount(patient_codes, minlength=len(patient_ids))
+    warning_patients = list(np.asarray(patient_ids, dtype=object)[patient_sizes <= n])
+
+    F1_per_sample, F1_per_patient = f1_per_sample_and_patient(
+        sample_ids,
+        patient_ids,
+        patient_codes,
+        nn_counts["TP"][:, n - 1],
+        nn_counts["FP"][:, n - 1],
+        nn_counts["FN"][:, n - 1],
+    )
+    return F1_per_sample, F1_per_patient, warning_patients
 
-        patient = sample_patient_mapping[sample]
-        tp_per_patient[patient] = tp_per_patient.get(patient, 0) + current_tp
-        fp_per_patient[patient] = fp_per_patient.get(patient, 0) + current_fp
-        fn_per_patient[patient] = fn_per_patient.get(patient, 0) + current_fn
-
-        F1_per_sample[sample] = F1
-
-    for patient in df["Patient_ID"].unique():
-        current_tp = tp_per_patient[patient]
-        current_fp = fp_per_patient[patient]
-        current_fn = fn_per_patient[patient]
-        precision = (
-            current_tp / (current_tp + current_fp)
-            if (current_tp + current_fp) > 0
-            else 0
-        )
-        sensitivity = (
-            current_tp / (current_tp + current_fn)
-            if (current_tp + current_fn) > 0
-            else 0
-        )
-        F1 = (
-            2 * ((precision * sensitivity) / (precision + sensitivity))
-            if (precision + sensitivity) > 0
-            else 0
-        )
-        F1_per_patient[patient] = F1
 
+def sample_patient_codes(df, sample_patient_mapping):
+    samples = pd.Index(df["Sample_ID"].unique())
+    patients = pd.Index(df["Patient_ID"].unique())
+    patient_codes = patients.get_indexer(
+        pd.Series(sample_patient_mapping).reindex(samples)
+    )
+    return samples, patients, patient_codes
+
+
+def calculate_f1_based_on_nn_neighbour(df, neighbors_df, sample_patient_mapping, n):
+    samples, patients, patient_codes = sample_patient_codes(df, sample_patient_mapping)
+    nn_counts = nn_counts_per_k(neighbors_df, samples, patient_codes)
+    message = nn_k_message(n, nn_counts)
+    if message:
+        warnings.warn(message)
+    return calculate_f1_based_on_nn_counts(
+        nn_counts, samples, patients, patient_codes, n
+    )
+
+
+def f1_from_counts(tp, fp, fn):
+    tp, fp, fn = (np.asarray(c, dtype=np.float64) for c in (tp, fp, fn))
+    zeros = np.zeros_like(tp)
+    precision = np.divide(tp, tp + fp, out=zeros.copy(), where=(tp + fp) > 0)
+    sensitivity = np.divide(tp, tp + fn, out=zeros.copy(), where=(tp + fn) > 0)
+    return 2 * np.divide(
+        precision * sensitivity,
+        precision + sensitivity,
+        out=zeros,
+        where=(precision + sensitivity) > 0,
+    )
+
+
+def f1_per_sample_and_patient(sample_ids, patient_ids, patient_codes, tp, fp, fn):
+    """
+    F1 per sample and per patient from per-sample TP/FP/FN count arrays.
+    `patient_codes` maps every sample to its position in `patient_ids`.
+    """
+    f1_samples = f1_from_counts(tp, fp, fn)
+    n_patients = len(patient_ids)
+    f1_patients = f1_from_counts(
+        *(
+            np.bincount(patient_codes, weights=counts, minlength=n_patients)
+            for counts in (tp, fp, fn)
+        )
+    )
+    F1_per_sample = dict(zip(sample_ids, f1_samples.tolist()))
+    F1_per_patient = dict(zip(patient_ids, f1_patients.tolist()))
     return F1_per_sample, F1_per_patient
 
 
+def calculate_f1_scores(
+    df, tp_per_sample, fp_per_sample, fn_per_sample, sample_patient_mapping
+):
+    samples, patients, patient_codes = sample_patient_codes(df, sample_patient_mapping)
+    tp, fp, fn = (
+        pd.Series(counts, dtype=np.float64).reindex(samples, fill_value=0).to_numpy()
+        for counts in (tp_per_sample, fp_per_sample, fn_per_sample)
+    )
+    return f1_per_sample_and_patient(samples, patients, patient_codes, tp, fp, fn)
+
+
 def calculate_f1_based_on_cutoff(df, tp, fp, tn, fn, sample_patient_mapping):
-    tp_per_sample = dict()
-    fp_per_sample = dict()
-    tn_per_sample = dict()
-    fn_per_sample = dict()
-
-    tp_per_sample = sum_up_per_sample(tp, tp_per_sample)
-    fp_per_sample = sum_up_per_sample(fp, fp_per_sample)
-    tn_per_sample = sum_up_per_sample(tn, tn_per_sample)
-    fn_per_sample = sum_up_per_sample(fn, fn_per_sample)
+    # true negatives do not enter the F1 score and are not counted
+    tp_per_sample = sum_up_per_sample(tp, dict())
+    fp_per_sample = sum_up_per_sample(fp, dict())
+    fn_per_sample = sum_up_per_sample(fn, dict())
 
     F1_per_sample, F1_per_patient = calculate_f1_scores(
         df, tp_per_sample, fp_per_sample, fn_per_sample, sample_patient_mapping
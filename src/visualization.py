@@ -0,0 +1,293 @@
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+from plotly.colors import qualitative
+
+from embedding import layout_coordinates
+
+# bits of the per-sample flags of a cluster layout
+UNCERTAIN = 1
+ERROR_CANDIDATE = 2
+
+CLUSTER_COLOURS = qualitative.Dark24
+
+
+def sample_positions(index, samples):
+    positions = index.get_indexer(list(samples) if samples is not None else [])
+    return positions[positions >= 0]
+
+
+def cluster_layout(
+    g, coords_2d, sample_ids, cluster_assignment, uncertain_nodes, error_candidates
+):
+    """
+    Everything the interactive cluster view draws, as compact arrays in sample
+    order: float32 coordinates, cluster codes (-1 for unclustered samples),
+    uncertain / error candidate flags and the graph edges as index pairs.
+    """
+    sample_ids = np.asarray(sample_ids)
+    index = pd.Index(sample_ids)
+    codes, clusters = pd.factorize(pd.Series(sample_ids).map(cluster_assignment))
+
+    flags = np.zeros(len(sample_ids), dtype=np.uint8)
+    flags[sample_positions(index, uncertain_nodes)] |= UNCERTAIN
+    flags[sample_positions(index, error_candidates)] |= ERROR_CANDIDATE
+
+    pairs = list(g.edges()) if g is not None else []
+    edges = np.column_stack(
+        [
+            index.get_indexer([a for a, _ in pairs]),
+            index.get_indexer([b for _, b in pairs]),
+        ]
+    ).reshape(-1, 2)
+    return {
+        "sample_ids": sample_ids,
+        "coords": layout_coordinates(coords_2d, sample_ids).astype(np.float32),
+        "codes": codes.astype(np.int32),
+        "clusters": np.asarray(clusters),
+        "flags": flags,
+        "edges": edges[(edges >= 0).all(axis=1)].astype(np.int32),
+    }
+
+
+def appended_layout(layout, sample_ids, base_neighbours):
+    """
+    `layout` with appended samples, without clustering again: every new sample
+    joins the cluster most of its nearest earlier samples (`base_neighbours`,
+    their positions in the layout) are in, is drawn at their mean position and
+    linked to those in its cluster. New samples whose neighbours are not all in
+    that cluster are flagged as uncertain.
+    """
+    n_old, n_new = len(layout["codes"]), len(base_neighbours)
+    neighbour_codes = layout["codes"][base_neighbours]
+    # votes per cluster, unclustered neighbours in the first column
+    votes = np.zeros((n_new, len(layout["clusters"]) + 1), dtype=np.int32)
+    np.add.at(votes, (np.arange(n_new)[:, None], neighbour_codes + 1), 1)
+    codes = np.where(votes[:, 1:].max(axis=1) > 0, votes[:, 1:].argmax(axis=1), -1)
+    agree = votes[np.arange(n_new), codes + 1] == base_neighbours.shape[1]
+    flags = np.where(agree & (codes >= 0), 0, UNCERTAIN).astype(np.uint8)
+
+    same_cluster = (neighbour_codes == codes[:, None]) & (codes[:, None] >= 0)
+    rows, slots = np.nonzero(same_cluster)
+    edges = np.column_stack([n_old + rows, base_neighbours[rows, slots]])
+    return {
+        "sample_ids": np.concatenate([layout["sample_ids"], sample_ids]),
+        "coords": np.concatenate(
+            [
+                layout["coords"],
+                layout["coords"][base_neighbours].mean(axis=1).astype(np.float32),
+            ]
+        ),
+        "codes": np.concatenate([layout["codes"], codes]).astype(np.int32),
+        "clusters": layout["clusters"],
+        "flags": np.concatenate([layout["flags"], flags]),
+        "edges": np.concatenate([layout["edges"], edges]).astype(np.int32),
+    }
+
+
+def cluster_labels(layout, points):
+    codes = layout["codes"][points]
+    labels = np.full(len(points), None, dtype=object)
+    labels[codes >= 0] = layout["clusters"][codes[codes >= 0]]
+    return labels
+
+
+def thin_points(coords, budget, seed=0):
+    """
+    At most `budget` of the points, at most one per cell of a grid over their
+    extent, so that sparse regions and outliers survive the downsampling.
+    """
+    n_points = len(coords)
+    if n_points <= budget:
+        return np.arange(n_points)
+    order = np.random.default_rng(seed).permutation(n_points)
+    side = max(int(np.sqrt(budget)), 1)
+    low = np.nanmin(coords, axis=0)
+    span = np.nanmax(coords, axis=0) - low
+    span[~(span > 0)] = 1.0
+    cells = np.nan_to_num((coords[order] - low) / span * side).astype(np.int64)
+    cells = np.clip(cells, 0, side - 1)
+    _, first = np.unique(cells[:, 0] * side + cells[:, 1], return_index=True)
+    kept = order[first]
+    # fill the budget left by empty cells with random points
+    rest = order[~np.isin(order, kept)]
+    return np.sort(np.concatenate([kept, rest[: budget - len(kept)]]))
+
+
+def level_of_detail(layout, max_points, max_edges, seed=0):
+    """
+    Indices of the points and edges drawn. Uncertain samples and error
+    candidates are always kept, the remaining points are thinned to
+    `max_points` and the edges between kept points to `max_edges`, edges
+    touching a flagged sample first.
+    """
+    flagged = layout["flags"] > 0
+    others = np.flatnonzero(~flagged)
+    budget = max(max_points - int(flagged.sum()), 0)
+    kept = np.sort(
+        np.concatenate(
+            [
+                np.flatnonzero(flagged),
+                others[thin_points(layout["coords"][others], budget, seed)],
+            ]
+        )
+    )
+
+    is_kept = np.zeros(len(flagged), dtype=bool)
+    is_kept[kept] = True
+    edges = layout["edges"]
+    candidates = np.flatnonzero(is_kept[edges].all(axis=1))
+    if len(candidates) > max_edges:
+        rng = np.random.default_rng(seed)
+        priority = flagged[edges[candidates]].any(axis=1)
+        order = np.concatenate(
+            [
+                rng.permutation(candidates[priority]),
+                rng.permutation(candidates[~priority]),
+            ]
+        )
+        candidates = np.sort(order[:max_edges])
+    return kept, candidates
+
+
+def edge_segments(coords, edges):
+    # one line trace for all edges, the segments separated by NaN
+    segments = np.full((len(edges), 3, 2), np.nan, dtype=np.float32)
+    segments[:, 0] = coords[edges[:, 0]]
+    segments[:, 1] = coords[edges[:, 1]]
+    return segments.reshape(-1, 2)
+
+
+def points_trace(layout, points, name, marker):
+    return go.Scattergl(
+        x=layout["coords"][points, 0],
+        y=layout["coords"][points, 1],
+        mode="markers",
+        name=name,
+        marker=marker,
+        text=layout["sample_ids"][points],
+        customdata=cluster_labels(layout, points),
+        hovertemplate="%{text}<br>Cluster %{customdata}<extra></extra>",
+    )
+
+
+def cluster_figure(layout, method, max_points, max_edges, show_edges=True):
+    """
+    WebGL scatter of a cluster layout. Coordinates are handed to plotly as
+    numpy arrays, which it sends to the browser as binary typed arrays.
+    """
+    points, edges = level_of_detail(layout, max_points, max_edges)
+    codes = layout["codes"][points]
+    flags = layout["flags"][points]
+    fig = go.Figure()
+
+    if show_edges and len(edges):
+        segments = edge_segments(layout["coords"], layout["edges"][edges])
+        fig.add_trace(
+            go.Scattergl(
+                x=segments[:, 0],
+                y=segments[:, 1],
+                mode="lines",
+                name="Neighbour edges",
+                line={"color": "rgba(120, 120, 120, 0.35)", "width": 1},
+                hoverinfo="skip",
+            )
+        )
+
+    n_colours = len(CLUSTER_COLOURS)
+    colourscale = []
+    for i, colour in enumerate(CLUSTER_COLOURS):
+        colourscale += [[i / n_colours, colour], [(i + 1) / n_colours, colour]]
+    clustered = points[codes >= 0]
+    fig.add_trace(
+        points_trace(
+            layout,
+            clustered,
+            "Clustered samples",
+            {
+                "color": layout["codes"][clustered] % n_colours,
+                "colorscale": colourscale,
+                "cmin": -0.5,
+                "cmax": n_colours - 0.5,
+                "size": 6,
+            },
+        )
+    )
+    unclustered = points[codes < 0]
+    if len(unclustered):
+        fig.add_trace(
+            points_trace(
+                layout,
+                unclustered,
+                "Unclustered samples",
+                {"color": "lightgrey", "size": 5},
+            )
+        )
+    uncertain = points[(flags & UNCERTAIN) > 0]
+    if len(uncertain):
+        fig.add_trace(
+            points_trace(
+                layout,
+                uncertain,
+                "Uncertain samples",
+                {
+                    "color": "rgba(0, 0, 0, 0)",
+                    "size": 13,
+                    "line": {"color": "orange", "width": 2},
+                },
+            )
+        )
+    errors = points[(flags & ERROR_CANDIDATE) > 0]
+    if len(errors):
+        fig.add_trace(
+            points_trace(
+                layout,
+                errors,
+                "Error candidates",
+                {"color": "red", "size": 12, "symbol": "x"},
+            )
+        )
+
+    n_samples = len(layout["codes"])
+    title = f"{method} representation"
+    if len(points) < n_samples:
+        title += f" ({len(points)} of {n_samples} samples shown)"
+    fig.update_layout(
+        title=title,
+        xaxis_title=f"{method} 1",
+        yaxis_title=f"{method} 2",
+        legend={"orientation": "h"},
+        height=650,
+    )
+    return fig
+
+
+def layout_table(layout):
+    """One row per sample of a cluster layout, for downloads and batch output."""
+    flags = layout["flags"]
+    return pd.DataFrame(
+        {
+            "Sample": layout["sample_ids"],
+            "x": layout["coords"][:, 0],
+            "y": layout["coords"][:, 1],
+            "Cluster": cluster_labels(layout, np.arange(len(flags))),
+            "Uncertain": (flags & UNCERTAIN) > 0,
+            "Error_Candidate": (flags & ERROR_CANDIDATE) > 0,
+        }
+    )
+
+
+def table_layout(table, edges):
+    """The cluster layout of a `layout_table` and its edges."""
+    codes, clusters = pd.factorize(table["Cluster"])
+    flags = np.where(table["Uncertain"], UNCERTAIN, 0) | np.where(
+        table["Error_Candidate"], ERROR_CANDIDATE, 0
+    )
+    return {
+        "sample_ids": table["Sample"].to_numpy(),
+        "coords": table[["x", "y"]].to_numpy(dtype=np.float32),
+        "codes": codes.astype(np.int32),
+        "clusters": np.asarray(clusters),
+        "flags": flags.astype(np.uint8),
+        "edges": np.asarray(edges, dtype=np.int32),
+    }
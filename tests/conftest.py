@@ -0,0 +1,45 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from constants import DEFAULT_RANKING_FILE
+from ingest import read_ranking_csv
+from synthetic import generate_cohort
+
+
+@pytest.fixture(scope="session")
+def ranking():
+    with open(os.path.join(ROOT, "data", DEFAULT_RANKING_FILE), "rb") as f:
+        return read_ranking_csv(f.read())
+
+
+@pytest.fixture(scope="session")
+def cohort(ranking):
+    # a few swapped samples and missing values, so that every pair class occurs
+    df, _ = generate_cohort(
+        ranking,
+        n_patients=30,
+        samples_per_patient=3,
+        n_proteins=40,
+        missing_rate=0.1,
+        swap_rate=0.1,
+        seed=1,
+    )
+    return df
+
+
+@pytest.fixture(scope="session")
+def matrix(cohort, ranking):
+    from matrix import build_protein_matrix
+
+    return build_protein_matrix(cohort, ranking, "test")
+
+
+@pytest.fixture(scope="session")
+def mapping(cohort):
+    return dict(zip(cohort["Sample_ID"], cohort["Patient_ID"]))
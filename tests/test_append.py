@@ -0,0 +1,127 @@
+import numpy as np
+import pytest
+
+from distances import (
+    appended_blocks,
+    appended_condensed,
+    appended_pairs,
+    compact_neighbours,
+    condensed_distances,
+    condensed_to_pairs,
+    evaluate_appended,
+    evaluate_distances,
+    same_patient_mask,
+    upper_pairs,
+)
+from matrix import append_samples, build_protein_matrix
+from incremental import INCREMENTAL_METRICS, IncrementalDistances
+from neighbours import appended_neighbours, top_k_neighbours
+
+N_NEIGHBOURS = 4
+
+
+@pytest.fixture(
+    scope="module",
+    # p = 0.01 gives distances far beyond float32
+    params=[("euclidean", None), ("correlation", None), ("fractional", 0.01)],
+)
+def appended(request, cohort, ranking):
+    metric, fractional_p = request.param
+    samples = cohort["Sample_ID"].unique()
+    is_base = cohort["Sample_ID"].isin(samples[:70])
+    base = build_protein_matrix(cohort[is_base], ranking, "base")
+    matrix = append_samples(base, cohort[~is_base], ranking, "appended")
+    n_base = base.n_samples
+
+    base_condensed = condensed_distances(base.top_n(20), metric, fractional_p)
+    base_result = evaluate_distances(
+        base_condensed,
+        base,
+        2.0,
+        compact_neighbours(top_k_neighbours(base_condensed, n_base, N_NEIGHBOURS)),
+    )
+    values = matrix.top_n(20)
+    cross, inner = appended_blocks(
+        values, n_base, metric, fractional_p, means=matrix.means(20)
+    )
+    positions, rows, cols = appended_pairs(n_base, matrix.n_samples - n_base)
+    condensed = appended_condensed(
+        base_condensed,
+        n_base,
+        matrix.n_samples,
+        positions,
+        np.concatenate([cross.T.ravel(), upper_pairs(inner)]),
+    )
+    nearest_neighbours = appended_neighbours(
+        base_result["neighbour_indices"],
+        base_result["neighbour_distances"],
+        cross,
+        inner,
+        N_NEIGHBOURS,
+    )
+    result = evaluate_appended(
+        base_result,
+        condensed,
+        matrix,
+        n_base,
+        positions,
+        rows,
+        cols,
+        compact_neighbours(nearest_neighbours),
+    )
+    # a full run on all samples, imputed with the base means like append_samples
+    full = condensed_distances(values, metric, fractional_p, means=matrix.means(20))
+    return {
+        "metric": metric,
+        "fractional_p": fractional_p,
+        "matrix": matrix,
+        "base_result": base_result,
+        "result": result,
+        "full": full,
+    }
+
+
+def test_appended_condensed_matches_full_recompute(appended):
+    np.testing.assert_allclose(
+        appended["result"]["condensed_distances"], appended["full"], rtol=1e-6
+    )
+
+
+def test_appended_neighbours_match_full_recompute(appended):
+    matrix = appended["matrix"]
+    _, expected = top_k_neighbours(appended["full"], matrix.n_samples, N_NEIGHBOURS)
+    assert np.isfinite(appended["result"]["neighbour_distances"]).all()
+    np.testing.assert_allclose(
+        np.sort(appended["result"]["neighbour_distances"], axis=1),
+        np.sort(expected, axis=1),
+        rtol=1e-5,
+    )
+
+
+def test_evaluate_appended_matches_full_recompute(appended):
+    matrix, result = appended["matrix"], appended["result"]
+    belonging = appended["full"] <= appended["base_result"]["threshold"]
+    same_patient = same_patient_mask(matrix.patient_codes)
+    for name, expected in (
+        ("TP", belonging & same_patient),
+        ("FP", belonging & ~same_patient),
+        ("FN", ~belonging & same_patient),
+    ):
+        np.testing.assert_array_equal(
+            result["pair_indices"][name], np.flatnonzero(expected)
+        )
+        rows, cols = condensed_to_pairs(np.flatnonzero(expected), matrix.n_samples)
+        np.testing.assert_array_equal(
+            result["sample_counts"][name],
+            np.bincount(rows, minlength=matrix.n_samples)
+            + np.bincount(cols, minlength=matrix.n_samples),
+        )
+
+
+def test_incremental_distances_impute_like_the_matrix(appended):
+    if appended["metric"] not in INCREMENTAL_METRICS:
+        pytest.skip("the metric is not additive over proteins")
+    engine = IncrementalDistances(
+        appended["matrix"], appended["metric"], appended["fractional_p"]
+    )
+    np.testing.assert_allclose(engine.distances(20), appended["full"], rtol=1e-6)
@@ -0,0 +1,19 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from embedding import match_layout
+
+
+def test_match_layout_aligns_frames_by_sample_id():
+    template = pd.DataFrame(np.zeros((3, 2)), index=["c", "a", "b"], columns=["x", "y"])
+    coords = np.array([[0.0, 1.0], [2.0, 3.0], [4.0, 5.0]])
+    matched = match_layout(template, coords, ["a", "b", "c"])
+    assert list(matched.index) == ["c", "a", "b"]
+    np.testing.assert_array_equal(matched.loc["b"], [2.0, 3.0])
+
+
+def test_match_layout_rejects_other_samples():
+    template = pd.DataFrame(np.zeros((2, 2)), index=[0, 1], columns=["x", "y"])
+    with pytest.raises(ValueError):
+        match_layout(template, np.zeros((2, 2)), ["a", "b"])
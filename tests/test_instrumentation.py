@@ -0,0 +1,40 @@
+import sys
+
+import numpy as np
+import pytest
+
+import instrumentation
+from instrumentation import Instrumentation, performance_table
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="stage peaks are Linux only")
+def test_peak_rss_is_per_stage_in_an_owned_process(monkeypatch):
+    monkeypatch.setattr(instrumentation, "_exclusive", True)
+    timings = Instrumentation()
+    with timings.stage("large"):
+        large = np.ones(64 * 1024**2, dtype=np.uint8)
+        del large
+    with timings.stage("small"):
+        pass
+    large, small = timings.report()["stages"]
+    assert large["peak_rss_bytes"] - small["peak_rss_bytes"] > 32 * 1024**2
+    table = performance_table(timings.report())
+    assert table["Stage peak RSS (MiB)"].notna().all()
+    assert table["Process-wide peak RSS (MiB)"].isna().all()
+
+
+def test_shared_process_keeps_its_peak_rss(monkeypatch):
+    # sessions of the app server must not reset the peaks of each other
+    monkeypatch.setattr(instrumentation, "_exclusive", False)
+
+    def reset_peak_rss():
+        raise AssertionError("the peak RSS of a shared process was reset")
+
+    monkeypatch.setattr(instrumentation, "reset_peak_rss", reset_peak_rss)
+    timings = Instrumentation()
+    with timings.stage("stage"):
+        pass
+    (stage,) = timings.report()["stages"]
+    assert stage["peak_rss_bytes"] is None
+    if instrumentation.resource is not None:
+        assert stage["process_peak_rss_bytes"] > 0
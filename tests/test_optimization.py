@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+import optimization
+from distances import fill_missing
+
+
+def reference_distances(values, p):
+    # the fractional distance of every pair, one pair at a time
+    n_samples = len(values)
+    return np.array(
+        [
+            np.sum(np.abs(values[i] - values[j]) ** p) ** (1 / p)
+            for i in range(n_samples)
+            for j in range(i + 1, n_samples)
+        ]
+    )
+
+
+def reference_score(tp, fp, fn, strategy):
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    sensitivity = tp / (tp + fn) if tp + fn else 0.0
+    total = precision + sensitivity
+    f1 = 2 * precision * sensitivity / total if total else 0.0
+    scores = {"F1": f1, "fp+fn": -(fp + fn), "precision": precision}
+    return scores[strategy], f1
+
+
+def reference_sweep(matrix, p_values, n_values, strategy):
+    """
+    Every (fractional_p, n, percentile) scored by thresholding the distances
+    with np.percentile, like a run with fixed parameters would.
+    """
+    codes = matrix.patient_codes
+    rows, cols = np.triu_indices(matrix.n_samples, 1)
+    same_patient = codes[rows] == codes[cols]
+    best = None
+    for p in p_values:
+        for n in n_values:
+            condensed = reference_distances(fill_missing(matrix.top_n(n)), p)
+            best_n = None
+            for percentile in optimization.PERCENTILE_GRID:
+                belonging = condensed <= np.percentile(condensed, percentile)
+                tp = int(np.sum(belonging & same_patient))
+                fp = int(np.sum(belonging & ~same_patient))
+                fn = int(np.sum(~belonging & same_patient))
+                score, f1 = reference_score(tp, fp, fn, strategy)
+                # ties go to the better F1, then to the lower percentile
+                if best_n is None or (score, f1) > (best_n["score"], best_n["F1"]):
+                    best_n = {"score": score, "F1": f1, "percentile": percentile}
+            if best is None or best_n["score"] > best["score"]:
+                best = dict(best_n, n=n, fractional_p=p)
+    return best
+
+
+@pytest.mark.parametrize("strategy", ["F1", "fp+fn", "precision"])
+def test_optimization_matches_reference_sweep(monkeypatch, matrix, strategy):
+    p_values = np.array([0.01, 0.05, 0.3, 1.0])
+    monkeypatch.setattr(optimization, "FRACTIONAL_P_GRID", p_values)
+    # every fractional_p is scored, so the result is that of the full sweep
+    monkeypatch.setattr(optimization, "COARSE_STEP", 1)
+    n_values = range(10, 13)
+    best = optimization.optimize_distance_parameters(
+        matrix, "fractional", n_values, strategy
+    )
+    expected = reference_sweep(matrix, p_values, n_values, strategy)
+    assert best["n"] == expected["n"]
+    assert best["fractional_p"] == expected["fractional_p"]
+    assert best["percentile"] == expected["percentile"]
+    assert best["score"] == pytest.approx(expected["score"], rel=1e-12)
+    assert best["F1"] == pytest.approx(expected["F1"], rel=1e-12)
+
+
+def test_fractional_p_grid_covers_the_parameter_range():
+    # the default fractional_p of the app and the CLI can be the optimum
+    assert optimization.FRACTIONAL_P_GRID[0] == 0.01
+    assert optimization.FRACTIONAL_P_GRID[-1] == 1.0
+
+
+def test_sweep_workers_fit_the_memory_budget(monkeypatch, matrix):
+    n_pairs = matrix.n_samples * (matrix.n_samples - 1) // 2
+    sweep_bytes = optimization.SWEEP_BYTES_PER_PAIR * n_pairs
+    monkeypatch.setattr(optimization, "worker_count", lambda: 8)
+    monkeypatch.setattr(optimization, "OPTIMIZATION_MAX_BYTES", 3 * sweep_bytes)
+    assert optimization.sweep_workers(matrix) == 3
+    monkeypatch.setattr(optimization, "OPTIMIZATION_MAX_BYTES", 0)
+    assert optimization.sweep_workers(matrix) == 1
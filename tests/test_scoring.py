@@ -0,0 +1,171 @@
+import numpy as np
+import pytest
+
+import reference
+from distances import (
+    PAIR_KEYS,
+    compact_neighbours,
+    condensed_distances,
+    condensed_to_pairs,
+    evaluate_distances,
+    pair_counts_per_sample,
+    pair_list,
+    pairs_to_condensed,
+    result_neighbours,
+    same_patient_mask,
+)
+from neighbours import top_k_neighbours
+from utils import (
+    calculate_f1_based_on_cutoff,
+    calculate_f1_based_on_nn_counts,
+    calculate_f1_based_on_nn_neighbour,
+    calculate_f1_scores,
+    f1_per_sample_and_patient,
+    nn_counts_from_indices,
+    sum_up_per_sample,
+)
+
+
+def assert_scores_equal(actual, expected):
+    assert list(actual) == list(expected)
+    for key, value in expected.items():
+        assert actual[key] == pytest.approx(value, rel=1e-12, abs=1e-12)
+
+
+@pytest.fixture(scope="module", params=[0.5, 2.0, 10.0])
+def evaluated(request, matrix):
+    condensed = condensed_distances(matrix.top_n(20), "correlation")
+    return evaluate_distances(
+        condensed,
+        matrix,
+        request.param,
+        top_k_neighbours(condensed, matrix.n_samples, 4),
+    )
+
+
+def pair_lists(result):
+    return {
+        name: pair_list(result["pair_indices"][name], result["sample_ids"])
+        for name in PAIR_KEYS
+    }
+
+
+@pytest.mark.parametrize("fractional_p", [0.01, 0.1, 0.5])
+def test_compact_neighbours_stay_finite(matrix, fractional_p):
+    condensed = condensed_distances(matrix.top_n(20), "fractional", fractional_p)
+    indices, distances = top_k_neighbours(condensed, matrix.n_samples, 4)
+    compact_indices, compact_distances = compact_neighbours((indices, distances))
+    assert np.isfinite(compact_distances).all()
+    np.testing.assert_array_equal(compact_indices, indices)
+    np.testing.assert_allclose(compact_distances, distances, rtol=1e-6)
+
+
+@pytest.mark.parametrize("n_samples", [2, 3, 17, 100])
+def test_condensed_pair_round_trip(n_samples):
+    n_pairs = n_samples * (n_samples - 1) // 2
+    rows, cols = condensed_to_pairs(np.arange(n_pairs), n_samples)
+    expected_rows, expected_cols = np.triu_indices(n_samples, 1)
+    np.testing.assert_array_equal(rows, expected_rows)
+    np.testing.assert_array_equal(cols, expected_cols)
+    np.testing.assert_array_equal(
+        pairs_to_condensed(rows, cols, n_samples), np.arange(n_pairs)
+    )
+    # the order within a pair does not matter
+    np.testing.assert_array_equal(
+        pairs_to_condensed(cols, rows, n_samples), np.arange(n_pairs)
+    )
+
+
+def test_pair_counts_per_sample():
+    n_samples = 12
+    indices = np.random.default_rng(0).choice(66, 20, replace=False)
+    rows, cols = np.triu_indices(n_samples, 1)
+    expected = np.bincount(rows[indices], minlength=n_samples) + np.bincount(
+        cols[indices], minlength=n_samples
+    )
+    np.testing.assert_array_equal(pair_counts_per_sample(indices, n_samples), expected)
+
+
+def test_same_patient_mask():
+    codes = np.array([0, 1, 0, 2, 1, 0])
+    rows, cols = np.triu_indices(len(codes), 1)
+    np.testing.assert_array_equal(same_patient_mask(codes), codes[rows] == codes[cols])
+
+
+def test_sum_up_per_sample(evaluated):
+    for pairs in [*pair_lists(evaluated).values(), []]:
+        assert sum_up_per_sample(pairs, {}) == reference.sum_up_per_sample(pairs, {})
+
+
+def test_calculate_f1_scores(cohort, mapping, evaluated):
+    counts = {
+        name: reference.sum_up_per_sample(pairs, {})
+        for name, pairs in pair_lists(evaluated).items()
+    }
+    arguments = (cohort, counts["TP"], counts["FP"], counts["FN"], mapping)
+    for actual, expected in zip(
+        calculate_f1_scores(*arguments), reference.calculate_f1_scores(*arguments)
+    ):
+        assert_scores_equal(actual, expected)
+
+
+def test_calculate_f1_based_on_cutoff(cohort, mapping, evaluated):
+    pairs = pair_lists(evaluated)
+    expected = reference.calculate_f1_based_on_cutoff(
+        cohort, pairs["TP"], pairs["FP"], [], pairs["FN"], mapping
+    )
+    actual = calculate_f1_based_on_cutoff(
+        cohort, pairs["TP"], pairs["FP"], [], pairs["FN"], mapping
+    )
+    for actual_scores, expected_scores in zip(actual, expected):
+        assert_scores_equal(actual_scores, expected_scores)
+
+
+def test_sample_counts_scoring(cohort, mapping, matrix, evaluated):
+    # the app scores from the per-sample counts of evaluate_distances
+    pairs = pair_lists(evaluated)
+    expected = reference.calculate_f1_based_on_cutoff(
+        cohort, pairs["TP"], pairs["FP"], [], pairs["FN"], mapping
+    )
+    counts = evaluated["sample_counts"]
+    actual = f1_per_sample_and_patient(
+        matrix.sample_ids,
+        matrix.patient_ids,
+        matrix.patient_codes,
+        counts["TP"],
+        counts["FP"],
+        counts["FN"],
+    )
+    for actual_scores, expected_scores in zip(actual, expected):
+        assert_scores_equal(actual_scores, expected_scores)
+
+
+@pytest.mark.parametrize("k", [1, 2, 3, 4])
+def test_calculate_f1_based_on_nn_neighbour(cohort, mapping, evaluated, k):
+    neighbours = result_neighbours(evaluated)
+    expected = reference.calculate_f1_based_on_nn_neighbour(
+        cohort, neighbours, mapping, k
+    )
+    actual = calculate_f1_based_on_nn_neighbour(cohort, neighbours, mapping, k)
+    for actual_scores, expected_scores in zip(actual[:2], expected[:2]):
+        assert_scores_equal(actual_scores, expected_scores)
+    assert list(actual[2]) == expected[2]
+
+
+@pytest.mark.parametrize("k", [1, 2, 3, 4, 6])
+def test_nn_counts_scoring(cohort, mapping, matrix, evaluated, k):
+    # the app scores every k from the same per-k counts, k beyond them is clipped
+    expected = reference.calculate_f1_based_on_nn_neighbour(
+        cohort, result_neighbours(evaluated), mapping, k
+    )
+    nn_counts = nn_counts_from_indices(
+        np.arange(matrix.n_samples),
+        evaluated["neighbour_indices"],
+        matrix.patient_codes,
+    )
+    actual = calculate_f1_based_on_nn_counts(
+        nn_counts, matrix.sample_ids, matrix.patient_ids, matrix.patient_codes, k
+    )
+    for actual_scores, expected_scores in zip(actual[:2], expected[:2]):
+        assert_scores_equal(actual_scores, expected_scores)
+    assert list(actual[2]) == expected[2]
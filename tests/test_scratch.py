@@ -0,0 +1,115 @@
+import os
+import threading
+
+import numpy as np
+
+import blocked
+import cache
+import optimization
+from constants import SKETCH_EPSILON
+from distances import condensed_distances, evaluate_distances
+from neighbours import top_k_neighbours
+from sketch import sketch_distances
+
+
+def scratch_files(directory):
+    return sorted(os.listdir(directory))
+
+
+def test_sweep_deletes_candidate_files(monkeypatch, tmp_path, matrix):
+    monkeypatch.setattr(blocked, "SCRATCH_DIR", str(tmp_path))
+    monkeypatch.setattr(optimization, "OUT_OF_CORE_MIN_SAMPLES", 0)
+    best = optimization.sweep_n(matrix, "euclidean", None, range(10, 13), "F1")
+    assert best["n"] in range(10, 13)
+    assert scratch_files(tmp_path) == []
+
+
+def test_scratch_distances_are_reused_and_evicted(monkeypatch, tmp_path, matrix):
+    monkeypatch.setattr(blocked, "SCRATCH_DIR", str(tmp_path))
+    values = matrix.top_n(20)
+    first = blocked.scratch_distances(values, "euclidean", None, ("a",))
+    np.testing.assert_allclose(
+        first, condensed_distances(values, "euclidean"), rtol=1e-6
+    )
+    again = blocked.scratch_distances(values, "euclidean", None, ("a",))
+    assert isinstance(again, np.memmap)
+    assert len(scratch_files(tmp_path)) == 1
+
+    # room for one distance file only, the least recently used one goes
+    size = os.path.getsize(first.filename)
+    monkeypatch.setattr(blocked, "SCRATCH_MAX_BYTES", size)
+    blocked.scratch_distances(values, "correlation", None, ("b",))
+    assert scratch_files(tmp_path) == [
+        os.path.basename(blocked.scratch_cache().path(("b",), ".npy"))
+    ]
+
+
+def test_disk_cache_only_reads_own_files(monkeypatch, tmp_path):
+    directory = tmp_path / "cache"
+    disk = cache.DiskCache(str(directory), 1024**2)
+    assert directory.stat().st_mode & 0o777 == 0o700
+    disk.put(("a",), {"value": 1})
+    assert disk.get(("a",)) == {"value": 1}
+    uid = os.getuid()
+    monkeypatch.setattr(cache.os, "getuid", lambda: uid + 1)
+    assert disk.get(("a",)) is None
+
+
+def test_disk_cache_clear(tmp_path):
+    disk = cache.DiskCache(str(tmp_path), 1024**2)
+    disk.put(("a",), np.arange(10))
+    disk.put(("b",), {"value": 1})
+    disk.clear()
+    assert scratch_files(tmp_path) == []
+
+
+def test_disk_cache_threads_write_the_same_key(monkeypatch, tmp_path):
+    # sessions of the app are threads of one process
+    disk = cache.DiskCache(str(tmp_path), 1024**2)
+    barrier = threading.Barrier(2)
+    dump = cache.pickle.dump
+
+    def concurrent_dump(*args):
+        barrier.wait(timeout=10)
+        dump(*args)
+
+    monkeypatch.setattr(cache.pickle, "dump", concurrent_dump)
+    errors = []
+
+    def put():
+        try:
+            disk.put(("a",), {"value": 1})
+        except OSError as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=put) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert disk.get(("a",)) == {"value": 1}
+    assert scratch_files(tmp_path) == [os.path.basename(disk.path(("a",), ".pkl"))]
+
+
+def test_out_of_core_fractional_matches_in_memory(tmp_path, matrix):
+    # p = 0.01 raises the sums to the 100th power, far beyond float32
+    values = matrix.top_n(20)
+    in_memory = condensed_distances(values, "fractional", 0.01)
+    expected = evaluate_distances(
+        in_memory, matrix, 2.0, top_k_neighbours(in_memory, matrix.n_samples, 4)
+    )
+    condensed = blocked.blocked_condensed_distances(
+        values, "fractional", 0.01, str(tmp_path / "distances.npy")
+    )
+    assert np.isfinite(condensed).all()
+    result = blocked.evaluate_distances_streamed(
+        condensed,
+        matrix,
+        2.0,
+        top_k_neighbours(np.asarray(condensed), matrix.n_samples, 4),
+        sketch_distances(condensed, matrix.patient_codes, SKETCH_EPSILON),
+    )
+    assert result["threshold"] == expected["threshold"]
+    for name in ("TP", "FP", "FN", "TN"):
+        assert result["eval_metrics"][name] == expected["eval_metrics"][name]
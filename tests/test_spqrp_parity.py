@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from distances import (
+    PAIR_KEYS,
+    condensed_distances,
+    evaluate_distances,
+    pair_list,
+    result_neighbours,
+)
+from matrix import build_protein_matrix
+from neighbours import top_k_neighbours
+
+spqrp_core = pytest.importorskip("spqrp.core")
+
+N = 20
+PERCENTILE = 2.0
+NEIGHBOURS = 4
+
+
+def pair_set(pairs):
+    return {frozenset(pair) for pair in pairs}
+
+
+@pytest.mark.parametrize(
+    "metric, fractional_p",
+    [("correlation", None), ("euclidean", None), ("fractional", 0.5)],
+)
+def test_evaluate_distances_matches_spqrp(cohort, ranking, metric, fractional_p):
+    expected = spqrp_core.perform_distance_evaluation_on_ranked_proteins(
+        df=cohort,
+        top_importance_df=ranking,
+        n=N,
+        p=PERCENTILE,
+        metric=metric,
+        fractional_p=fractional_p,
+        number_display_neighbours=NEIGHBOURS,
+    )
+    matrix = build_protein_matrix(cohort, ranking, "parity")
+    condensed = condensed_distances(matrix.top_n(N), metric, fractional_p)
+    result = evaluate_distances(
+        condensed,
+        matrix,
+        PERCENTILE,
+        top_k_neighbours(condensed, matrix.n_samples, NEIGHBOURS),
+    )
+
+    expected_distances = expected["distance_matrix"].reindex(
+        index=result["sample_ids"], columns=result["sample_ids"]
+    )
+    squared = np.zeros_like(expected_distances.to_numpy(dtype=np.float64))
+    rows, cols = np.triu_indices(matrix.n_samples, 1)
+    squared[rows, cols] = squared[cols, rows] = condensed
+    np.testing.assert_allclose(squared, expected_distances, rtol=1e-5, atol=1e-8)
+
+    for name, key in PAIR_KEYS.items():
+        assert pair_set(
+            pair_list(result["pair_indices"][name], result["sample_ids"])
+        ) == pair_set(expected["eval_metrics"][key])
+    for name in ("TP", "FP", "FN", "TN"):
+        assert result["eval_metrics"][name] == expected["eval_metrics"][name]
+
+    neighbours = result_neighbours(result)
+    expected_neighbours = expected["nearest_neighbours"].reindex(neighbours.index)
+    np.testing.assert_array_equal(
+        neighbours.iloc[:, 0::2].to_numpy().astype(str),
+        expected_neighbours.iloc[:, 0::2].to_numpy().astype(str),
+    )
+    np.testing.assert_allclose(
+        neighbours.iloc[:, 1::2].to_numpy(dtype=np.float64),
+        expected_neighbours.iloc[:, 1::2].to_numpy(dtype=np.float64),
+        rtol=1e-5,
+    )
@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from store import ResultStore
+
+
+def processing_output(n_samples, key):
+    rng = np.random.default_rng(0)
+    pairs = n_samples * (n_samples - 1) // 2
+    return {
+        "df_display": pd.DataFrame({"Sample ID": [f"S{i}" for i in range(n_samples)]}),
+        "metrics": {"F1 Score": 1.0},
+        "warning_patients": None,
+        "used_params": {"n": key[1]},
+        "distance_key": key,
+        "messages": [],
+        "result": {
+            "eval_metrics": {"TP": 1},
+            "threshold": 0.5,
+            "square": True,
+            "sample_ids": np.array([f"S{i}" for i in range(n_samples)]),
+            "condensed_distances": rng.random(pairs),
+            "neighbour_indices": np.zeros((n_samples, 2), dtype=np.int32),
+            "neighbour_distances": np.zeros((n_samples, 2)),
+            "sample_counts": {
+                name: np.zeros(n_samples, dtype=np.int32) for name in ("TP", "FP", "FN")
+            },
+        },
+    }
+
+
+def test_runs_share_their_distances(tmp_path):
+    store = ResultStore(str(tmp_path))
+    output = processing_output(50, ("abc", 20, "euclidean", None, None))
+    first = store.save_processing("abc", None, {"param_k": 1}, output)
+    second = store.save_processing("abc", None, {"param_k": 2}, output)
+    shared = store.distances_path(output["distance_key"])
+    assert os.stat(shared).st_nlink == 3
+    loaded = store.load_processing(second)
+    assert loaded["distance_key"] == output["distance_key"]
+    np.testing.assert_array_equal(
+        loaded["result"]["condensed_distances"],
+        output["result"]["condensed_distances"],
+    )
+    store.delete(first)
+    assert os.stat(shared).st_nlink == 2
+    store.delete(second)
+    assert not os.path.exists(shared)
+
+
+def test_prune_deletes_the_oldest_runs(tmp_path):
+    store = ResultStore(str(tmp_path))
+    run_ids = [
+        store.save_processing(
+            "abc", None, {"n": n}, processing_output(50, ("abc", n, "euclidean"))
+        )
+        for n in range(3)
+    ]
+    store.max_bytes = store.disk_usage() * 2 // 3
+    store.prune(keep=run_ids[-1])
+    assert store.find("processing", "abc", {"n": 0}) is None
+    assert store.find("processing", "abc", {"n": 2}) == run_ids[-1]
+    assert store.disk_usage() <= store.max_bytes
+    store.max_age = 0
+    store.prune()
+    assert store.history("abc").empty
+    assert os.listdir(tmp_path / "distances") == []
+
+
+def test_prune_walks_the_store_once(monkeypatch, tmp_path):
+    store = ResultStore(str(tmp_path))
+    output = processing_output(200, ("abc", 20, "euclidean"))
+    run_ids = [store.save_processing("abc", None, {"n": n}, output) for n in range(3)]
+    # deleting a run frees its own files, not the distances it shares
+    shared = os.stat(store.distances_path(output["distance_key"])).st_size
+    store.max_bytes = store.disk_usage() - shared // 2
+    walks = []
+    file_sizes = store.file_sizes
+    monkeypatch.setattr(store, "file_sizes", lambda: walks.append(1) or file_sizes())
+    store.prune(keep=run_ids[-1])
+    assert walks == [1]
+    assert store.history("abc")["id"].tolist() == run_ids[-1:]
+    assert os.path.exists(store.distances_path(output["distance_key"]))